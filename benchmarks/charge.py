@@ -0,0 +1,307 @@
+"""Banc d'essai de charge pour l'API Points-Air.
+
+Génère des utilisateurs, activités et observations synthétiques dans
+un DATADIR temporaire, puis lance des requêtes simultanées sur `apiv1`
+(en processus, par ASGI) et rapporte la latence (p50, p95, p99) et le
+débit de chaque point d'accès en JSON.  Avec `--reference`, compare le
+résultat à une exécution précédente et échoue en cas de régression.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, Union
+
+import httpx
+import numpy as np
+
+import points_air.api
+from points_air.especes import ESPECES, Observation
+from points_air.plateaux import FICHES
+from points_air.stockage import ouvrir
+from points_air.user import Activite, Utilisateur
+
+# Requête: méthode, URL et corps JSON
+Requete = Tuple[str, str, Any]
+
+
+class Donnees(NamedTuple):
+    """Identificateurs des données générées"""
+
+    users: List[Utilisateur]
+    plateaux: List[uuid.UUID]
+    boite: Tuple[float, float, float, float]
+
+
+def uuid_aleatoire(rng: random.Random) -> uuid.UUID:
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+def emplacement(
+    rng: random.Random, boite: Tuple[float, float, float, float]
+) -> Tuple[float, float]:
+    """Point (longitude, latitude) au hasard dans une boîte"""
+    minx, miny, maxx, maxy = boite
+    return (rng.uniform(minx, maxx), rng.uniform(miny, maxy))
+
+
+def date(rng: random.Random) -> datetime.datetime:
+    """Date au hasard en 2024"""
+    return datetime.datetime(2024, 1, 1) + datetime.timedelta(
+        minutes=rng.randrange(366 * 24 * 60)
+    )
+
+
+def activite(rng: random.Random, donnees: Donnees) -> Activite:
+    return Activite(
+        id=uuid_aleatoire(rng),
+        user=rng.choice(donnees.users).id,
+        sport=[rng.choice(["Marche", "Vélo"])],
+        plateau=rng.choice(donnees.plateaux),
+        date=date(rng),
+        confirme=rng.random() < 0.5,
+    )
+
+
+def observation(rng: random.Random, donnees: Donnees) -> Observation:
+    lon, lat = emplacement(rng, donnees.boite)
+    return Observation(
+        id=uuid_aleatoire(rng),
+        user=rng.choice(donnees.users).id,
+        date=date(rng),
+        code_espece=rng.choice(ESPECES).code_espece,
+        emplacement={"type": "Point", "coordinates": [lon, lat]},
+    )
+
+
+def generer(datadir: Path, moteur: str, echelle: int, rng: random.Random) -> Donnees:
+    """Générer `echelle` activités et observations, et echelle/100 utilisateurs"""
+    centroides = np.array([f.centroide for f in FICHES.values()])
+    minx, miny = centroides.min(axis=0) - 0.05
+    maxx, maxy = centroides.max(axis=0) + 0.05
+    donnees = Donnees(
+        users=[
+            Utilisateur(id=uuid_aleatoire(rng), nom=f"user{i}", sports=["Marche"])
+            for i in range(max(1, echelle // 100))
+        ],
+        plateaux=list(FICHES),
+        boite=(minx, miny, maxx, maxy),
+    )
+    stockage = ouvrir(moteur, datadir)
+    for user in donnees.users:
+        stockage.put_user(user)
+    lot = 10000
+    for debut in range(0, echelle, lot):
+        n = min(lot, echelle - debut)
+        stockage.put_activites([activite(rng, donnees) for _ in range(n)])
+        stockage.put_observations([observation(rng, donnees) for _ in range(n)])
+    stockage.close()
+    return donnees
+
+
+def scenarios(donnees: Donnees) -> Dict[str, Callable[[random.Random], Requete]]:
+    """Requêtes à mesurer, par point d'accès"""
+
+    def point(rng: random.Random) -> str:
+        lon, lat = emplacement(rng, donnees.boite)
+        return f"{lat},{lon}"
+
+    return {
+        "GET /palmares": lambda rng: ("GET", "/palmares", None),
+        "GET /plateaux/{lat},{lon}": lambda rng: (
+            "GET",
+            f"/plateaux/{point(rng)}?proximite=10&limite=10",
+            None,
+        ),
+        "GET /observations/{lat},{lon}": lambda rng: (
+            "GET",
+            f"/observations/{point(rng)}?proximite=5&limite=10",
+            None,
+        ),
+        "GET /activites": lambda rng: (
+            "GET",
+            f"/activites?user={rng.choice(donnees.users).id}&limite=100",
+            None,
+        ),
+        "GET /user/{nom}": lambda rng: (
+            "GET",
+            f"/user/{rng.choice(donnees.users).nom}",
+            None,
+        ),
+        "PUT /activite": lambda rng: (
+            "PUT",
+            "/activite",
+            json.loads(activite(rng, donnees).model_dump_json()),
+        ),
+        "PUT /observation": lambda rng: (
+            "PUT",
+            "/observation",
+            json.loads(observation(rng, donnees).model_dump_json()),
+        ),
+        "PUT /activites": lambda rng: (
+            "PUT",
+            "/activites",
+            [json.loads(activite(rng, donnees).model_dump_json()) for _ in range(20)],
+        ),
+    }
+
+
+async def mesurer(
+    client: httpx.AsyncClient, requetes: List[Requete], concurrence: int
+) -> Dict[str, Union[int, float]]:
+    """Lancer des requêtes avec `concurrence` clients et mesurer leur latence"""
+    latences: List[float] = []
+    erreurs = 0
+    suivantes = iter(requetes)
+
+    async def client_virtuel():
+        nonlocal erreurs
+        for methode, url, corps in suivantes:
+            debut = time.perf_counter()
+            r = await client.request(methode, url, json=corps)
+            latences.append(time.perf_counter() - debut)
+            if r.status_code >= 400:
+                erreurs += 1
+
+    debut = time.perf_counter()
+    await asyncio.gather(*(client_virtuel() for _ in range(concurrence)))
+    duree = time.perf_counter() - debut
+    p50, p95, p99 = np.percentile(np.array(latences) * 1000, [50, 95, 99])
+    return {
+        "n": len(latences),
+        "erreurs": erreurs,
+        "rps": round(len(latences) / duree, 1),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+    }
+
+
+async def lancer(args: argparse.Namespace, donnees: Donnees) -> Dict[str, Any]:
+    transport = httpx.ASGITransport(app=points_air.api.apiv1)
+    resultats = {}
+    client = httpx.AsyncClient(transport=transport, base_url="http://bench")
+    async with client:
+        for nom, generateur in scenarios(donnees).items():
+            if args.points and nom not in args.points:
+                continue
+            rng = random.Random(f"{args.graine}:{nom}")
+            # Réchauffement (caches, connexions, etc.)
+            rechauffement = [generateur(rng) for _ in range(args.concurrence)]
+            await mesurer(client, rechauffement, 1)
+            requetes = [generateur(rng) for _ in range(args.requetes)]
+            resultats[nom] = await mesurer(client, requetes, args.concurrence)
+            print(nom, resultats[nom], file=sys.stderr)
+    return resultats
+
+
+def commit() -> Union[str, None]:
+    """Commit courant, s'il y en a un"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparer(
+    reference: Dict[str, Any], resultat: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """Régressions de p95 ou de débit au-delà de la tolérance"""
+    regressions = []
+    for nom, mesure in resultat["resultats"].items():
+        ancienne = reference["resultats"].get(nom)
+        if ancienne is None:
+            continue
+        p95 = mesure["p95_ms"] / ancienne["p95_ms"]
+        rps = mesure["rps"] / ancienne["rps"]
+        print(f"{nom}: p95 x{p95:.2f}, rps x{rps:.2f}", file=sys.stderr)
+        if p95 > 1 + tolerance or rps < 1 / (1 + tolerance):
+            regressions.append(nom)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-n",
+        "--echelle",
+        type=int,
+        default=1000,
+        help="Nombre d'activités et d'observations",
+    )
+    parser.add_argument(
+        "-r", "--requetes", type=int, default=1000, help="Requêtes par point d'accès"
+    )
+    parser.add_argument(
+        "-c", "--concurrence", type=int, default=32, help="Clients simultanés"
+    )
+    parser.add_argument(
+        "-m", "--moteur", default="sqlite", help="Stockage (sqlite ou fichiers)"
+    )
+    parser.add_argument("--graine", type=int, default=42, help="Graine aléatoire")
+    parser.add_argument(
+        "-p", "--points", nargs="*", help="Points d'accès à mesurer (défaut: tous)"
+    )
+    parser.add_argument("-o", "--output", type=Path, help="Fichier de résultats JSON")
+    parser.add_argument(
+        "--reference", type=Path, help="Résultats JSON d'une exécution précédente"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Régression tolérée (fraction)"
+    )
+    args = parser.parse_args()
+    # Une ligne par requête fausserait les mesures
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    rng = random.Random(args.graine)
+    with tempfile.TemporaryDirectory() as tempdir:
+        datadir = Path(tempdir)
+        debut = time.perf_counter()
+        donnees = generer(datadir, args.moteur, args.echelle, rng)
+        generation = time.perf_counter() - debut
+        print(f"Données générées en {generation:.1f}s", file=sys.stderr)
+        points_air.api.DATADIR = datadir
+        os.environ["STORAGE"] = args.moteur
+        try:
+            resultats = asyncio.run(lancer(args, donnees))
+        finally:
+            points_air.api.fermer()
+    resultat = {
+        "commit": commit(),
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "moteur": args.moteur,
+        "echelle": args.echelle,
+        "requetes": args.requetes,
+        "concurrence": args.concurrence,
+        "graine": args.graine,
+        "generation_s": round(generation, 3),
+        "resultats": resultats,
+    }
+    sortie = json.dumps(resultat, indent=2)
+    if args.output:
+        args.output.write_text(sortie + "\n")
+    else:
+        print(sortie)
+    if args.reference:
+        reference = json.loads(args.reference.read_text())
+        regressions = comparer(reference, resultat, args.tolerance)
+        if regressions:
+            print("Régressions:", ", ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
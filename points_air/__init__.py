@@ -1,10 +1,128 @@
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Dict
+
 import uvicorn
 
+LOGGER = logging.getLogger("points-air")
+# Un processus terminé moins de DEMARRAGE_MIN secondes après son lancement
+# est relancé après un délai qui double à chaque fois (à partir de DELAI),
+# jusqu'à RELANCES_MAX fois de suite, après quoi le serveur abandonne
+DEMARRAGE_MIN = 10.0
+DELAI = 0.5
+RELANCES_MAX = 5
+
+
+def servir(config: uvicorn.Config, sock: socket.socket) -> None:
+    """Lancer un serveur dans un processus fils"""
+    # Arrêté par le parent seulement (pas deux fois par Ctrl-C)
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    code = 1
+    try:
+        uvicorn.Server(config).run(sockets=[sock])
+        code = 0
+    except Exception:
+        LOGGER.exception("Échec du processus %d", os.getpid())
+    finally:
+        os._exit(code)
+
+
+def prefork(config: uvicorn.Config, workers: int) -> None:
+    """
+    Lancer `workers` processus qui partagent les données géographiques
+    chargées (et projetées en mémoire) par le processus parent avant
+    leur création, ainsi que le socket d'écoute.
+    """
+    from . import plateaux  # noqa: F401 (géodonnées partagées avec les processus)
+
+    gc.freeze()  # Ne pas copier les pages des objets partagés au ramassage
+    sock = config.bind_socket()
+    fils: Dict[int, int] = {}
+    lancements: Dict[int, float] = {}
+    echecs = [0] * workers
+    arret = False
+
+    def lancer(i: int) -> None:
+        lancements[i] = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            servir(config, sock)
+        fils[pid] = i
+
+    def arreter(signum, frame) -> None:
+        nonlocal arret
+        arret = True
+        for pid in fils:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, arreter)
+    signal.signal(signal.SIGTERM, arreter)
+    for i in range(workers):
+        lancer(i)
+    LOGGER.info("%d processus lancés: %s", workers, ", ".join(map(str, fils)))
+    while fils:
+        try:
+            pid, statut = os.wait()
+        except ChildProcessError:
+            break
+        i = fils.pop(pid)
+        if arret:
+            continue
+        if time.monotonic() - lancements[i] < DEMARRAGE_MIN:
+            echecs[i] += 1
+        else:
+            echecs[i] = 0
+        if echecs[i] >= RELANCES_MAX:
+            LOGGER.error("Processus %d terminé %d fois au lancement", pid, echecs[i])
+            arreter(signal.SIGTERM, None)
+            continue
+        delai = DELAI * 2 ** (echecs[i] - 1) if echecs[i] else 0.0
+        LOGGER.warning(
+            "Processus %d terminé (%d), relance dans %.1f s", pid, statut, delai
+        )
+        time.sleep(delai)
+        if not arret:
+            lancer(i)
+    sock.close()
+    if any(e >= RELANCES_MAX for e in echecs):
+        raise SystemExit("Abandon: les processus ne démarrent pas")
+
 
 def main():
     """Fonction principale"""
+    parser = argparse.ArgumentParser(description="Serveur de l'API Points-Air")
+    parser.add_argument("--host", default="127.0.0.1", help="Adresse d'écoute")
+    parser.add_argument("--port", type=int, default=8000, help="Port d'écoute")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=int(os.environ.get("WEB_CONCURRENCY", 1)),
+        help="Nombre de processus (défaut: WEB_CONCURRENCY ou 1)",
+    )
+    args = parser.parse_args()
     from .api import apiv1
-    uvicorn.run(apiv1, port=8000)
+
+    if args.workers <= 1:
+        uvicorn.run(apiv1, host=args.host, port=args.port)
+    elif hasattr(os, "fork"):
+        logging.basicConfig(level=logging.INFO)
+        prefork(uvicorn.Config(apiv1, host=args.host, port=args.port), args.workers)
+    else:
+        # Sans fork, chaque processus charge ses propres données
+        uvicorn.run(
+            "points_air.api:apiv1",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+        )
 
 
 if __name__ == '__main__':
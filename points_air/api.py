@@ -1,16 +1,61 @@
+import asyncio
+import datetime
+import json
 import logging
+import math
+import secrets
+import threading
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Annotated, Dict, List, Tuple, Union
+from typing import (
+    Annotated,
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Literal,
+    Tuple,
+    Type,
+    Union,
+)
 from uuid import UUID
 
-from fastapi import Body, FastAPI, Request, Query, Response, status
+from fastapi import Body, FastAPI, HTTPException, Request, Query, Response, status
+from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, Field, ValidationError
+from starlette.concurrency import run_in_threadpool
 from starlette.config import Config
 
-from .especes import ESPECES, Espece, Observation
-from .plateaux import PLATEAUX, Plateau
+from . import geodonnees, medias, metriques, reponses, traces, tuiles
+from .ecrivain import Ecrivain
+from .especes import CATEGORIE_ESPECE, ESPECES, Espece, Observation
+from .metriques import Metriques
+from .plateaux import PLATEAUX, SHAPES, Mesure, Plateau, Sport
+from .reponses import (
+    NDJSON,
+    json_liste,
+    json_modele,
+    json_octets,
+    rendu,
+    reponse_paginee,
+    reponse_statique,
+    sans_geometrie,
+)
+from .stockage import NomPris, Stockage, ouvrir
+from .traces import TraceInvalide, Verification
+from .tuiles import NIVEAU_MAX, Densite
 from .user import Activite, Utilisateur
-from .villes import VILLES, Palmares, Score, Ville
+from .villes import (
+    VILLES,
+    Palmares,
+    Periode,
+    Score,
+    Ville,
+    bornes_periode,
+    villes_wgs84,
+)
 
 # FLAT FILES ARE THE FUTURE!!!
 DATADIR = Path("data")
@@ -19,7 +64,48 @@ DATADIR.mkdir(parents=True, exist_ok=True)
 LOGGER = logging.getLogger("points-air-api")
 CONFIG = Config()
 logging.basicConfig(level=logging.INFO)
-app = FastAPI()
+CACHE_CONTROL = f"public, max-age={CONFIG('CACHE_MAX_AGE', cast=int, default=3600)}"
+reponses.TAILLE_MAX = CONFIG(
+    "RESPONSE_CACHE_BYTES", cast=int, default=reponses.TAILLE_MAX
+)
+reponses.TAILLE_MIN_COMPRESSION = CONFIG(
+    "COMPRESSION_MIN_BYTES", cast=int, default=reponses.TAILLE_MIN_COMPRESSION
+)
+STOCKAGE: Union[Stockage, None] = None
+ECRIVAIN: Union[Ecrivain, None] = None
+# Ouverture du stockage (au démarrage, dans un fil, ou au premier usage)
+OUVERTURE = threading.RLock()
+
+
+# Seuils de confirmation des activités par leur trace GPS
+TRACE_COUVERTURE_MIN = CONFIG(
+    "TRACE_COUVERTURE_MIN", cast=float, default=traces.COUVERTURE_MIN
+)
+TRACE_DUREE_MIN = CONFIG("TRACE_DUREE_MIN", cast=float, default=traces.DUREE_MIN)
+traces.TAILLE_MAX = CONFIG("TRACE_MAX_BYTES", cast=int, default=traces.TAILLE_MAX)
+medias.TAILLE_MAX = CONFIG("PHOTO_MAX_BYTES", cast=int, default=medias.TAILLE_MAX)
+medias.ATELIERS = CONFIG("THUMBNAIL_WORKERS", cast=int, default=medias.ATELIERS)
+# Jeton des points d'accès d'administration (désactivés sans jeton)
+ADMIN_TOKEN = CONFIG("ADMIN_TOKEN", default=None)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    surveillant = None
+    intervalle = CONFIG("GEODATA_POLL_SECONDS", cast=float, default=0)
+    if intervalle > 0:
+        surveillant = geodonnees.Surveillant(intervalle)
+        surveillant.start()
+    # Ouvrir (et vérifier) le stockage hors de la boucle d'événements, et
+    # non pendant la première requête
+    await run_in_threadpool(ecrivain)
+    yield
+    if surveillant is not None:
+        await run_in_threadpool(surveillant.close)
+    await run_in_threadpool(fermer)
+
+
+app = FastAPI(lifespan=lifespan)
 middleware_args: Dict[str, Union[str, List[str]]]
 if CONFIG("DEVELOPMENT", default=False):
     LOGGER.info("En mode développement, requêtes seront acceptés de http://localhost:*")
@@ -37,63 +123,296 @@ app.add_middleware(
     allow_methods=["GET", "PUT", "POST", "DELETE", "OPTIONS"],
     **middleware_args,
 )
-apiv1 = FastAPI(title="Points-Air API")
+# Servie seule par points_air_api, d'où son propre lifespan
+apiv1 = FastAPI(title="Points-Air API", lifespan=lifespan)
 apiv1.add_middleware(
     CORSMiddleware,
     allow_methods=["GET", "PUT", "POST", "DELETE", "OPTIONS"],
     **middleware_args,
 )
+# Réponses dynamiques seulement, les statiques sont déjà compressées, et
+# jamais les photos (y compris HEIC), déjà compressées par leur format
+apiv1.add_middleware(
+    GZipMiddleware,
+    minimum_size=reponses.TAILLE_MIN_COMPRESSION,
+    compresslevel=6,
+    exclude_content_types=("image/*", "audio/*", "video/*", "application/zip"),
+)
+apiv1.add_middleware(
+    Metriques,
+    routes=apiv1.router.routes,
+    profils=Path(CONFIG("PROFILE_DIR", default="profils")),
+    lent=CONFIG("PROFILE_SLOW_SECONDS", cast=float, default=None),
+    entete=CONFIG("PROFILE_HEADER", cast=bool, default=False),
+)
+apiv1.add_middleware(geodonnees.Epinglage)
 app.mount("/api/v1", apiv1)
 
 
+def stockage() -> Stockage:
+    """Obtenir le stockage pour DATADIR (ouvert au démarrage ou au premier usage)"""
+    global STOCKAGE
+    with OUVERTURE:
+        if STOCKAGE is None or STOCKAGE.datadir != DATADIR:
+            fermer()
+            STOCKAGE = ouvrir(CONFIG("STORAGE", default="sqlite"), DATADIR)
+        return STOCKAGE
+
+
+def ecrivain() -> Ecrivain:
+    """Obtenir l'écrivain du stockage courant"""
+    global ECRIVAIN
+    with OUVERTURE:
+        stock = stockage()
+        if ECRIVAIN is None or ECRIVAIN.stockage is not stock:
+            ECRIVAIN = Ecrivain(stock)
+        return ECRIVAIN
+
+
+def fermer() -> None:
+    """Terminer les écritures en attente et fermer le stockage"""
+    global STOCKAGE, ECRIVAIN
+    with OUVERTURE:
+        if ECRIVAIN is not None:
+            ECRIVAIN.close()
+            ECRIVAIN = None
+        if STOCKAGE is not None:
+            STOCKAGE.close()
+            STOCKAGE = None
+    medias.fermer()
+
+
+class Geodonnees(BaseModel):
+    """Version des données géographiques servies"""
+
+    version: int = Field(description="Numéro de version, croissant")
+    villes: int = Field(description="Nombre de villes")
+    plateaux: int = Field(description="Nombre de plateaux")
+
+    @classmethod
+    def de_version(cls, version: geodonnees.Version) -> "Geodonnees":
+        return cls(
+            version=version.numero,
+            villes=len(version.donnees["villes"].fiches),
+            plateaux=len(version.donnees["plateaux"].fiches),
+        )
+
+
+def autoriser(request: Request) -> None:
+    """Vérifier le jeton d'administration (Authorization: Bearer)"""
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Not Found")
+    schema, _, jeton = request.headers.get("authorization", "").partition(" ")
+    if schema.lower() != "bearer" or not secrets.compare_digest(
+        jeton.encode(), ADMIN_TOKEN.encode()
+    ):
+        raise HTTPException(
+            status.HTTP_401_UNAUTHORIZED,
+            "Jeton d'administration requis",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+class Resultat(BaseModel):
+    """Résultat de l'écriture d'un enregistrement d'un lot"""
+
+    id: Union[UUID, None] = None
+    erreur: Union[str, None] = None
+
+
+def corps_lot(modele: str) -> Dict[str, Any]:
+    """Documentation OpenAPI d'un corps de requête en lot"""
+    schema = {"type": "array", "items": {"$ref": f"#/components/schemas/{modele}"}}
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": schema}, NDJSON: {}},
+        }
+    }
+
+
+def sans_photos(obs: Observation) -> Observation:
+    """Ignorer les photos fournies: seul PUT /observation/{id}/photo en ajoute"""
+    return obs.model_copy(update={"photos": []}) if obs.photos else obs
+
+
+async def ecrire_lot(
+    request: Request, modele: Type[BaseModel], genre: str
+) -> List[Resultat]:
+    """Valider un lot (tableau JSON ou NDJSON) et l'écrire d'un coup"""
+    corps = await request.body()
+    donnees: List[Union[bytes, Any]]
+    if NDJSON in request.headers.get("content-type", ""):
+        donnees = [ligne for ligne in corps.splitlines() if ligne.strip()]
+    else:
+        try:
+            donnees = json.loads(corps)
+        except ValueError as e:
+            raise HTTPException(422, str(e))
+        if not isinstance(donnees, list):
+            raise HTTPException(422, "Tableau JSON attendu")
+    resultats = []
+    valides = []
+    for donnee in donnees:
+        try:
+            if isinstance(donnee, bytes):
+                enregistrement = modele.model_validate_json(donnee)
+            else:
+                enregistrement = modele.model_validate(donnee)
+        except ValidationError as e:
+            erreur = "; ".join(
+                f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()
+            )
+            resultats.append(Resultat(erreur=erreur))
+        else:
+            if isinstance(enregistrement, Observation):
+                enregistrement = sans_photos(enregistrement)
+            resultats.append(Resultat(id=enregistrement.id))  # type: ignore
+            valides.append((len(resultats) - 1, enregistrement))
+    erreurs = await ecrivain().ecrire_lot(genre, [e for _, e in valides])
+    for (i, _), erreur in zip(valides, erreurs):
+        if erreur is not None:
+            LOGGER.error("Échec d'écriture %s %s: %s", genre, resultats[i].id, erreur)
+            resultats[i].erreur = str(erreur)
+    LOGGER.info(
+        "Creation/MAJ de %d %ss (%d erreurs)",
+        len(resultats),
+        genre,
+        sum(r.erreur is not None for r in resultats),
+    )
+    return resultats
+
+
 @apiv1.get("/", summary="Bonjour!")
 async def home_page(request: Request) -> str:
     return "Bonjour!"
 
 
-@apiv1.get("/villes", summary="Liste de villes")
+@apiv1.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    """Métriques au format Prometheus"""
+    return Response(
+        metriques.exposer(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@apiv1.get("/geodonnees", summary="Version des données géographiques")
+async def get_geodonnees() -> Geodonnees:
+    """Obtenir la version des villes et plateaux servis"""
+    return Geodonnees.de_version(geodonnees.actuelle())
+
+
+@apiv1.post("/admin/geodonnees", include_in_schema=False)
+async def recharger_geodonnees(request: Request) -> Geodonnees:
+    """Recharger les villes et plateaux sans redémarrer (jeton requis)"""
+    autoriser(request)
+    # Construite dans un autre fil, les requêtes continuent sur l'ancienne version
+    version = await run_in_threadpool(geodonnees.recharger)
+    return Geodonnees.de_version(version)
+
+
+@apiv1.get("/villes", summary="Liste de villes", response_model=List[Ville])
 async def villes(
+    request: Request,
     geometrie: Annotated[
         bool, Query(description="Retourner perimètre en GeoJSON")
-    ] = False
-) -> List[Ville]:
+    ] = False,
+) -> Response:
     """
     Obtenir la liste de villes de compétition.
     """
-    return [
-        v.model_dump(exclude=None if geometrie else "feature") for v in VILLES.values()
-    ]
+    return await reponse_statique(
+        request,
+        ("villes", geometrie),
+        lambda: json_liste(sans_geometrie(v, geometrie) for v in VILLES.values()),
+        CACHE_CONTROL,
+    )
 
 
-@apiv1.get("/ville/{latitude},{longitude}", summary="Ville par emplacement")
+@apiv1.get(
+    "/ville/{latitude},{longitude}",
+    summary="Ville par emplacement",
+    response_model=Union[Ville, None],
+)
 async def ville_wsg84(
+    request: Request,
     latitude: float,
     longitude: float,
     geometrie: Annotated[
         bool, Query(description="Retourner perimètre en GeoJSON")
     ] = False,
-) -> Union[Ville, None]:
+) -> Union[Response, None]:
     """
     Localiser un emplacement dans une des villes de compétition.
     """
     ville = Ville.from_wgs84(latitude, longitude)
     if ville is None:
         return None
-    if geometrie:
-        return ville
-    else:
-        return ville.model_dump(exclude="feature")
+    # Même réponse que /ville/{id}
+    return await reponse_statique(
+        request,
+        ("ville", ville.id, geometrie),
+        lambda: json_modele(sans_geometrie(ville, geometrie)),
+        CACHE_CONTROL,
+    )
+
+
+@apiv1.post(
+    "/villes/emplacements",
+    summary="Villes par emplacements",
+    response_model=List[Union[str, None]],
+)
+async def villes_emplacements(
+    emplacements: Annotated[
+        List[Tuple[float, float]],
+        Body(
+            description="Emplacements (latitude, longitude)",
+            examples=[[[45.768380, -73.431657], [45.628861, -73.804224]]],
+        ),
+    ]
+) -> Response:
+    """
+    Localiser plusieurs emplacements à la fois.  Retourne l'identificateur
+    de la ville de compétition de chaque emplacement, ou `null`.
+    """
+    if not emplacements:
+        return Response(b"[]", media_type="application/json")
+    latitudes, longitudes = zip(*emplacements)
+    return Response(
+        json_octets(villes_wgs84(latitudes, longitudes)),
+        media_type="application/json",
+    )
 
 
-@apiv1.get("/ville/{id}", summary="Ville par identificateur")
-async def ville_id(id: str, geometrie: bool = False) -> Ville:
+@apiv1.get("/ville/{id}", summary="Ville par identificateur", response_model=Ville)
+async def ville_id(request: Request, id: str, geometrie: bool = False) -> Response:
     """
     Obtenir les informations pour une ville de compétition.
     """
-    return VILLES[id].model_dump(exclude=None if geometrie else "feature")
+    ville = VILLES.get(id)
+    if ville is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, f"Ville {id} inconnue")
+    return await reponse_statique(
+        request,
+        ("ville", id, geometrie),
+        lambda: json_modele(sans_geometrie(ville, geometrie)),
+        CACHE_CONTROL,
+    )
+
+
+def json_plateau(plateau: Plateau, geometrie: bool) -> bytes:
+    """Plateau rendu une seule fois, comme pour /plateau/{id}"""
+    return rendu(
+        ("plateau", plateau.id, geometrie),
+        lambda: json_modele(sans_geometrie(plateau, geometrie)),
+    ).contenu
 
 
-@apiv1.get("/plateaux/{latitude},{longitude}", summary="Plateaux par emplacement")
+@apiv1.get(
+    "/plateaux/{latitude},{longitude}",
+    summary="Plateaux par emplacement",
+    response_model=List[Tuple[float, Plateau]],
+)
 async def activ_wgs84(
     latitude: float,
     longitude: float,
@@ -104,63 +423,107 @@ async def activ_wgs84(
     geometrie: Annotated[
         bool, Query(description="Retourner perimètre en GeoJSON")
     ] = False,
-) -> List[Tuple[float, Plateau]]:
+    mesure: Annotated[
+        Mesure,
+        Query(description="Distance jusqu'au centroïde ou jusqu'au périmètre"),
+    ] = "centroide",
+) -> Response:
     """
     Localiser des activités par emplacement
     """
-    return [
-        (dist, p.model_dump(exclude=None if geometrie else "feature"))
-        for dist, p in Plateau.near_wgs84(latitude, longitude, proximite, limite)
+    paires = [
+        b"[%s,%s]" % (json_octets(dist), json_plateau(p, geometrie))
+        for dist, p in Plateau.near_wgs84(
+            latitude, longitude, proximite, limite, mesure
+        )
     ]
+    return Response(b"[" + b",".join(paires) + b"]", media_type="application/json")
 
 
-@apiv1.get("/plateaux/{ville}", summary="Plateaux par ville")
+@apiv1.get(
+    "/plateaux/{ville}", summary="Plateaux par ville", response_model=List[Plateau]
+)
 async def plateau_par_ville(
+    request: Request,
     ville: str,
     geometrie: Annotated[
         bool, Query(description="Retourner perimètre en GeoJSON")
     ] = False,
-) -> List[Plateau]:
+) -> Response:
     """
     Localiser des activités par ville
     """
-    return [
-        p.model_dump(exclude=None if geometrie else "feature") for p in PLATEAUX[ville]
-    ]
+    plateaux = PLATEAUX.get(ville)
+    if plateaux is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, f"Ville {ville} inconnue")
+    return await reponse_statique(
+        request,
+        ("plateaux", ville, geometrie),
+        lambda: json_liste(sans_geometrie(p, geometrie) for p in plateaux),
+        CACHE_CONTROL,
+    )
 
 
-@apiv1.get("/plateau/{id}", summary="Plateau par identificateur")
+@apiv1.get(
+    "/plateau/{id}",
+    summary="Plateau par identificateur",
+    response_model=Union[Plateau, None],
+)
 async def plateau_par_id(
+    request: Request,
     id: UUID,
     geometrie: Annotated[
         bool, Query(description="Retourner perimètre en GeoJSON")
     ] = False,
-) -> Union[Plateau, None]:
+) -> Union[Response, None]:
     """
     Localiser des activités par ville
     """
     plateau = Plateau.from_uuid(id)
     if plateau is None:
         return None
-    elif geometrie:
-        return plateau
-    else:
-        return plateau.model_dump(exclude="feature")
+    return await reponse_statique(
+        request,
+        ("plateau", id, geometrie),
+        lambda: json_modele(sans_geometrie(plateau, geometrie)),
+        CACHE_CONTROL,
+    )
 
 
 @apiv1.get("/palmares", summary="Palmarès des villes")
-async def palmares() -> Palmares:
-    """Obtenir les palmares des villes"""
+async def palmares(
+    confirme: Annotated[
+        bool, Query(description="Compter seulement les activités confirmées")
+    ] = False,
+    periode: Annotated[
+        Union[Periode, None],
+        Query(description="Compter seulement les activités de cette période"),
+    ] = None,
+    jour: Annotated[
+        Union[datetime.date, None],
+        Query(description="Jour dans la période (par défaut aujourd'hui)"),
+    ] = None,
+    debut: Annotated[
+        Union[datetime.date, None],
+        Query(description="Premier jour (remplace le début de la période)"),
+    ] = None,
+    fin: Annotated[
+        Union[datetime.date, None],
+        Query(description="Jour suivant le dernier (remplace la fin de la période)"),
+    ] = None,
+    sport: Annotated[
+        Union[Sport, None], Query(description="Compter seulement ce sport")
+    ] = None,
+) -> Palmares:
+    """Obtenir les palmares des villes, depuis toujours ou par période et sport"""
+    if periode is not None:
+        premier, lendemain = bornes_periode(periode, jour or datetime.date.today())
+        debut = premier if debut is None else debut
+        fin = lendemain if fin is None else fin
     scores: Dict[str, int] = {ville: 0 for ville in VILLES}
-    # FIXME: Faut clairement une vraie DB!!!
-    for path in (DATADIR / "activites").iterdir():
-        if path.suffix != ".json":
-            continue
-        with open(path, "rt") as infh:
-            act = Activite.model_validate_json(infh.read())
-            p = Plateau.from_uuid(act.plateau)
-            if p is not None:
-                scores[p.ville] += 1
+    scores.update(
+        await run_in_threadpool(stockage().scores, confirme, debut, fin, sport)
+    )
     return Palmares([Score(ville=k, score=v) for k, v in scores.items()])
 
 
@@ -168,56 +531,315 @@ async def palmares() -> Palmares:
 async def put_activite(activite: Activite) -> Activite:
     """Creer ou mettre a jour une activite"""
     # FIXME: Faut clairement de l'authentification, etc!!!
-    acpath = DATADIR / "activites" / f"{activite.id}.json"
-    acpath.parent.mkdir(parents=True, exist_ok=True)
-    with open(acpath, "wt") as outfh:
-        print(activite.model_dump_json(indent=2), file=outfh)
-    LOGGER.info("Creation/MAJ activité: %s dans %s", activite.id, acpath)
+    await ecrivain().put_activite(activite)
+    LOGGER.info("Creation/MAJ activité: %s", activite.id)
     return activite
 
 
-@apiv1.get("/activites")
-async def activites(user: UUID) -> List[Activite]:
-    """Obtenir les contributions d'un utilisateur"""
-    # FIXME: Faut clairement une vraie DB!!!
-    acts = []
-    for path in (DATADIR / "activites").iterdir():
-        if path.suffix != ".json":
-            continue
-        with open(path, "rt") as infh:
-            act = Activite.model_validate_json(infh.read())
-            if act.user != user:
-                continue
-            acts.append(act)
-    return acts
+@apiv1.put(
+    "/activites", summary="Création/MÀJ en lot", openapi_extra=corps_lot("Activite")
+)
+async def put_activites(request: Request) -> List[Resultat]:
+    """Creer ou mettre a jour plusieurs activites (tableau JSON ou NDJSON)"""
+    # FIXME: Faut clairement de l'authentification, etc!!!
+    return await ecrire_lot(request, Activite, "activite")
+
+
+@apiv1.put(
+    "/activite/{id}/trace",
+    summary="Confirmer une activité par sa trace GPS",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {traces.GPX: {}, traces.GEOJSON: {}},
+        }
+    },
+)
+async def put_trace(request: Request, id: UUID) -> Verification:
+    """
+    Vérifier la trace GPS (GPX ou GeoJSON) d'une activité contre la
+    géométrie de son plateau, et confirmer l'activité si assez de ses
+    points y sont et, si la trace est horodatée, qu'elle y a passé assez
+    de temps.
+    """
+    # FIXME: Faut clairement de l'authentification, etc!!!
+    activite = await run_in_threadpool(stockage().get_activite, id)
+    if activite is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Activité non trouvée")
+    shape = SHAPES.get(activite.plateau)
+    if shape is None:
+        raise HTTPException(422, "Plateau de l'activité inconnu")
+    lecteur = traces.lecteur(request.headers.get("content-type", ""))
+    taille = 0
+    try:
+        async for morceau in request.stream():
+            taille += len(morceau)
+            if taille > traces.TAILLE_MAX:
+                raise HTTPException(
+                    status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, "Trace trop volumineuse"
+                )
+            await run_in_threadpool(lecteur.feed, morceau)
+        trace = await run_in_threadpool(lecteur.close)
+    except TraceInvalide as e:
+        raise HTTPException(422, str(e))
+    verification = traces.verifier(
+        trace, shape, TRACE_COUVERTURE_MIN, TRACE_DUREE_MIN
+    )
+    if verification.confirme and not activite.confirme:
+        await ecrivain().put_activite(activite.model_copy(update={"confirme": True}))
+        LOGGER.info("Activité confirmée par sa trace: %s", id)
+    return verification
+
+
+@apiv1.get("/activites", response_model=List[Activite])
+async def activites(
+    request: Request,
+    user: UUID,
+    limite: Annotated[
+        Union[int, None], Query(ge=1, description="Nombre maximal d'activités")
+    ] = None,
+    apres: Annotated[
+        Union[UUID, None], Query(description="Curseur: activités après celle-ci")
+    ] = None,
+) -> Response:
+    """Obtenir les contributions d'un utilisateur (JSON ou NDJSON)"""
+    return await reponse_paginee(
+        request,
+        lambda apres, limite: list(stockage().activites(user, apres, limite)),
+        apres,
+        limite,
+    )
 
 
 @apiv1.put("/observation", summary="Création/MÀJ observation")
 async def put_observation(obs: Observation) -> Observation:
     """Creer ou mettre a jour une observation"""
     # FIXME: Faut clairement de l'authentification, etc!!!
-    obpath = DATADIR / "observations" / f"{obs.id}.json"
-    obpath.parent.mkdir(parents=True, exist_ok=True)
-    with open(obpath, "wt") as outfh:
-        print(obs.model_dump_json(indent=2), file=outfh)
-    LOGGER.info("Creation/MAJ observation: %s dans %s", obs.id, obpath)
+    await ecrivain().put_observation(sans_photos(obs))
+    LOGGER.info("Creation/MAJ observation: %s", obs.id)
+    # Relue pour retourner les photos déjà associées
+    return await run_in_threadpool(stockage().get_observation, obs.id) or obs
+
+
+@apiv1.put(
+    "/observations",
+    summary="Création/MÀJ en lot",
+    openapi_extra=corps_lot("Observation"),
+)
+async def put_observations(request: Request) -> List[Resultat]:
+    """Creer ou mettre a jour plusieurs observations (tableau JSON ou NDJSON)"""
+    # FIXME: Faut clairement de l'authentification, etc!!!
+    return await ecrire_lot(request, Observation, "observation")
+
+
+@apiv1.put(
+    "/observation/{id}/photo",
+    summary="Ajouter une photo à une observation",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {t: {} for t in medias.FORMATS.values()},
+        }
+    },
+)
+async def put_photo(request: Request, id: UUID) -> Observation:
+    """
+    Ajouter une photo (JPEG, PNG, WebP ou HEIC, en corps de requête) à
+    une observation.  Les photos identiques ne sont conservées qu'une
+    fois.
+    """
+    # FIXME: Faut clairement de l'authentification, etc!!!
+    if await run_in_threadpool(stockage().get_observation, id) is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Observation non trouvée")
+    televersement = await run_in_threadpool(medias.Televersement, DATADIR)
+    try:
+        async for morceau in request.stream():
+            await run_in_threadpool(televersement.ecrire, morceau)
+        nom = await run_in_threadpool(televersement.terminer)
+    except medias.PhotoTropGrande as e:
+        await run_in_threadpool(televersement.annuler)
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, str(e))
+    except medias.PhotoInvalide as e:
+        raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, str(e))
+    except BaseException:
+        await run_in_threadpool(televersement.annuler)
+        raise
+    medias.vignette(DATADIR, nom)
+    # Ajoutée dans une transaction pour ne perdre aucune photo concurrente
+    obs = await run_in_threadpool(stockage().ajouter_photo, id, nom)
+    if obs is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Observation non trouvée")
+    LOGGER.info("Photo %s ajoutée à l'observation %s", nom, id)
     return obs
 
 
-@apiv1.get("/observations")
-async def observations(user: Union[str, None] = None) -> List[Observation]:
-    """Obtenir les observations d'EEE"""
-    # FIXME: Faut clairement une vraie DB!!!
-    obss = []
-    for path in (DATADIR / "observations").iterdir():
-        if path.suffix != ".json":
-            continue
-        with open(path, "rt") as infh:
-            obs = Observation.model_validate_json(infh.read())
-            if user is not None and obs.user != user:
-                continue
-            obss.append(obs)
-    return obss
+@apiv1.get(
+    "/photo/{nom}",
+    summary="Photo d'une observation",
+    response_class=FileResponse,
+    responses={200: {"content": {t: {} for t in medias.FORMATS.values()}}},
+)
+async def get_photo(
+    nom: str,
+    vignette: Annotated[
+        bool, Query(description="Vignette JPEG plutôt que la photo originale")
+    ] = False,
+) -> FileResponse:
+    """
+    Obtenir une photo par son nom.  Son contenu ne change jamais, elle
+    peut donc être gardée en cache indéfiniment.  Les requêtes partielles
+    (`Range`) sont prises en charge.
+    """
+    if not medias.NOM.match(nom):
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Photo non trouvée")
+    path = medias.chemin(DATADIR, nom)
+    if not path.exists():
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Photo non trouvée")
+    media_type = medias.FORMATS[nom.partition(".")[2]]
+    if vignette:
+        apercu = await asyncio.wrap_future(medias.vignette(DATADIR, nom))
+        if apercu is not None:
+            path, media_type = apercu, "image/jpeg"
+    return FileResponse(
+        path, media_type=media_type, headers={"Cache-Control": medias.CACHE_CONTROL}
+    )
+
+
+@apiv1.get("/observations", response_model=List[Observation])
+async def observations(
+    request: Request,
+    user: Union[UUID, None] = None,
+    limite: Annotated[
+        Union[int, None], Query(ge=1, description="Nombre maximal d'observations")
+    ] = None,
+    apres: Annotated[
+        Union[UUID, None], Query(description="Curseur: observations après celle-ci")
+    ] = None,
+) -> Response:
+    """Obtenir les observations d'EEE (JSON ou NDJSON)"""
+    return await reponse_paginee(
+        request,
+        lambda apres, limite: list(stockage().observations(user, apres, limite)),
+        apres,
+        limite,
+    )
+
+
+@apiv1.get(
+    "/observations/{latitude},{longitude}", summary="Observations par emplacement"
+)
+async def observations_wgs84(
+    latitude: float,
+    longitude: float,
+    proximite: Annotated[float, Query(description="Distance maximale en km")] = 10,
+    limite: Annotated[
+        int, Query(description="Nombre maximal d'observations à retourner")
+    ] = 10,
+    code_espece: Annotated[
+        Union[str, None], Query(description="Seulement les observations de cette EEE")
+    ] = None,
+    debut: Annotated[
+        Union[datetime.datetime, None],
+        Query(description="Seulement les observations à partir de cette date"),
+    ] = None,
+    fin: Annotated[
+        Union[datetime.datetime, None],
+        Query(description="Seulement les observations avant cette date"),
+    ] = None,
+) -> List[Tuple[float, Observation]]:
+    """
+    Localiser les observations d'EEE les plus proches
+    """
+    return await run_in_threadpool(
+        stockage().observations_proches,
+        latitude,
+        longitude,
+        proximite,
+        limite,
+        code_espece,
+        debut,
+        fin,
+    )
+
+
+@apiv1.get(
+    "/densites", summary="Densité des observations", response_model=List[Densite]
+)
+async def densites(
+    boite: Annotated[
+        str,
+        Query(
+            description="Limites ouest,sud,est,nord (WGS84)",
+            examples=["-80,44,-57,63"],
+        ),
+    ],
+    z: Annotated[
+        int, Query(ge=0, le=NIVEAU_MAX, description="Niveau des tuiles")
+    ] = 8,
+    code_espece: Annotated[
+        Union[str, None], Query(description="Seulement les observations de cette EEE")
+    ] = None,
+    categorie: Annotated[
+        Union[str, None],
+        Query(description="Seulement les observations de cette catégorie d'EEE"),
+    ] = None,
+    par: Annotated[
+        Union[Literal["espece", "categorie"], None],
+        Query(description="Regrouper par espèce ou par catégorie d'espèces"),
+    ] = None,
+) -> Response:
+    """
+    Nombre d'observations d'EEE par tuile (Web Mercator, identifiées par
+    leur quadkey) au niveau `z` dans une boîte, optionnellement par
+    espèce ou par catégorie.  Les comptes sont tenus à jour à l'écriture
+    des observations.
+    """
+    try:
+        ouest, sud, est, nord = (float(v) for v in boite.split(","))
+    except ValueError:
+        raise HTTPException(422, "Boîte attendue: ouest,sud,est,nord")
+    if not all(math.isfinite(v) for v in (ouest, sud, est, nord)):
+        raise HTTPException(422, "Limites de la boîte non finies")
+    ouest, est = (max(-180.0, min(180.0, v)) for v in (ouest, est))
+    if ouest > est or sud > nord:
+        raise HTTPException(422, "Boîte vide: ouest > est ou sud > nord")
+    codes: Union[List[str], None] = None
+    if categorie is not None:
+        codes = [c for c, cat in CATEGORIE_ESPECE.items() if cat == categorie]
+        if not codes:
+            raise HTTPException(422, f"Catégorie d'EEE inconnue: {categorie}")
+    if code_espece is not None:
+        if codes is None:
+            codes = [code_espece]
+        else:
+            codes = [c for c in codes if c == code_espece]
+    comptes = await run_in_threadpool(
+        stockage().densites, z, (ouest, sud, est, nord), codes
+    )
+    groupes: Dict[Tuple[int, int, str], int] = {}
+    for (_, x, y, code), n in comptes.items():
+        groupe = ""
+        if par == "espece":
+            groupe = code
+        elif par == "categorie":
+            groupe = CATEGORIE_ESPECE.get(code, "")
+        groupes[x, y, groupe] = groupes.get((x, y, groupe), 0) + n
+    return Response(
+        json_liste(
+            Densite(
+                quadkey=tuiles.quadkey(z, x, y),
+                z=z,
+                x=x,
+                y=y,
+                boite=list(tuiles.boite(z, x, y)),
+                code_espece=(groupe or None) if par == "espece" else None,
+                categorie=(groupe or None) if par == "categorie" else None,
+                n=n,
+            )
+            for (x, y, groupe), n in sorted(groupes.items())
+        ),
+        media_type="application/json",
+    )
 
 
 @apiv1.get("/especes")
@@ -242,35 +864,27 @@ async def put_user(
 ) -> Utilisateur:
     """Création d'un utilisateur"""
     # FIXME: Faut clairement de l'authentification, etc!!!
-    userpath = DATADIR / "users" / f"{user.id}.json"
-    userpath.parent.mkdir(parents=True, exist_ok=True)
-    with open(userpath, "wt") as outfh:
-        print(user.model_dump_json(indent=2), file=outfh)
-    LOGGER.info("Creation/MAJ utilisateur: %s dans %s", user, userpath)
+    try:
+        await ecrivain().put_user(user)
+    except NomPris as e:
+        raise HTTPException(status.HTTP_409_CONFLICT, str(e))
+    LOGGER.info("Creation/MAJ utilisateur: %s", user)
     return user
 
 
 @apiv1.get("/userid/{id}", summary="utilisateur par ID")
 async def get_user_id(id: UUID, response: Response) -> Union[Utilisateur, None]:
     """Recherche d'un utilisateur"""
-    userpath = DATADIR / "users" / f"{id}.json"
-    try:
-        with open(userpath, "rt") as infh:
-            return Utilisateur.model_validate_json(infh.read())
-    except FileNotFoundError:
+    user = await run_in_threadpool(stockage().get_user, id)
+    if user is None:
         response.status_code = status.HTTP_404_NOT_FOUND
-        return None
+    return user
 
 
 @apiv1.get("/user/{nom}", summary="utilisateur par nom")
 async def get_user_nom(nom: str, response: Response) -> Union[Utilisateur, None]:
     """Recherche d'un utilisateur"""
-    for path in (DATADIR / "users").iterdir():
-        if path.suffix != ".json":
-            continue
-        with open(path, "rt") as infh:
-            user = Utilisateur.model_validate_json(infh.read())
-            if user.nom == nom:
-                return user
-    response.status_code = status.HTTP_404_NOT_FOUND
-    return None
+    user = await run_in_threadpool(stockage().get_user_nom, nom)
+    if user is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+    return user
@@ -0,0 +1,270 @@
+"""Cache HTTP sur disque pour la construction des données.
+
+Les corps des réponses sont conservés par empreinte SHA-256 dans
+`objets/`, et chaque requête (méthode, URL et données) a une entrée
+dans `requetes/` avec l'empreinte de sa dernière réponse et ses
+validateurs (ETag, Last-Modified).  Une requête en cache est revalidée
+avec `If-None-Match` et `If-Modified-Since`; en mode hors ligne, elle
+est rejouée sans réseau et une requête absente du cache donne 504 (comme
+`Cache-Control: only-if-cached`).
+
+Les corps sont écrits sur disque au fur et à mesure de leur
+réception.  Le nombre de requêtes simultanées et leur cadence sont
+limités par hôte (voir `LIMITES`), et les échecs temporaires (429, 5xx,
+erreurs de réseau) sont réessayés avec un délai croissant.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, NamedTuple, Tuple, Union
+
+import httpx
+
+LOGGER = logging.getLogger("points-air-cache")
+TAILLE_BLOC = 64 * 1024
+# Nombre d'essais et délai initial (secondes) pour les échecs temporaires
+ESSAIS = 5
+DELAI = 1.0
+DELAI_MAX = 60.0
+STATUTS_TEMPORAIRES = {429, 500, 502, 503, 504}
+
+
+class Limite(NamedTuple):
+    """Requêtes simultanées et intervalle minimal (secondes) pour un hôte"""
+
+    simultanees: int
+    intervalle: float = 0.0
+
+
+# Politiques d'usage de Nominatim (1 requête/s) et d'Overpass (2 créneaux)
+LIMITES = {
+    "nominatim.openstreetmap.org": Limite(1, 1.0),
+    "overpass-api.de": Limite(2),
+}
+LIMITE_DEFAUT = Limite(4)
+
+
+def empreinte(contenu: bytes) -> str:
+    """Empreinte SHA-256 d'un contenu"""
+    return hashlib.sha256(contenu).hexdigest()
+
+
+class Limiteur:
+    """Limite de requêtes simultanées et de cadence pour un hôte"""
+
+    def __init__(self, limite: Limite):
+        self.limite = limite
+        self.semaphore = asyncio.Semaphore(limite.simultanees)
+        self.verrou = asyncio.Lock()
+        self.prochaine = 0.0
+
+    async def __aenter__(self) -> None:
+        await self.semaphore.acquire()
+        if self.limite.intervalle:
+            async with self.verrou:
+                attente = self.prochaine - time.monotonic()
+                if attente > 0:
+                    await asyncio.sleep(attente)
+                self.prochaine = time.monotonic() + self.limite.intervalle
+
+    async def __aexit__(self, *exc: Any) -> None:
+        self.semaphore.release()
+
+
+def delai(essai: int, r: Union[httpx.Response, None]) -> float:
+    """Délai avant de réessayer (Retry-After si donné)"""
+    if r is not None:
+        try:
+            return min(float(r.headers["Retry-After"]), DELAI_MAX)
+        except (KeyError, ValueError):
+            pass
+    return min(DELAI * 2**essai, DELAI_MAX)
+
+
+class CacheHTTP:
+    """Client HTTP avec cache sur disque"""
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        repertoire: Path = Path("cache"),
+        hors_ligne: bool = False,
+    ):
+        self.client = client
+        self.repertoire = repertoire
+        self.hors_ligne = hors_ligne
+        self.limiteurs: Dict[str, Limiteur] = {}
+
+    def cle(self, methode: str, url: str, data: Union[Dict[str, Any], None]) -> str:
+        """Clé d'une requête"""
+        return empreinte(
+            json.dumps([methode, url, data], sort_keys=True).encode("utf-8")
+        )
+
+    def path_objet(self, sha: str) -> Path:
+        return self.repertoire / "objets" / sha[:2] / sha
+
+    def path_requete(self, cle: str) -> Path:
+        return self.repertoire / "requetes" / f"{cle}.json"
+
+    def ecrire(self, path: Path, contenu: bytes) -> None:
+        """Écrire un fichier du cache atomiquement"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = path.with_name(f".{path.name}.tmp")
+        with open(tmppath, "wb") as outfh:
+            outfh.write(contenu)
+        os.replace(tmppath, path)
+
+    def lire(self, cle: str) -> Union[Dict[str, Any], None]:
+        """Lire une entrée de requête (si son objet existe toujours)"""
+        try:
+            with open(self.path_requete(cle), "rt") as infh:
+                entree = json.load(infh)
+        except FileNotFoundError:
+            return None
+        if not self.path_objet(entree["sha256"]).exists():
+            return None
+        return entree
+
+    def limiteur(self, url: str) -> Limiteur:
+        """Limiteur de l'hôte d'une URL"""
+        hote = httpx.URL(url).host
+        if hote not in self.limiteurs:
+            self.limiteurs[hote] = Limiteur(LIMITES.get(hote, LIMITE_DEFAUT))
+        return self.limiteurs[hote]
+
+    async def recevoir(self, r: httpx.Response) -> str:
+        """Écrire un corps dans les objets au fur et à mesure, et son empreinte"""
+        tmpdir = self.repertoire / "objets"
+        tmpdir.mkdir(parents=True, exist_ok=True)
+        tmppath = tmpdir / f".{os.getpid()}.{id(r)}.tmp"
+        sha = hashlib.sha256()
+        try:
+            with open(tmppath, "wb") as outfh:
+                async for bloc in r.aiter_bytes(TAILLE_BLOC):
+                    sha.update(bloc)
+                    outfh.write(bloc)
+            path = self.path_objet(sha.hexdigest())
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmppath, path)
+        finally:
+            tmppath.unlink(missing_ok=True)
+        return sha.hexdigest()
+
+    async def envoyer(
+        self, request: httpx.Request, entree: Union[Dict[str, Any], None]
+    ) -> Tuple[int, Union[Dict[str, str], None], Union[str, None]]:
+        """
+        Envoyer une requête (avec réessais) et recevoir son corps s'il est
+        nouveau: (statut, validateurs, empreinte).
+        """
+        r = None
+        for essai in range(ESSAIS):
+            if essai:
+                attente = delai(essai - 1, r)
+                LOGGER.warning(
+                    "Réessai %d de %s %s dans %.1fs",
+                    essai,
+                    request.method,
+                    request.url,
+                    attente,
+                )
+                await asyncio.sleep(attente)
+            try:
+                async with self.limiteur(str(request.url)):
+                    r = await self.client.send(
+                        request, stream=True, follow_redirects=True
+                    )
+                    try:
+                        if r.status_code == 304 and entree is not None:
+                            return 304, None, entree["sha256"]
+                        if r.status_code != 200:
+                            if r.status_code in STATUTS_TEMPORAIRES:
+                                continue
+                            return r.status_code, None, None
+                        validateurs = {
+                            "etag": r.headers.get("ETag"),
+                            "last_modified": r.headers.get("Last-Modified"),
+                        }
+                        return 200, validateurs, await self.recevoir(r)
+                    finally:
+                        await r.aclose()
+            except httpx.TransportError as e:
+                LOGGER.warning("Échec de %s %s: %s", request.method, request.url, e)
+                r = None
+                if essai == ESSAIS - 1:
+                    raise
+        assert r is not None
+        return r.status_code, None, None
+
+    async def obtenir(
+        self, methode: str, url: str, data: Union[Dict[str, Any], None] = None
+    ) -> Tuple[int, Union[str, None], httpx.Request]:
+        """Lancer une requête en passant par le cache: (statut, empreinte)"""
+        cle = self.cle(methode, url, data)
+        entree = self.lire(cle)
+        request = self.client.build_request(methode, url, data=data)
+        if self.hors_ligne:
+            if entree is None:
+                LOGGER.warning("Absent du cache (hors ligne): %s %s", methode, url)
+                return 504, None, request
+            return 200, entree["sha256"], request
+        if entree is not None:
+            if entree.get("etag"):
+                request.headers["If-None-Match"] = entree["etag"]
+            if entree.get("last_modified"):
+                request.headers["If-Modified-Since"] = entree["last_modified"]
+        try:
+            statut, validateurs, sha = await self.envoyer(request, entree)
+        except httpx.HTTPError as e:
+            if entree is None:
+                raise
+            LOGGER.warning("Échec de %s %s (%s), réponse en cache", methode, url, e)
+            return 200, entree["sha256"], request
+        if statut == 304:
+            LOGGER.info("Inchangé: %s %s", methode, url)
+            return 200, sha, request
+        if statut != 200 or sha is None:
+            if entree is not None and statut in STATUTS_TEMPORAIRES:
+                LOGGER.warning(
+                    "Erreur %d pour %s %s, réponse en cache", statut, methode, url
+                )
+                return 200, entree["sha256"], request
+            return statut, None, request
+        entree = {"methode": methode, "url": url, "data": data, "sha256": sha}
+        entree.update(validateurs or {})
+        self.ecrire(self.path_requete(cle), json.dumps(entree, indent=2).encode())
+        return 200, sha, request
+
+    async def requete(
+        self, methode: str, url: str, data: Union[Dict[str, Any], None] = None
+    ) -> httpx.Response:
+        """Lancer une requête et lire sa réponse en mémoire"""
+        statut, sha, request = await self.obtenir(methode, url, data)
+        if sha is None:
+            return httpx.Response(statut, request=request)
+        with open(self.path_objet(sha), "rb") as infh:
+            return httpx.Response(statut, content=infh.read(), request=request)
+
+    async def get(self, url: str) -> httpx.Response:
+        return await self.requete("GET", url)
+
+    async def post(self, url: str, data: Dict[str, Any]) -> httpx.Response:
+        return await self.requete("POST", url, data)
+
+    async def telecharger(self, url: str, path: Path) -> bool:
+        """Télécharger une ressource dans un fichier sans la lire en mémoire"""
+        statut, sha, _ = await self.obtenir("GET", url)
+        if sha is None:
+            LOGGER.error("Échec de téléchargement de %s: %d", url, statut)
+            return False
+        tmppath = path.with_name(f".{path.name}.tmp")
+        shutil.copyfile(self.path_objet(sha), tmppath)
+        os.replace(tmppath, path)
+        return True
@@ -6,33 +6,46 @@ import asyncio
 import json
 import logging
 import urllib
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, Union, List
+from typing import Dict, List, Tuple, Union
 
+import numpy as np
 import osm2geojson  # type: ignore
 import shapely  # type: ignore
-from httpx import AsyncClient
+from httpx import AsyncClient, Limits, Timeout
 from pydantic_geojson import (  # type: ignore
     FeatureCollectionModel,
     FeatureModel,
     PointModel,
 )
 
+from .__about__ import __version__
+from . import plateaux as plateaux_module
+from . import villes as villes_module
+from .cache import CacheHTTP, empreinte
 from .plateaux import Plateau, PlateauCollection
 from .villes import Ville, VilleCollection
 
-CLIENT = AsyncClient()
+CLIENT = AsyncClient(
+    headers={"User-Agent": f"points-air/{__version__}"},
+    limits=Limits(max_connections=16, max_keepalive_connections=8),
+    timeout=Timeout(60.0, connect=10.0),
+)
+CACHE = CacheHTTP(CLIENT)
 LOGGER = logging.getLogger("points-air-data")
 ICHERCHE = "https://geoegl.msp.gouv.qc.ca/apis/icherche"
 DQURL = "https://www.donneesquebec.ca/recherche/api/3/action"
 NOMINATIM = "https://nominatim.openstreetmap.org/search"
 OVERPASS = "https://overpass-api.de/api/interpreter"
 THISDIR = Path(__file__).parent
+# À incrémenter lorsque plateaux_ville change, pour tout retraiter
+VERSION_PLATEAUX = 1
 
 
 async def overpass_query(query: str) -> Union[Dict, None]:
     """Lancer une requête sur Overpass"""
-    r = await CLIENT.post(OVERPASS, data={"data": query})
+    r = await CACHE.post(OVERPASS, data={"data": query})
     if r.status_code != 200:
         return None
     return r.json()
@@ -44,7 +57,7 @@ async def nominatim_query(**kwargs) -> Union[Dict, None]:
     # support pas properties) .. faudrait utiliser l'autre geojson_pydantic
     params = urllib.parse.urlencode({**kwargs, "format": "jsonv2"})
     url = f"{NOMINATIM}?{params}"
-    r = await CLIENT.get(url, follow_redirects=True)
+    r = await CACHE.get(url)
     if r.status_code != 200:
         return None
     return r.json()
@@ -54,7 +67,7 @@ async def icherche_query(action: str, **kwargs) -> Union[FeatureCollectionModel,
     """Lancer une requête sur iCherche"""
     params = urllib.parse.urlencode(kwargs)
     url = f"{ICHERCHE}/{action}?{params}"
-    r = await CLIENT.get(url)
+    r = await CACHE.get(url)
     if r.status_code != 200:
         return None
     return FeatureCollectionModel.model_validate_json(r.text)
@@ -64,7 +77,7 @@ async def dq_query(action: str, **kwargs) -> Union[Dict, None]:
     """Lancer une requête sur Données Québec"""
     params = urllib.parse.urlencode(kwargs)
     url = f"{DQURL}/{action}?{params}"
-    r = await CLIENT.get(url)
+    r = await CACHE.get(url)
     if r.status_code != 200:
         return None
     return r.json()
@@ -116,25 +129,24 @@ async def ville_organization(ville: str) -> Union[Dict, None]:
     return villes["result"][0]
 
 
-async def ville_parcs(ville: Ville) -> Union[Dict, None]:
-    """Trouver le GeoJSON des parcs pour une ville."""
+async def ville_parcs(ville: Ville) -> bool:
+    """Télécharger le GeoJSON des parcs pour une ville."""
     result = await dq_query(
         "package_search", q=f"(organization:{ville.id} AND title:parcs)"
     )
     if result is None:
-        return None
+        return False
     if result["result"]["count"] == 0:
-        return None
+        return False
     dataset = result["result"]["results"][0]
     LOGGER.info("Parcs trouvés pour %s: %s", ville.id, dataset["title"])
     for resource in dataset["resources"]:
         if resource["format"] == "GeoJSON":
             LOGGER.info("GeoJSON trouvé pour %s: %s", dataset["title"], resource["url"])
-            r = await CLIENT.get(resource["url"])
-            if r.status_code != 200:
-                return None
-            return r.json()
-    return None
+            return await CACHE.telecharger(
+                resource["url"], THISDIR / f"{ville.id}_parcs.json"
+            )
+    return False
 
 
 async def ville_sentiers(ville: Ville) -> Union[Dict, None]:
@@ -156,49 +168,41 @@ out geom;
     return osm2geojson.json2geojson(data)
 
 
-async def find_plateaux(ville: Ville) -> List[Plateau]:
-    """Chercher des plateaux d'activité extérieure pour une ville."""
-    with open(THISDIR / f"{ville.id}_sentiers.json", "rt") as infh:
-        fc = FeatureCollectionModel.model_validate_json(infh.read())
-    # NOTE: Could use geopandas
-    sentiers = []
-    for f in fc.features:
-        shape = shapely.geometry.shape(f.geometry.model_dump())
-        shapely.prepare(shape)
-        sentiers.append(shape)
-    LOGGER.info("%s: %d sentiers trouvés", ville.id, len(sentiers))
-    with open(THISDIR / f"{ville.id}_parcs.json", "rt") as infh:
+def lire_features(path: Path) -> Tuple[List[Dict], np.ndarray]:
+    """Lire les features d'un fichier GeoJSON et leurs géométries (en 2D)"""
+    with open(path, "rt") as infh:
         # FIXME: Must preserve properties because pydantic_geojson
-        parcs_fc = json.load(infh)
-    parcs = []
-    for f in parcs_fc["features"]:
-        shape = shapely.geometry.shape(f["geometry"])
-        shapely.prepare(shape)
-        parcs.append((shape, f))
-    LOGGER.info("%s: %d parcs trouvés", ville.id, len(parcs))
-    # NOTE: Could use Spatial SQL
-    parcs_sentiers = []
-    for shape, parc in parcs:
-        found = False
-        for s in sentiers:
-            if shape.contains(s):
-                found = True
-                break
-        if found:
-            parcs_sentiers.append((shape, parc))
-    LOGGER.info("%s: %d parcs avec sentiers", ville.id, len(parcs_sentiers))
+        fc = json.load(infh)
+    features = [f for f in fc["features"] if f.get("geometry")]
+    shapes = np.array(
+        [shapely.geometry.shape(f["geometry"]) for f in features], dtype=object
+    )
+    return features, shapely.force_2d(shapes)
+
+
+def plateaux_ville(ville: str) -> List[Plateau]:
+    """Chercher les plateaux d'une ville: les parcs contenant un sentier."""
+    _, sentiers = lire_features(THISDIR / f"{ville}_sentiers.json")
+    LOGGER.info("%s: %d sentiers trouvés", ville, len(sentiers))
+    parcs, shapes = lire_features(THISDIR / f"{ville}_parcs.json")
+    LOGGER.info("%s: %d parcs trouvés", ville, len(parcs))
+    # Jointure spatiale: (parc, sentier) pour chaque sentier dans un parc
+    idx, _ = shapely.STRtree(sentiers).query(shapes, predicate="contains")
+    avec_sentiers = np.unique(idx)
+    LOGGER.info("%s: %d parcs avec sentiers", ville, len(avec_sentiers))
     plateaux = []
-    for shape, parc in parcs_sentiers:
+    for i in avec_sentiers:
+        shape, parc = shapes[i], parcs[i]
         props = parc["properties"]
         nom = props.get("NOM", "INCONNU")
-        print(props)
+        LOGGER.debug("%s: %s", ville, props)
         if "LONGITUDE" in props:
             centroide = (props["LONGITUDE"], props["LATITUDE"])
         else:
             centroide = (shape.centroid.x, shape.centroid.y)
         # FIXME: ça urge de remplacer pydantic_geojson qui est mauvais
         parc["geometry"] = json.loads(shapely.to_geojson(shape))
-        p = Plateau(ville=ville.id,
+        p = Plateau(ville=ville,
                     nom=nom,
                     saison="QuatreSaisons",
                     sports=["Marche", "Vélo"],
@@ -208,6 +212,29 @@ async def find_plateaux(ville: Ville) -> List[Plateau]:
     return plateaux
 
 
+async def ecrire_sentiers(ville: Ville) -> bool:
+    """Écrire le GeoJSON des sentiers pour une ville."""
+    sentiers = await ville_sentiers(ville)
+    if sentiers is None:
+        return False
+    path = THISDIR / f"{ville.id}_sentiers.json"
+    tmppath = path.with_name(f".{path.name}.tmp")
+    with open(tmppath, "wt") as outfh:
+        json.dump(sentiers, outfh)
+    tmppath.replace(path)
+    return True
+
+
+async def find_plateaux(
+    ville: Ville, pool: Union[Executor, None] = None
+) -> List[Plateau]:
+    """Chercher des plateaux d'activité extérieure pour une ville."""
+    if pool is None:
+        return plateaux_ville(ville.id)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, plateaux_ville, ville.id)
+
+
 async def find_ville(nom: str) -> Union[Ville, None]:
     """Obtenir informations pour une ville des API iCherche et DQ."""
     (org, overpass, feature) = await asyncio.gather(
@@ -236,25 +263,92 @@ async def async_main(args: argparse.Namespace):
     """Fonction principale async."""
     v = await asyncio.gather(*(find_ville(nom) for nom in args.villes))
     villes = VilleCollection({ville.id: ville for ville in v if ville is not None})
+    if not villes.root:
+        LOGGER.error("Aucune ville trouvée, données inchangées")
+        return
     with open(THISDIR / "villes.json", "wt") as outfh:
         print(villes.model_dump_json(indent=2), file=outfh)
     # Obtenir GeoJSON des parcs et sentiers pour les villes pour test (temporaire)
-    sentiers, parcs = await asyncio.gather(
-        asyncio.gather(*(ville_sentiers(v) for v in villes.root.values())),
+    await asyncio.gather(
+        asyncio.gather(*(ecrire_sentiers(v) for v in villes.root.values())),
         asyncio.gather(*(ville_parcs(v) for v in villes.root.values())),
     )
-    vp = {}
-    for ville, vsentiers, vparcs in zip(villes.root.values(), sentiers, parcs):
-        if ville is None:
-            continue
-        with open(THISDIR / f"{ville.id}_sentiers.json", "wt") as outfh:
-            json.dump(vsentiers, outfh, indent=2)
-        with open(THISDIR / f"{ville.id}_parcs.json", "wt") as outfh:
-            json.dump(vparcs, outfh, indent=2)
-        vp[ville.id] = await find_plateaux(ville)
-    plateaux = PlateauCollection(vp)
+    for ville in list(villes.root):
+        if not all(
+            (THISDIR / f"{ville}_{suffixe}.json").exists()
+            for suffixe in ("sentiers", "parcs")
+        ):
+            LOGGER.error("Parcs ou sentiers manquants pour %s, ville ignorée", ville)
+            del villes.root[ville]
+    # Retraiter seulement les villes dont les parcs ou sentiers ont changé
+    manifeste = lire_manifeste()
+    entrees = {ville: empreinte_entrees(ville) for ville in villes.root}
+    anciens = lire_plateaux() if manifeste else {}
+    vp = {
+        ville: anciens[ville]
+        for ville, e in entrees.items()
+        if manifeste.get(ville) == e and ville in anciens
+    }
+    modifiees = [v for v in villes.root.values() if v.id not in vp]
+    LOGGER.info("Villes à retraiter: %s", [v.id for v in modifiees])
+    if args.processus > 1:
+        with ProcessPoolExecutor(args.processus) as pool:
+            resultats = await asyncio.gather(
+                *(find_plateaux(v, pool) for v in modifiees)
+            )
+    else:
+        resultats = [await find_plateaux(v) for v in modifiees]
+    vp.update((v.id, r) for v, r in zip(modifiees, resultats))
+    plateaux = PlateauCollection({ville: vp[ville] for ville in villes.root})
     with open(THISDIR / "plateaux.json", "wt") as outfh:
         print(plateaux.model_dump_json(indent=2), file=outfh)
+    ecrire_manifeste(entrees)
+    ecrire_instantanes()
+
+
+def empreinte_entrees(ville: str) -> str:
+    """Empreinte des parcs et sentiers d'une ville"""
+    contenu = str(VERSION_PLATEAUX).encode()
+    for suffixe in "sentiers", "parcs":
+        with open(THISDIR / f"{ville}_{suffixe}.json", "rb") as infh:
+            contenu += empreinte(infh.read()).encode()
+    return empreinte(contenu)
+
+
+def lire_manifeste() -> Dict[str, str]:
+    """Lire les empreintes des entrées de la dernière construction"""
+    try:
+        with open(CACHE.repertoire / "manifeste.json", "rt") as infh:
+            return json.load(infh)
+    except FileNotFoundError:
+        return {}
+
+
+def ecrire_manifeste(entrees: Dict[str, str]) -> None:
+    """Sauvegarder les empreintes des entrées"""
+    CACHE.ecrire(
+        CACHE.repertoire / "manifeste.json", json.dumps(entrees, indent=2).encode()
+    )
+
+
+def lire_plateaux() -> Dict[str, List[Plateau]]:
+    """Lire les plateaux de la dernière construction"""
+    try:
+        with open(THISDIR / "plateaux.json", "rt") as infh:
+            return PlateauCollection.model_validate_json(infh.read()).root
+    except FileNotFoundError:
+        return {}
+
+
+def ecrire_instantanes():
+    """Construire les instantanés binaires de villes.json et plateaux.json"""
+    villes_module.ecrire_instantane()
+    plateaux_module.ecrire_instantane()
+    LOGGER.info(
+        "Instantanés écrits: %s %s",
+        villes_module.INSTANTANE,
+        plateaux_module.INSTANTANE,
+    )
 
 
 def main():
@@ -266,9 +360,34 @@ def main():
     parser.add_argument(
         "-v", "--verbose", help="Informations verboses pour debug", action="store_true"
     )
+    parser.add_argument(
+        "-j",
+        "--processus",
+        help="Nombre de processus pour chercher les plateaux des villes",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--cache", help="Répertoire du cache HTTP", type=Path, default=CACHE.repertoire
+    )
+    parser.add_argument(
+        "--hors-ligne",
+        help="Rejouer les réponses du cache sans réseau",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--instantanes",
+        help="Seulement reconstruire les instantanés binaires (sans réseau)",
+        action="store_true",
+    )
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
-    asyncio.run(async_main(args))
+    CACHE.repertoire = args.cache
+    CACHE.hors_ligne = args.hors_ligne
+    if args.instantanes:
+        ecrire_instantanes()
+    else:
+        asyncio.run(async_main(args))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+"""Écritures groupées hors de la boucle d'événements.
+
+Les gestionnaires de requêtes soumettent leurs écritures à un
+`Ecrivain`, qui les exécute dans un fil dédié.  Toutes les écritures en
+attente au moment où le fil se libère sont faites en un seul lot (une
+transaction SQLite, ou une synchronisation par répertoire pour les
+fichiers), et chaque requête n'est complétée qu'une fois son lot
+durable.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Sequence, Union
+
+from .especes import Observation
+from .stockage import Stockage
+from .user import Activite, Utilisateur
+
+LOGGER = logging.getLogger("points-air-ecrivain")
+# Nombre maximal d'écritures dans un lot
+TAILLE_LOT = 1000
+
+
+class Ecriture(NamedTuple):
+    """Écriture en attente et la requête qui l'attend"""
+
+    genre: str
+    enregistrement: Any
+    loop: asyncio.AbstractEventLoop
+    future: "asyncio.Future[None]"
+
+
+def completer(ecriture: Ecriture, erreur: Union[BaseException, None]) -> None:
+    """Compléter la requête en attente (dans sa boucle d'événements)"""
+
+    def resoudre() -> None:
+        if ecriture.future.done():
+            return  # Requête annulée
+        if erreur is None:
+            ecriture.future.set_result(None)
+        else:
+            ecriture.future.set_exception(erreur)
+
+    ecriture.loop.call_soon_threadsafe(resoudre)
+
+
+class Ecrivain:
+    """Fil d'écriture pour un stockage"""
+
+    def __init__(self, stockage: Stockage):
+        self.stockage = stockage
+        self.queue: "queue.Queue[Union[List[Ecriture], None]]" = queue.Queue()
+        self.lots: Dict[str, Callable[[List[Any]], None]] = {
+            "activite": stockage.put_activites,
+            "observation": stockage.put_observations,
+        }
+        self.thread = threading.Thread(
+            target=self.boucle, name="points-air-ecrivain", daemon=True
+        )
+        self.thread.start()
+
+    async def ecrire(self, genre: str, enregistrement: Any) -> None:
+        """Soumettre une écriture et attendre qu'elle soit durable"""
+        (erreur,) = await self.ecrire_lot(genre, [enregistrement])
+        if erreur is not None:
+            raise erreur
+
+    async def ecrire_lot(
+        self, genre: str, enregistrements: Sequence[Any]
+    ) -> List[Union[BaseException, None]]:
+        """
+        Soumettre plusieurs écritures, faites dans le même lot, et
+        retourner l'erreur (ou None) de chacune une fois durables.
+        """
+        loop = asyncio.get_running_loop()
+        ecritures = [
+            Ecriture(genre, e, loop, loop.create_future()) for e in enregistrements
+        ]
+        if not ecritures:
+            return []
+        self.queue.put(ecritures)
+        return await asyncio.gather(
+            *(e.future for e in ecritures), return_exceptions=True
+        )
+
+    async def put_activite(self, activite: Activite) -> None:
+        await self.ecrire("activite", activite)
+
+    async def put_observation(self, obs: Observation) -> None:
+        await self.ecrire("observation", obs)
+
+    async def put_user(self, user: Utilisateur) -> None:
+        await self.ecrire("user", user)
+
+    def boucle(self) -> None:
+        """Exécuter les écritures par lots jusqu'à la fermeture"""
+        while True:
+            ecritures = self.queue.get()
+            if ecritures is None:
+                return
+            lot = list(ecritures)
+            fin = False
+            while len(lot) < TAILLE_LOT:
+                try:
+                    ecritures = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if ecritures is None:
+                    fin = True
+                    break
+                lot.extend(ecritures)
+            self.executer(lot)
+            if fin:
+                return
+
+    def executer(self, lot: List[Ecriture]) -> None:
+        """Écrire un lot, un genre d'enregistrement à la fois"""
+        genres: Dict[str, List[Ecriture]] = {}
+        for ecriture in lot:
+            genres.setdefault(ecriture.genre, []).append(ecriture)
+        for genre, ecritures in genres.items():
+            ecrire_lot = self.lots.get(genre)
+            if ecrire_lot is not None and len(ecritures) > 1:
+                try:
+                    ecrire_lot([e.enregistrement for e in ecritures])
+                except Exception:
+                    LOGGER.exception("Échec d'un lot de %d %ss", len(ecritures), genre)
+                else:
+                    for e in ecritures:
+                        completer(e, None)
+                    continue
+            # Une à la fois (utilisateurs, ou reprise après un échec du lot)
+            for e in ecritures:
+                try:
+                    getattr(self.stockage, f"put_{genre}")(e.enregistrement)
+                except Exception as erreur:
+                    completer(e, erreur)
+                else:
+                    completer(e, None)
+
+    def close(self) -> None:
+        """Terminer les écritures en attente et arrêter le fil"""
+        self.queue.put(None)
+        self.thread.join()
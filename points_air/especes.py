@@ -1,9 +1,10 @@
 import csv
 import datetime
 from pathlib import Path
-from uuid import UUID
+from typing import List
+from uuid import UUID, uuid4
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from pydantic_geojson import PointModel  # type: ignore
 
 THISDIR = Path(__file__).parent
@@ -16,10 +17,18 @@ CATEGORIES = {
 
 
 class Observation(BaseModel):
+    id: UUID = Field(
+        default_factory=uuid4, description="Identificateur unique pour cette observation"
+    )
     user: UUID
     date: datetime.datetime
     code_espece: str
     emplacement: PointModel
+    photos: List[str] = Field(
+        default_factory=list,
+        description="Noms des photos (empreinte SHA-256 et format), voir /photo/{nom};"
+        " ajoutées par PUT /observation/{id}/photo, ignorées autrement",
+    )
 
 
 class Espece(BaseModel):
@@ -37,3 +46,5 @@ with open(THISDIR / "sentinelle_liste_sp.csv", "rt") as infh:
     rows = (r for r in csv.DictReader(infh) if r["Categorie"] in CATEGORIES)
     for row in rows:
         ESPECES.append(Espece(**{k.lower(): v for k, v in row.items()}))
+# Catégorie de chaque espèce
+CATEGORIE_ESPECE = {espece.code_espece: espece.categorie for espece in ESPECES}
@@ -0,0 +1,182 @@
+"""Registre versionné des données géographiques.
+
+Les villes et les plateaux (fiches, géométries et index) forment une
+version immuable.  Une nouvelle version est construite en arrière-plan
+à partir de `villes.json` et `plateaux.json` (sur demande ou lorsque
+`Surveillant` les voit changer) puis publiée d'un seul coup.  Chaque
+requête est épinglée à la version courante à son arrivée (`Epinglage`)
+et la garde jusqu'à la fin, même si une autre est publiée entretemps.
+"""
+
+import contextvars
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+LOGGER = logging.getLogger("points-air-geodonnees")
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class Version(NamedTuple):
+    """Une version publiée des données, par module"""
+
+    numero: int
+    donnees: Dict[str, Any]
+
+
+COURANTE = Version(0, {})
+EPINGLEE: "contextvars.ContextVar[Union[Version, None]]" = contextvars.ContextVar(
+    "geodonnees", default=None
+)
+# Une seule publication et un seul rechargement à la fois
+PUBLICATION = threading.Lock()
+RECHARGEMENT = threading.Lock()
+
+
+def actuelle() -> Version:
+    """Version épinglée par la requête courante, sinon la plus récente"""
+    return EPINGLEE.get() or COURANTE
+
+
+def donnees(nom: str) -> Any:
+    """Données d'un module dans la version actuelle"""
+    return actuelle().donnees[nom]
+
+
+def publier(**donnees: Any) -> Version:
+    """Publier une nouvelle version remplaçant les données de certains modules"""
+    global COURANTE
+    with PUBLICATION:
+        COURANTE = Version(COURANTE.numero + 1, {**COURANTE.donnees, **donnees})
+    return COURANTE
+
+
+@contextmanager
+def epingler(version: Union[Version, None] = None) -> Iterator[Version]:
+    """Épingler une version (la courante par défaut) dans ce contexte"""
+    version = version or COURANTE
+    jeton = EPINGLEE.set(version)
+    try:
+        yield version
+    finally:
+        EPINGLEE.reset(jeton)
+
+
+def sources() -> List[Path]:
+    """Fichiers à partir desquels les données sont construites"""
+    from . import plateaux, villes
+
+    return [villes.SOURCE, villes.INSTANTANE, plateaux.SOURCE, plateaux.INSTANTANE]
+
+
+def recharger() -> Version:
+    """Reconstruire les villes et les plateaux et publier la nouvelle version"""
+    from . import plateaux, villes
+
+    with RECHARGEMENT:
+        LOGGER.info("Rechargement des données géographiques")
+        nouvelles = {"villes": villes.charger(), "plateaux": plateaux.charger()}
+        version = publier(**nouvelles)
+    LOGGER.info("Données géographiques version %d publiées", version.numero)
+    return version
+
+
+class Vue(Mapping[K, V]):
+    """Dictionnaire d'un module dans la version actuelle"""
+
+    def __init__(self, nom: str, champ: Callable[[Any], Mapping[K, V]]):
+        self.nom = nom
+        self.champ = champ
+
+    def actuel(self) -> Mapping[K, V]:
+        return self.champ(donnees(self.nom))
+
+    def __getitem__(self, cle: K) -> V:
+        return self.actuel()[cle]
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(self.actuel())
+
+    def __len__(self) -> int:
+        return len(self.actuel())
+
+    def __contains__(self, cle: object) -> bool:
+        return cle in self.actuel()
+
+
+class Epinglage:
+    """Middleware ASGI épinglant chaque requête à la version courante"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        with epingler():
+            await self.app(scope, receive, send)
+
+
+def etat(paths: Sequence[Path]) -> Tuple[Tuple[int, int], ...]:
+    """Dernière modification et taille de fichiers (0 s'ils sont absents)"""
+    resultat = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            resultat.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            resultat.append((0, 0))
+    return tuple(resultat)
+
+
+class Surveillant:
+    """
+    Fil d'exécution qui recharge les données lorsque leurs fichiers
+    changent.  Un changement n'est pris en compte qu'une fois les
+    fichiers stables pendant un intervalle, pour ne pas recharger au
+    milieu d'une reconstruction.
+    """
+
+    def __init__(self, intervalle: float, paths: Union[Sequence[Path], None] = None):
+        self.paths = sources() if paths is None else paths
+        self.intervalle = intervalle
+        self.charge = etat(self.paths)
+        self.arret = threading.Event()
+        self.thread = threading.Thread(
+            target=self.boucle, name="geodonnees", daemon=True
+        )
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def boucle(self) -> None:
+        charge = precedent = self.charge
+        while not self.arret.wait(self.intervalle):
+            courant = etat(self.paths)
+            if courant != charge and courant == precedent:
+                try:
+                    recharger()
+                except Exception:
+                    LOGGER.exception("Échec du rechargement, version conservée")
+                charge = courant  # Sinon attendre le prochain changement
+            precedent = courant
+
+    def close(self) -> None:
+        self.arret.set()
+        self.thread.join()
@@ -0,0 +1,197 @@
+"""Instantanés binaires des données géographiques.
+
+Un instantané contient les attributs des villes ou des plateaux (en
+JSON, avec l'index de leur clé dans la collection d'origine), leurs
+géométries en WKB et leurs centroïdes, afin d'éviter d'analyser
+`villes.json` et `plateaux.json` avec pydantic au démarrage.  Les
+tableaux sont projetés en mémoire (mmap) à la lecture.
+
+Format: `MAGIC`, longueur de l'en-tête (uint64 little-endian), en-tête
+JSON, puis les tableaux alignés sur 8 octets.
+"""
+
+import hashlib
+import json
+import mmap
+import struct
+import weakref
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Sequence,
+    TypeVar,
+)
+
+import numpy as np
+import shapely  # type: ignore
+from pydantic_geojson import FeatureModel  # type: ignore
+
+MAGIC = b"PAIRGEO1"
+ALIGNEMENT = 8
+K = TypeVar("K")
+F = TypeVar("F")
+V = TypeVar("V")
+
+
+class Instantane(NamedTuple):
+    """Contenu d'un instantané"""
+
+    source: str
+    cles: List[str]
+    groupes: List[int]
+    attributs: List[Dict[str, Any]]
+    geometries: np.ndarray
+    centroides: np.ndarray
+
+
+def empreinte(path: Path) -> str:
+    """Empreinte SHA-256 d'un fichier source"""
+    with open(path, "rb") as infh:
+        return hashlib.sha256(infh.read()).hexdigest()
+
+
+def feature(geometrie: shapely.Geometry) -> FeatureModel:
+    """Reconstruire un feature GeoJSON à partir d'une géométrie"""
+    return FeatureModel.model_validate_json(
+        '{"type":"Feature","geometry":%s}' % shapely.to_geojson(geometrie)
+    )
+
+
+def centroides(geometries: np.ndarray) -> np.ndarray:
+    """Centroïdes (longitude, latitude) des géométries, NaN si manquantes"""
+    presentes = ~shapely.is_missing(geometries)
+    tout = np.full((len(geometries), 2), np.nan)
+    tout[presentes] = shapely.get_coordinates(
+        shapely.centroid(geometries[presentes]), include_z=False
+    )
+    return tout
+
+
+def ecrire(
+    path: Path,
+    source: str,
+    cles: Sequence[str],
+    groupes: Sequence[int],
+    attributs: Sequence[Dict[str, Any]],
+    geometries: np.ndarray,
+) -> None:
+    """Écrire un instantané (géométries dans un tableau d'objets, ou None)"""
+    blobs = [b"" if b is None else b for b in shapely.to_wkb(geometries)]
+    offsets = np.zeros(len(blobs) + 1, dtype="<i8")
+    offsets[1:] = np.cumsum([len(b) for b in blobs])
+    tableaux = {
+        "centroides": centroides(geometries).astype("<f8"),
+        "wkb_offsets": offsets,
+        "wkb": np.frombuffer(b"".join(blobs), dtype=np.uint8),
+    }
+    descr = {}
+    offset = 0
+    for nom, tab in tableaux.items():
+        descr[nom] = {"dtype": tab.dtype.str, "shape": tab.shape, "offset": offset}
+        offset += -(-tab.nbytes // ALIGNEMENT) * ALIGNEMENT
+    entete = json.dumps(
+        {
+            "source": source,
+            "cles": list(cles),
+            "groupes": list(groupes),
+            "attributs": list(attributs),
+            "tableaux": descr,
+        },
+        ensure_ascii=False,
+    ).encode()
+    entete += b" " * (-(len(MAGIC) + 8 + len(entete)) % ALIGNEMENT)
+    tmppath = path.with_suffix(".tmp")
+    with open(tmppath, "wb") as outfh:
+        outfh.write(MAGIC)
+        outfh.write(struct.pack("<Q", len(entete)))
+        outfh.write(entete)
+        for tab in tableaux.values():
+            outfh.write(tab.tobytes())
+            outfh.write(b"\0" * (-tab.nbytes % ALIGNEMENT))
+    tmppath.replace(path)
+
+
+def lire(path: Path) -> Instantane:
+    """Lire un instantané en projetant ses tableaux en mémoire"""
+    with open(path, "rb") as infh:
+        mm = mmap.mmap(infh.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[: len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} n'est pas un instantané")
+    (taille,) = struct.unpack_from("<Q", mm, len(MAGIC))
+    debut = len(MAGIC) + 8
+    entete = json.loads(mm[debut : debut + taille])
+    debut += taille
+    tableaux = {}
+    for nom, d in entete["tableaux"].items():
+        dtype = np.dtype(d["dtype"])
+        count = int(np.prod(d["shape"]))
+        tableaux[nom] = np.frombuffer(
+            mm, dtype=dtype, count=count, offset=debut + d["offset"]
+        ).reshape(d["shape"])
+    # Découpage en Python, mais décodage de toutes les géométries d'un coup
+    wkb, offsets = tableaux["wkb"].tobytes(), tableaux["wkb_offsets"].tolist()
+    blobs = np.empty(len(offsets) - 1, dtype=object)
+    blobs[:] = [wkb[a:b] or None for a, b in zip(offsets[:-1], offsets[1:])]
+    geometries = shapely.from_wkb(blobs)
+    return Instantane(
+        source=entete["source"],
+        cles=entete["cles"],
+        groupes=entete["groupes"],
+        attributs=entete["attributs"],
+        geometries=geometries,
+        centroides=tableaux["centroides"],
+    )
+
+
+class Materialises(Mapping[K, V], Generic[K, F, V]):
+    """
+    Fiches compactes matérialisées à la demande en modèles.
+
+    Les modèles sont gardés par référence faible: tant qu'une requête
+    s'en sert, ils sont partagés, puis libérés.
+    """
+
+    def __init__(self, fiches: Mapping[K, F], construire: Callable[[F], V]):
+        self.fiches = fiches
+        self.construire = construire
+        self.cache: "weakref.WeakValueDictionary[K, V]" = weakref.WeakValueDictionary()
+
+    def __getitem__(self, cle: K) -> V:
+        modele = self.cache.get(cle)
+        if modele is None:
+            modele = self.construire(self.fiches[cle])
+            self.cache[cle] = modele
+        return modele
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(self.fiches)
+
+    def __len__(self) -> int:
+        return len(self.fiches)
+
+    def __contains__(self, cle: object) -> bool:
+        return cle in self.fiches
+
+
+class Groupes(Mapping[str, List[V]], Generic[K, V]):
+    """Listes de modèles par clé (p.ex. les plateaux d'une ville)"""
+
+    def __init__(self, groupes: Mapping[str, Sequence[K]], elements: Mapping[K, V]):
+        self.groupes = groupes
+        self.elements = elements
+
+    def __getitem__(self, cle: str) -> List[V]:
+        return [self.elements[e] for e in self.groupes[cle]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.groupes)
+
+    def __len__(self) -> int:
+        return len(self.groupes)
@@ -0,0 +1,165 @@
+"""Photos des observations, adressées par leur contenu.
+
+Une photo est écrite au fur et à mesure de sa réception dans un fichier
+temporaire puis renommée d'après son empreinte SHA-256 (et son format)
+dans `medias/` sous le DATADIR, p.ex. `medias/3f/3fa2...e1.jpg`.  Deux
+photos identiques n'en font donc qu'une.  Les vignettes sont créées
+avec Pillow, s'il est installé, dans une réserve de fils d'exécution
+séparée de la boucle d'événements.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Union
+
+try:
+    from PIL import Image, ImageOps  # type: ignore
+except ImportError:
+    Image = None
+
+LOGGER = logging.getLogger("points-air-medias")
+# Formats acceptés, reconnus par leurs premiers octets
+FORMATS: Dict[str, str] = {
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+    "heic": "image/heic",
+}
+NOM = re.compile(r"^[0-9a-f]{64}\.(?:jpg|png|webp|heic)$")
+# Taille maximale d'une photo (octets)
+TAILLE_MAX = 20 * 1024 * 1024
+# Côté maximal des vignettes (pixels)
+VIGNETTE = 320
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+ATELIERS = 2
+RESERVE: Union[ThreadPoolExecutor, None] = None
+
+
+class PhotoInvalide(ValueError):
+    """Le contenu n'est pas une photo d'un format accepté"""
+
+
+class PhotoTropGrande(ValueError):
+    """La photo dépasse TAILLE_MAX"""
+
+
+def format_photo(debut: bytes) -> Union[str, None]:
+    """Format (extension) d'une photo selon ses premiers octets"""
+    if debut.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if debut.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if debut[:4] == b"RIFF" and debut[8:12] == b"WEBP":
+        return "webp"
+    if debut[4:8] == b"ftyp" and debut[8:12] in (b"heic", b"heix", b"mif1"):
+        return "heic"
+    return None
+
+
+def racine(datadir: Path) -> Path:
+    """Répertoire des médias"""
+    return datadir / "medias"
+
+
+def chemin(datadir: Path, nom: str) -> Path:
+    """Chemin d'une photo par son nom (empreinte et extension)"""
+    return racine(datadir) / nom[:2] / nom
+
+
+def chemin_vignette(datadir: Path, nom: str) -> Path:
+    """Chemin de la vignette (JPEG) d'une photo"""
+    empreinte = nom.partition(".")[0]
+    return racine(datadir) / nom[:2] / f"{empreinte}-{VIGNETTE}.jpg"
+
+
+class Televersement:
+    """Écriture d'une photo reçue par morceaux"""
+
+    def __init__(self, datadir: Path):
+        self.datadir = datadir
+        temporaire = racine(datadir) / "tmp"
+        temporaire.mkdir(parents=True, exist_ok=True)
+        self.fichier = tempfile.NamedTemporaryFile(dir=temporaire, delete=False)
+        self.empreinte = hashlib.sha256()
+        self.taille = 0
+        self.debut = b""
+
+    def ecrire(self, morceau: bytes) -> None:
+        self.taille += len(morceau)
+        if self.taille > TAILLE_MAX:
+            raise PhotoTropGrande(f"Photo de plus de {TAILLE_MAX} octets")
+        if len(self.debut) < 16:
+            self.debut += morceau[:16]
+        self.empreinte.update(morceau)
+        self.fichier.write(morceau)
+
+    def terminer(self) -> str:
+        """Placer la photo dans le magasin et retourner son nom"""
+        self.fichier.close()
+        extension = format_photo(self.debut)
+        if extension is None:
+            os.unlink(self.fichier.name)
+            raise PhotoInvalide("Format de photo non pris en charge")
+        nom = f"{self.empreinte.hexdigest()}.{extension}"
+        path = chemin(self.datadir, nom)
+        if path.exists():
+            # Déjà reçue
+            os.unlink(self.fichier.name)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.chmod(self.fichier.name, 0o644)
+            os.replace(self.fichier.name, path)
+        return nom
+
+    def annuler(self) -> None:
+        self.fichier.close()
+        try:
+            os.unlink(self.fichier.name)
+        except FileNotFoundError:
+            pass
+
+
+def creer_vignette(datadir: Path, nom: str) -> Union[Path, None]:
+    """Créer la vignette d'une photo (None sans Pillow ou si illisible)"""
+    if Image is None:
+        return None
+    path = chemin_vignette(datadir, nom)
+    if path.exists():
+        return path
+    try:
+        with Image.open(chemin(datadir, nom)) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((VIGNETTE, VIGNETTE))
+            temporaire = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            image.convert("RGB").save(temporaire, "JPEG", quality=85)
+    except Exception as e:
+        LOGGER.warning("Vignette impossible pour %s: %s", nom, e)
+        return None
+    os.replace(temporaire, path)
+    return path
+
+
+def reserve() -> ThreadPoolExecutor:
+    """Réserve de fils d'exécution des vignettes (créée au premier usage)"""
+    global RESERVE
+    if RESERVE is None:
+        RESERVE = ThreadPoolExecutor(ATELIERS, thread_name_prefix="vignettes")
+    return RESERVE
+
+
+def vignette(datadir: Path, nom: str) -> "Future[Union[Path, None]]":
+    """Créer une vignette dans la réserve"""
+    return reserve().submit(creer_vignette, datadir, nom)
+
+
+def fermer() -> None:
+    """Terminer les vignettes en cours"""
+    global RESERVE
+    if RESERVE is not None:
+        RESERVE.shutdown(wait=True)
+        RESERVE = None
@@ -0,0 +1,197 @@
+"""Métriques et profilage des requêtes.
+
+Le middleware `Metriques` compte les requêtes par gabarit de route
+(p.ex. `/plateaux/{latitude},{longitude}`), méthode et statut, et
+mesure leur latence, la taille des réponses et le nombre de requêtes en
+cours.  `exposer` les rend au format texte de Prometheus.
+
+Les requêtes peuvent aussi être profilées avec cProfile: toutes si
+`lent` est donné (le profil n'est gardé que si la requête dépasse ce
+seuil), ou à la demande avec l'en-tête `X-Profil` si `entete` est vrai.
+Un seul profil est actif à la fois, et il couvre tout ce qui s'exécute
+dans la boucle d'événements pendant la requête.
+"""
+
+import cProfile
+import logging
+import re
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple, Union
+
+from starlette.routing import BaseRoute, Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+LOGGER = logging.getLogger("points-air-metriques")
+# Bornes des histogrammes de latence (secondes) et de taille (octets)
+BORNES_DUREE = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+BORNES_TAILLE = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+# Étiquettes: méthode, route (et statut pour les compteurs)
+Etiquettes = Tuple[str, ...]
+
+
+class Histogramme:
+    """Histogramme cumulatif à la Prometheus"""
+
+    def __init__(self, bornes: Sequence[float]):
+        self.bornes = bornes
+        self.compteurs = [0] * (len(bornes) + 1)
+        self.somme = 0.0
+
+    def observer(self, valeur: float) -> None:
+        self.compteurs[bisect_left(self.bornes, valeur)] += 1
+        self.somme += valeur
+
+    def lignes(self, nom: str, etiquettes: str) -> List[str]:
+        lignes = []
+        cumul = 0
+        for borne, n in zip(self.bornes, self.compteurs):
+            cumul += n
+            lignes.append(f'{nom}_bucket{{{etiquettes},le="{borne}"}} {cumul}')
+        cumul += self.compteurs[-1]
+        lignes.append(f'{nom}_bucket{{{etiquettes},le="+Inf"}} {cumul}')
+        lignes.append(f"{nom}_sum{{{etiquettes}}} {self.somme}")
+        lignes.append(f"{nom}_count{{{etiquettes}}} {cumul}")
+        return lignes
+
+
+class Registre:
+    """Métriques de toutes les routes"""
+
+    def __init__(self) -> None:
+        self.requetes: Dict[Etiquettes, int] = {}
+        self.en_cours: Dict[Etiquettes, int] = {}
+        self.durees: Dict[Etiquettes, Histogramme] = {}
+        self.tailles: Dict[Etiquettes, Histogramme] = {}
+
+    def debut(self, cle: Etiquettes) -> None:
+        self.en_cours[cle] = self.en_cours.get(cle, 0) + 1
+
+    def fin(self, cle: Etiquettes, statut: int, duree: float, taille: int) -> None:
+        self.en_cours[cle] -= 1
+        cle_statut = (*cle, str(statut))
+        self.requetes[cle_statut] = self.requetes.get(cle_statut, 0) + 1
+        if cle not in self.durees:
+            self.durees[cle] = Histogramme(BORNES_DUREE)
+            self.tailles[cle] = Histogramme(BORNES_TAILLE)
+        self.durees[cle].observer(duree)
+        self.tailles[cle].observer(taille)
+
+
+REGISTRE = Registre()
+
+
+def etiquettes(cle: Etiquettes) -> str:
+    noms = ("methode", "route", "statut")
+    return ",".join(
+        '%s="%s"' % (nom, v.replace("\\", "\\\\").replace('"', '\\"'))
+        for nom, v in zip(noms, cle)
+    )
+
+
+def exposer(registre: Registre = REGISTRE) -> str:
+    """Métriques au format texte de Prometheus"""
+    lignes = [
+        "# HELP points_air_requetes_total Requêtes HTTP terminées",
+        "# TYPE points_air_requetes_total counter",
+    ]
+    for cle, n in sorted(registre.requetes.items()):
+        lignes.append(f"points_air_requetes_total{{{etiquettes(cle)}}} {n}")
+    lignes += [
+        "# HELP points_air_requetes_en_cours Requêtes HTTP en cours",
+        "# TYPE points_air_requetes_en_cours gauge",
+    ]
+    for cle, n in sorted(registre.en_cours.items()):
+        lignes.append(f"points_air_requetes_en_cours{{{etiquettes(cle)}}} {n}")
+    for nom, aide, histogrammes in (
+        ("points_air_requete_duree_secondes", "Latence", registre.durees),
+        ("points_air_reponse_octets", "Taille des réponses", registre.tailles),
+    ):
+        lignes += [f"# HELP {nom} {aide}", f"# TYPE {nom} histogram"]
+        for cle, histogramme in sorted(histogrammes.items()):
+            lignes += histogramme.lignes(nom, etiquettes(cle))
+    return "\n".join(lignes) + "\n"
+
+
+class Metriques:
+    """Middleware ASGI de métriques (et de profilage) par route"""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        routes: Sequence[BaseRoute],
+        registre: Registre = REGISTRE,
+        profils: Path = Path("profils"),
+        lent: Union[float, None] = None,
+        entete: bool = False,
+    ):
+        self.app = app
+        self.routes = routes
+        self.registre = registre
+        self.profils = profils
+        self.lent = lent
+        self.entete = entete
+        self.profil_actif = False
+
+    def route(self, scope: Scope) -> str:
+        """Gabarit de la route d'une requête"""
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", "inconnue")
+        return "inconnue"
+
+    def profiler(self, scope: Scope) -> bool:
+        """Profiler cette requête?"""
+        if self.profil_actif:
+            return False
+        if self.lent is not None:
+            return True
+        return self.entete and any(k == b"x-profil" for k, _ in scope["headers"])
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        cle = (scope["method"], self.route(scope))
+        statut = 500
+        taille = 0
+
+        async def envoyer(message: Message) -> None:
+            nonlocal statut, taille
+            if message["type"] == "http.response.start":
+                statut = message["status"]
+            elif message["type"] == "http.response.body":
+                taille += len(message.get("body", b""))
+            await send(message)
+
+        profil = None
+        if self.profiler(scope):
+            self.profil_actif = True
+            profil = cProfile.Profile()
+            profil.enable()
+        self.registre.debut(cle)
+        debut = time.perf_counter()
+        try:
+            await self.app(scope, receive, envoyer)
+        finally:
+            duree = time.perf_counter() - debut
+            self.registre.fin(cle, statut, duree, taille)
+            if profil is not None:
+                profil.disable()
+                self.profil_actif = False
+                if self.lent is None or duree >= self.lent:
+                    self.sauver(profil, cle, duree)
+
+    def sauver(self, profil: cProfile.Profile, cle: Etiquettes, duree: float) -> None:
+        """Sauvegarder le profil d'une requête"""
+        methode, route = cle
+        nom = re.sub(r"[^\w]+", "_", route).strip("_") or "racine"
+        self.profils.mkdir(parents=True, exist_ok=True)
+        ms = duree * 1000
+        path = self.profils / f"{time.time():.3f}-{methode}-{nom}-{ms:.0f}ms.prof"
+        profil.dump_stats(path)
+        LOGGER.warning("%s %s: %.0f ms, profil dans %s", methode, route, ms, path)
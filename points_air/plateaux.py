@@ -6,24 +6,49 @@ ville.
 """
 
 import logging
+import math
+import weakref
 from pathlib import Path
-from typing import Dict, List, Literal, Tuple, Union
+from typing import Dict, List, Literal, Mapping, NamedTuple, Tuple, Union
 from uuid import UUID, uuid4
 
+import numpy as np
 import pyproj
 import shapely  # type: ignore
 from pydantic import BaseModel, Field, RootModel
 from pydantic_geojson import FeatureModel, PointModel  # type: ignore
 
+from . import geodonnees, instantane
+
 LOGGER = logging.getLogger("points-air-plateaux")
 WGS84 = pyproj.Geod(ellps="WGS84")
-SHAPES: Dict[UUID, shapely.Geometry] = {}
-PLATEAUX: Dict[str, List["Plateau"]]
-PLATEAUX_UUID: Dict[UUID, "Plateau"]
+# Vues sur la version actuelle des données (voir `Donnees`)
+SHAPES: Mapping[UUID, shapely.Geometry] = geodonnees.Vue(
+    "plateaux", lambda d: d.shapes
+)
+FICHES: Mapping[UUID, "FichePlateau"] = geodonnees.Vue(
+    "plateaux", lambda d: d.fiches
+)
+PAR_VILLE: Mapping[str, List[UUID]] = geodonnees.Vue(
+    "plateaux", lambda d: d.par_ville
+)
+PLATEAUX: Mapping[str, List["Plateau"]] = geodonnees.Vue(
+    "plateaux", lambda d: d.plateaux
+)
+PLATEAUX_UUID: Mapping[UUID, "Plateau"] = geodonnees.Vue(
+    "plateaux", lambda d: d.plateaux_uuid
+)
+# Nombre minimal de km par degré de latitude (avec marge)
+KM_PAR_DEGRE = 110.0
+# Projection métrique locale (Québec Lambert) pour les distances aux bordures
+LAMBERT = "EPSG:32198"
+# Marge sur les distances projetées (déformation de la projection)
+MARGE_LAMBERT = 1.05
 
 
 Saison = Literal["Hiver", "TroisSaisons", "QuatreSaisons"]
 Sport = Literal["Marche", "Vélo"]
+Mesure = Literal["centroide", "bordure"]
 
 
 class Plateau(BaseModel):
@@ -53,50 +78,312 @@ class Plateau(BaseModel):
         examples=[PointModel(coordinates=(-72.75478338821179, 46.53507358332476))],
     )
     feature: Union[FeatureModel, None] = Field(
-        None, description="Feature GeoJSON de ce plateau"
+        default=None, description="Feature GeoJSON de ce plateau"
     )
 
     @classmethod
     def near_wgs84(
-        self, latitude: float, longitude: float, proximite: float = 10, limit: int = 10
+        self,
+        latitude: float,
+        longitude: float,
+        proximite: float = 10,
+        limit: int = 10,
+        mesure: Mesure = "centroide",
     ) -> List[Tuple[float, "Plateau"]]:
-        """Plateaux a proximité et distances"""
-        # FIXME: Pourrait vraiment utiliser Spatial SQL ;-)
-        ns = len(SHAPES)
-        _, _, distances = WGS84.inv(
-            [longitude] * ns,
-            [latitude] * ns,
-            [shape.centroid.x for shape in SHAPES.values()],
-            [shape.centroid.y for shape in SHAPES.values()],
-        )
-        plateaux = list(zip(distances, SHAPES.keys()))
-        plateaux.sort()
+        """
+        Plateaux a proximité et distances, mesurées jusqu'au centroïde ou
+        jusqu'au point le plus proche du périmètre (0 à l'intérieur).
+        """
+        d = donnees()
+        if mesure == "bordure":
+            idx, distances = bordures_proches(
+                latitude, longitude, proximite, limit, d.bordures
+            )
+        else:
+            boite = shapely.box(*boite_wgs84(latitude, longitude, proximite))
+            idx = d.index.query(boite)
+            idx, distances = plus_proches(
+                latitude,
+                longitude,
+                d.centroides[idx, 0],
+                d.centroides[idx, 1],
+                proximite,
+                limit,
+                idx,
+            )
         return [
-            (dist, PLATEAUX_UUID[uid])
-            for dist, uid in plateaux[:limit]
-            if dist < proximite * 1000
+            (float(dist), d.plateaux_uuid[d.ids[i]]) for i, dist in zip(idx, distances)
         ]
 
     @classmethod
     def from_uuid(self, uid: UUID) -> Union["Plateau", None]:
-        return PLATEAUX_UUID.get(uid)
+        return donnees().plateaux_uuid.get(uid)
+
+    @classmethod
+    def ville_de(self, uid: UUID) -> Union[str, None]:
+        """Ville d'un plateau (sans matérialiser le plateau)"""
+        fiche = donnees().fiches.get(uid)
+        if fiche is None:
+            return None
+        return fiche.ville
+
+    def avec_feature(self) -> "Plateau":
+        """Ce plateau avec son feature GeoJSON (reconstruit au besoin)"""
+        d = donnees()
+        if self.feature is not None or self.id not in d.shapes:
+            return self
+        plateau = d.features.get(self.id)
+        if plateau is None:
+            plateau = self.model_copy(
+                update={"feature": instantane.feature(d.shapes[self.id])}
+            )
+            d.features[self.id] = plateau
+        return plateau
+
+
+def boite_wgs84(
+    latitude: float, longitude: float, proximite: float
+) -> Tuple[float, float, float, float]:
+    """Boîte englobante (conservatrice) en degrés d'une proximité en km"""
+    dlat = proximite / KM_PAR_DEGRE
+    maxlat = abs(latitude) + dlat
+    if maxlat >= 90:
+        dlon = 180.0
+    else:
+        dlon = min(180.0, dlat / math.cos(math.radians(maxlat)))
+    return (longitude - dlon, latitude - dlat, longitude + dlon, latitude + dlat)
+
+
+def plus_proches(
+    latitude: float,
+    longitude: float,
+    longitudes: np.ndarray,
+    latitudes: np.ndarray,
+    proximite: float,
+    limite: int,
+    idx: Union[np.ndarray, None] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sélectionner les `limite` candidats les plus proches à moins de
+    `proximite` km, en ordre de distance.  Retourne leurs indices (ou
+    les éléments correspondants de `idx`) et leurs distances en mètres.
+    """
+    if idx is None:
+        idx = np.arange(len(longitudes))
+    if limite <= 0 or len(idx) == 0:
+        return idx[:0], np.zeros(0)
+    _, _, distances = WGS84.inv(
+        np.full(len(idx), longitude),
+        np.full(len(idx), latitude),
+        longitudes,
+        latitudes,
+    )
+    distances = np.asarray(distances)
+    proches = distances < proximite * 1000
+    idx, distances = idx[proches], distances[proches]
+    if len(idx) > limite:
+        top = np.argpartition(distances, limite - 1)[:limite]
+        idx, distances = idx[top], distances[top]
+    order = np.argsort(distances, kind="stable")
+    return idx[order], distances[order]
+
+
+class Bordures(NamedTuple):
+    """Géométries des plateaux projetées en Lambert et leur index"""
+
+    vers_lambert: pyproj.Transformer
+    de_lambert: pyproj.Transformer
+    geometries: np.ndarray
+    index: shapely.STRtree
+
+
+def projeter_bordures(shapes: np.ndarray) -> Bordures:
+    """Projeter les géométries des plateaux en Lambert et les indexer"""
+    vers_lambert = pyproj.Transformer.from_crs("EPSG:4326", LAMBERT, always_xy=True)
+    de_lambert = pyproj.Transformer.from_crs(LAMBERT, "EPSG:4326", always_xy=True)
+
+    def projeter(coords: np.ndarray) -> np.ndarray:
+        return np.column_stack(vers_lambert.transform(coords[:, 0], coords[:, 1]))
+
+    geometries = shapely.transform(shapes, projeter)
+    shapely.prepare(geometries)
+    return Bordures(vers_lambert, de_lambert, geometries, shapely.STRtree(geometries))
+
+
+def bordures_proches(
+    latitude: float,
+    longitude: float,
+    proximite: float,
+    limite: int,
+    b: Union[Bordures, None] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sélectionner les `limite` plateaux dont le périmètre est le plus
+    proche à moins de `proximite` km.  Le point le plus proche de chaque
+    candidat est trouvé en Lambert, puis sa distance géodésique calculée.
+    """
+    if b is None:
+        b = donnees().bordures
+    point = shapely.Point(*b.vers_lambert.transform(longitude, latitude))
+    idx = b.index.query(
+        point, predicate="dwithin", distance=proximite * 1000 * MARGE_LAMBERT
+    )
+    if limite <= 0 or len(idx) == 0:
+        return idx[:0], np.zeros(0)
+    lignes = shapely.shortest_line(point, b.geometries[idx])
+    fins = shapely.get_coordinates(shapely.get_point(lignes, 1))
+    longitudes, latitudes = b.de_lambert.transform(fins[:, 0], fins[:, 1])
+    return plus_proches(
+        latitude, longitude, longitudes, latitudes, proximite, limite, idx
+    )
+
+
+class FichePlateau(NamedTuple):
+    """Représentation compacte (sans géométrie) d'un plateau"""
+
+    id: UUID
+    nom: str
+    ville: str
+    saison: Saison
+    sports: Tuple[Sport, ...]
+    centroide: Tuple[float, float]
+
+    @classmethod
+    def de_modele(cls, p: Plateau) -> "FichePlateau":
+        return cls(
+            p.id, p.nom, p.ville, p.saison, tuple(p.sports), tuple(p.centroide.coordinates)
+        )
+
+    @classmethod
+    def de_attributs(cls, attributs: Dict) -> "FichePlateau":
+        return cls(
+            UUID(attributs["id"]),
+            attributs["nom"],
+            attributs["ville"],
+            attributs["saison"],
+            tuple(attributs["sports"]),
+            tuple(attributs["centroide"]["coordinates"]),
+        )
+
+    def plateau(self) -> Plateau:
+        return Plateau(
+            id=self.id,
+            nom=self.nom,
+            ville=self.ville,
+            saison=self.saison,
+            sports=list(self.sports),
+            centroide=PointModel(coordinates=self.centroide),
+        )
 
 
 PlateauCollection = RootModel[Dict[str, List[Plateau]]]
 THISDIR = Path(__file__).parent
-with open(THISDIR / "plateaux.json") as infh:
-    data = infh.read()
-    PLATEAUX = PlateauCollection.model_validate_json(data).root
-    PLATEAUX_UUID = {}
-    for v in PLATEAUX.values():
+SOURCE = THISDIR / "plateaux.json"
+INSTANTANE = THISDIR / "plateaux.instantane"
+Chargement = Tuple[Dict[str, List[FichePlateau]], np.ndarray, np.ndarray]
+
+
+def lire_json(path: Path) -> Chargement:
+    """Lire les plateaux et leurs géométries en GeoJSON"""
+    with open(path) as infh:
+        plateaux = PlateauCollection.model_validate_json(infh.read()).root
+    fiches: Dict[str, List[FichePlateau]] = {}
+    geometries: List[Union[shapely.Geometry, None]] = []
+    for ville, v in plateaux.items():
+        fiches[ville] = []
         for p in v:
+            fiches[ville].append(FichePlateau.de_modele(p))
             if p.feature is None:
                 LOGGER.warning(
                     "feature pour %s ne devrait pas être None dans plateaux.json", p.id
                 )
+                geometries.append(None)
                 continue
             # FIXME: THERE MUST BE A BETTER WAY
-            shape = shapely.from_geojson(p.feature.model_dump_json())
+            geometries.append(shapely.from_geojson(p.feature.model_dump_json()))
+    shapes = np.array(geometries, dtype=object)
+    return fiches, shapes, instantane.centroides(shapes)
+
+
+def lire_instantane(path: Path, source: Path) -> Union[Chargement, None]:
+    """Lire les plateaux et leurs géométries d'un instantané à jour"""
+    try:
+        inst = instantane.lire(path)
+    except FileNotFoundError:
+        return None
+    if inst.source != instantane.empreinte(source):
+        LOGGER.warning("Instantané %s périmé, lecture de %s", path, source)
+        return None
+    fiches: Dict[str, List[FichePlateau]] = {cle: [] for cle in inst.cles}
+    for groupe, attributs in zip(inst.groupes, inst.attributs):
+        fiches[inst.cles[groupe]].append(FichePlateau.de_attributs(attributs))
+    return fiches, inst.geometries, inst.centroides
+
+
+def ecrire_instantane(path: Path = INSTANTANE, source: Path = SOURCE) -> None:
+    """Construire l'instantané des plateaux à partir du GeoJSON"""
+    fiches, geometries, _ = lire_json(source)
+    groupes = []
+    attributs = []
+    for groupe, v in enumerate(fiches.values()):
+        for f in v:
+            groupes.append(groupe)
+            attributs.append(f.plateau().model_dump(mode="json", exclude={"feature"}))
+    instantane.ecrire(
+        path,
+        instantane.empreinte(source),
+        list(fiches.keys()),
+        groupes,
+        attributs,
+        geometries,
+    )
+
+
+class Donnees:
+    """Une version des plateaux, de leurs géométries et de leurs index"""
+
+    def __init__(
+        self,
+        fiches: Dict[str, List[FichePlateau]],
+        geometries: np.ndarray,
+        centroides: np.ndarray,
+    ):
+        self.par_ville = {ville: [f.id for f in v] for ville, v in fiches.items()}
+        # Fiches compactes des plateaux, matérialisées en Plateau à la demande
+        self.fiches = {f.id: f for v in fiches.values() for f in v}
+        self.shapes: Dict[UUID, shapely.Geometry] = {}
+        for fiche, shape in zip((f for v in fiches.values() for f in v), geometries):
+            if shape is None:
+                continue
             shapely.prepare(shape)
-            SHAPES[p.id] = shape
-            PLATEAUX_UUID[p.id] = p
+            self.shapes[fiche.id] = shape
+        self.plateaux_uuid = instantane.Materialises(self.fiches, FichePlateau.plateau)
+        self.plateaux = instantane.Groupes(self.par_ville, self.plateaux_uuid)
+        # Plateaux avec leur feature GeoJSON, tant qu'une requête s'en sert
+        self.features: "weakref.WeakValueDictionary[UUID, Plateau]" = (
+            weakref.WeakValueDictionary()
+        )
+        # Centroïdes (longitude, latitude) des shapes, dans le même ordre que ids
+        self.ids = list(self.shapes.keys())
+        self.centroides = centroides[~shapely.is_missing(geometries)]
+        self.index = shapely.STRtree(shapely.points(self.centroides))
+        # Géométries projetées avec la version (hors de la boucle d'événements)
+        self.bordures = projeter_bordures(
+            np.array([self.shapes[i] for i in self.ids], dtype=object)
+        )
+
+
+def charger(path: Path = INSTANTANE, source: Path = SOURCE) -> Donnees:
+    """Construire une version des plateaux (de l'instantané s'il est à jour)"""
+    charge = lire_instantane(path, source)
+    if charge is None:
+        charge = lire_json(source)
+    return Donnees(*charge)
+
+
+def donnees() -> Donnees:
+    """Version actuelle des plateaux"""
+    return geodonnees.donnees("plateaux")
+
+
+geodonnees.publier(plateaux=charger())
@@ -0,0 +1,301 @@
+"""Réponses JSON pré-sérialisées pour les données géographiques statiques.
+
+Les villes et les plateaux ne changent que lorsque `villes.json` et
+`plateaux.json` sont reconstruits, donc leurs réponses sont rendues
+une seule fois par version des données (voir `geodonnees`) et par
+variante (avec ou sans géométrie) puis servies avec un ETag fort et
+`Cache-Control`.  Leurs variantes compressées (gzip, et brotli s'il
+est installé) sont aussi gardées, chacune avec son ETag, et choisies
+selon `Accept-Encoding`.
+
+Les listes d'activités et d'observations sont plutôt paginées par
+curseur et diffusées page par page, en JSON ou en NDJSON.
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Sequence,
+    TypeVar,
+    Union,
+)
+from uuid import UUID
+
+from fastapi import Request, Response, status
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+from . import geodonnees
+from .plateaux import Plateau
+from .villes import Ville
+
+M = TypeVar("M", Ville, Plateau)
+NDJSON = "application/x-ndjson"
+# Enregistrements lus à la fois lors d'une diffusion
+TAILLE_PAGE = 500
+
+
+# Taille minimale (en octets) d'une réponse à compresser
+TAILLE_MIN_COMPRESSION = 1024
+NIVEAU_GZIP = 9
+QUALITE_BROTLI = 9
+
+
+class ReponseStatique(NamedTuple):
+    """Corps d'une réponse JSON et son ETag, et ses variantes compressées"""
+
+    contenu: bytes
+    etag: str
+    variantes: Dict[str, bytes]
+
+
+# Réponses rendues, les moins récemment utilisées en premier
+REPONSES: "OrderedDict[Hashable, ReponseStatique]" = OrderedDict()
+# Taille maximale (en octets) des réponses gardées en mémoire
+TAILLE_MAX = 64 * 1024 * 1024
+taille = 0
+# Protège REPONSES et taille (rendus et compressions dans des fils)
+VERROU = threading.Lock()
+
+
+def sans_geometrie(modele: M, geometrie: bool = False) -> M:
+    """Retirer le feature GeoJSON d'un modèle (ou l'ajouter si demandé)"""
+    if geometrie:
+        return modele.avec_feature()
+    return modele.model_copy(update={"feature": None})
+
+
+def json_octets(donnees: Any) -> bytes:
+    """Sérialiser des données JSON simples (avec orjson s'il est installé)"""
+    if orjson is not None:
+        return orjson.dumps(donnees)
+    return json.dumps(donnees, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def json_modele(modele: Union[BaseModel, None]) -> bytes:
+    """Sérialiser un modèle (ou null)"""
+    if modele is None:
+        return b"null"
+    return modele.model_dump_json().encode()
+
+
+def json_liste(modeles: Iterable[BaseModel]) -> bytes:
+    """Sérialiser une liste de modèles"""
+    return b"[" + b",".join(m.model_dump_json().encode() for m in modeles) + b"]"
+
+
+def etag_correspond(if_none_match: Union[str, None], etag: str) -> bool:
+    """Vérifier un en-tête If-None-Match (comparaison faible)"""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def encodage(accept_encoding: Union[str, None]) -> Union[str, None]:
+    """Meilleur encodage disponible selon un en-tête Accept-Encoding"""
+    if not accept_encoding:
+        return None
+    disponibles = ["br", "gzip"] if brotli is not None else ["gzip"]
+    qualites: Dict[str, float] = {}
+    for element in accept_encoding.split(","):
+        nom, _, params = element.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        qualites[nom.strip().lower()] = q
+    choix, meilleure = None, 0.0
+    for nom in disponibles:
+        q = qualites.get(nom, qualites.get("*", 0.0))
+        if q > meilleure:
+            choix, meilleure = nom, q
+    return choix
+
+
+def compresser(contenu: bytes, encodage: str) -> bytes:
+    """Compresser un corps de réponse"""
+    if encodage == "br":
+        return brotli.compress(contenu, quality=QUALITE_BROTLI)
+    return gzip.compress(contenu, NIVEAU_GZIP, mtime=0)
+
+
+def version(cle: Hashable) -> Hashable:
+    """Clé d'une réponse dans la version actuelle des données"""
+    return (geodonnees.actuelle().numero, cle)
+
+
+def conserver(
+    cle: Hashable,
+    reponse: ReponseStatique,
+    choix: Union[str, None] = None,
+    variante: bytes = b"",
+) -> ReponseStatique:
+    """
+    Garder une réponse, ou une de ses variantes compressées, en mémoire.
+    Seul endroit où `taille` change: si une autre requête l'a rendue
+    entretemps, c'est la sienne qui est gardée et retournée.
+    """
+    global taille
+    with VERROU:
+        gardee = REPONSES.get(cle)
+        if choix is None:
+            if gardee is not None:
+                return gardee
+            REPONSES[cle] = reponse
+            taille += len(reponse.contenu)
+        else:
+            if choix in reponse.variantes:
+                return reponse
+            reponse.variantes[choix] = variante
+            if gardee is reponse:  # Sinon déjà évincée
+                taille += len(variante)
+        evincer()
+    return reponse
+
+
+def trouver(cle: Hashable) -> Union[ReponseStatique, None]:
+    """Réponse déjà rendue, ou None"""
+    with VERROU:
+        reponse = REPONSES.get(cle)
+        if reponse is not None:
+            REPONSES.move_to_end(cle)
+        return reponse
+
+
+def rendre_reponse(cle: Hashable, rendre: Callable[[], bytes]) -> ReponseStatique:
+    """Rendre une réponse et la garder en mémoire"""
+    contenu = rendre()
+    etag = '"%s"' % hashlib.sha256(contenu).hexdigest()
+    return conserver(cle, ReponseStatique(contenu, etag, {}))
+
+
+def rendu(cle: Hashable, rendre: Callable[[], bytes]) -> ReponseStatique:
+    """Obtenir une réponse pré-sérialisée, la rendant au premier usage"""
+    cle = version(cle)
+    return trouver(cle) or rendre_reponse(cle, rendre)
+
+
+def evincer() -> None:
+    """Retirer les réponses les moins récemment utilisées au-delà de TAILLE_MAX"""
+    global taille  # Sous VERROU
+    while taille > TAILLE_MAX and len(REPONSES) > 1:
+        _, vieille = REPONSES.popitem(last=False)
+        taille -= len(vieille.contenu) + sum(map(len, vieille.variantes.values()))
+
+
+async def reponse_statique(
+    request: Request,
+    cle: Hashable,
+    rendre: Callable[[], bytes],
+    cache_control: str,
+) -> Response:
+    """
+    Servir une réponse pré-sérialisée, compressée si le client l'accepte.
+    Le rendu et la compression (lents pour les villes et plateaux avec
+    leurs géométries) se font hors de la boucle d'événements.
+    """
+    cle = version(cle)
+    reponse = trouver(cle)
+    if reponse is None:
+        reponse = await run_in_threadpool(rendre_reponse, cle, rendre)
+    contenu, etag = reponse.contenu, reponse.etag
+    headers = {"Cache-Control": cache_control}
+    if len(contenu) >= TAILLE_MIN_COMPRESSION:
+        choix = encodage(request.headers.get("accept-encoding"))
+        if choix is not None:
+            variante = reponse.variantes.get(choix)
+            if variante is None:
+                variante = await run_in_threadpool(compresser, contenu, choix)
+                conserver(cle, reponse, choix, variante)
+            contenu = reponse.variantes[choix]
+            etag = '%s-%s"' % (etag[:-1], choix)
+            headers["Content-Encoding"] = choix
+            # Sinon ajouté par GZipMiddleware (qui ignore les réponses encodées)
+            headers["Vary"] = "Accept-Encoding"
+    headers["ETag"] = etag
+    if etag_correspond(request.headers.get("if-none-match"), etag):
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(contenu, media_type="application/json", headers=headers)
+
+
+def json_lignes(modeles: Iterable[BaseModel]) -> bytes:
+    """Sérialiser des modèles en NDJSON"""
+    return b"".join(m.model_dump_json().encode() + b"\n" for m in modeles)
+
+
+async def reponse_paginee(
+    request: Request,
+    lire: Callable[[Union[UUID, None], int], Sequence[BaseModel]],
+    apres: Union[UUID, None] = None,
+    limite: Union[int, None] = None,
+) -> Response:
+    """
+    Servir une liste d'enregistrements ordonnés par identificateur.
+
+    Avec une `limite`, une seule page est retournée et l'en-tête `Link`
+    donne la page suivante.  Sinon tout est diffusé par pages de
+    `TAILLE_PAGE` enregistrements.  La réponse est en NDJSON si le client
+    l'accepte.
+    """
+    ndjson = NDJSON in request.headers.get("accept", "")
+    media_type = NDJSON if ndjson else "application/json"
+    if limite is not None:
+        page = await run_in_threadpool(lire, apres, limite)
+        headers = {}
+        if len(page) == limite:
+            suivante = request.url.include_query_params(apres=page[-1].id)  # type: ignore
+            headers["Link"] = f'<{suivante}>; rel="next"'
+        contenu = json_lignes(page) if ndjson else json_liste(page)
+        return Response(contenu, media_type=media_type, headers=headers)
+
+    def pages() -> Iterator[bytes]:
+        curseur = apres
+        premiere = True
+        if not ndjson:
+            yield b"["
+        while True:
+            page: List[BaseModel] = list(lire(curseur, TAILLE_PAGE))
+            if ndjson:
+                yield json_lignes(page)
+            elif page:
+                yield (b"" if premiere else b",") + json_liste(page)[1:-1]
+                premiere = False
+            if len(page) < TAILLE_PAGE:
+                break
+            curseur = page[-1].id  # type: ignore
+        if not ndjson:
+            yield b"]"
+
+    return StreamingResponse(pages(), media_type=media_type)
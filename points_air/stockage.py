@@ -0,0 +1,1268 @@
+"""Stockage des données des utilisateurs de Points-Air.
+
+Deux implantations sont disponibles: une base SQLite (en mode WAL)
+avec des index sur les champs interrogés, et l'ancienne disposition en
+fichiers JSON (un fichier par enregistrement) conservée pour
+compatibilité.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import urllib.parse
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple, TypeVar, Union
+from uuid import UUID
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None  # type: ignore
+
+from .especes import Observation
+from .plateaux import Plateau, boite_wgs84, plus_proches
+from .tuiles import Boite, plage, tuile, tuiles
+from .user import Activite, Utilisateur
+
+LOGGER = logging.getLogger("points-air-stockage")
+M = TypeVar("M")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activites (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    plateau TEXT NOT NULL,
+    date TEXT NOT NULL,
+    confirme INTEGER NOT NULL,
+    json TEXT NOT NULL
+);
+DROP INDEX IF EXISTS activites_user;
+CREATE INDEX IF NOT EXISTS activites_user_id ON activites(user, id);
+CREATE INDEX IF NOT EXISTS activites_plateau ON activites(plateau);
+CREATE INDEX IF NOT EXISTS activites_date ON activites(date);
+CREATE TABLE IF NOT EXISTS compteurs (
+    ville TEXT NOT NULL,
+    confirme INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    PRIMARY KEY (ville, confirme)
+);
+CREATE TABLE IF NOT EXISTS cumuls (
+    sport TEXT NOT NULL,
+    jour TEXT NOT NULL,
+    ville TEXT NOT NULL,
+    confirme INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (sport, jour, ville, confirme)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS densites (
+    z INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    code_espece TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (z, x, y, code_espece)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    cle TEXT PRIMARY KEY,
+    valeur
+);
+CREATE TABLE IF NOT EXISTS observations (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    code_espece TEXT NOT NULL,
+    date TEXT NOT NULL,
+    longitude REAL NOT NULL,
+    latitude REAL NOT NULL,
+    json TEXT NOT NULL
+);
+DROP INDEX IF EXISTS observations_user;
+CREATE INDEX IF NOT EXISTS observations_user_id ON observations(user, id);
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    nom TEXT NOT NULL UNIQUE,
+    json TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS observations_rtree
+    USING rtree(id, minx, maxx, miny, maxy);
+CREATE TRIGGER IF NOT EXISTS observations_insert AFTER INSERT ON observations
+BEGIN
+    INSERT INTO observations_rtree VALUES (
+        new.rowid, new.longitude, new.longitude, new.latitude, new.latitude
+    );
+END;
+CREATE TRIGGER IF NOT EXISTS observations_update AFTER UPDATE ON observations
+BEGIN
+    UPDATE observations_rtree
+    SET minx = new.longitude, maxx = new.longitude,
+        miny = new.latitude, maxy = new.latitude
+    WHERE id = new.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS observations_delete AFTER DELETE ON observations
+BEGIN
+    DELETE FROM observations_rtree WHERE id = old.rowid;
+END;
+"""
+Compteurs = Dict[Tuple[str, bool], int]
+# Cumuls quotidiens du palmarès par (sport, jour, ville, confirmé), où le
+# sport TOUS compte chaque activité une seule fois quels que soient ses sports
+Cumuls = Dict[Tuple[str, str, str, bool], int]
+TOUS = "*"
+# Nombre d'observations par tuile (z, x, y) et espèce, à tous les niveaux
+Densites = Dict[Tuple[int, int, int, str], int]
+
+
+def filtrer(
+    enregistrements: Iterable[M], user: Union[UUID, None], limite: Union[int, None]
+) -> Iterator[M]:
+    """Garder au plus `limite` enregistrements d'un utilisateur"""
+    if limite is not None and limite <= 0:
+        return
+    n = 0
+    for e in enregistrements:
+        if user is not None and e.user != user:  # type: ignore
+            continue
+        yield e
+        n += 1
+        if n == limite:
+            return
+
+
+class NomPris(ValueError):
+    """Le nom d'utilisateur est déjà pris par un autre utilisateur"""
+
+
+def ecrire_fichiers(fichiers: Iterable[Tuple[Path, str]]) -> None:
+    """
+    Écrire des fichiers atomiquement et durablement: chacun est écrit
+    et synchronisé sous un nom temporaire, puis renommé, et chaque
+    répertoire touché n'est synchronisé qu'une fois pour tout le lot.
+    """
+    contenus = dict(fichiers)  # La dernière écriture d'un fichier gagne
+    pid = os.getpid()  # Noms temporaires distincts entre processus
+    for path, contenu in contenus.items():
+        tmppath = path.with_name(f".{path.name}.{pid}.tmp")
+        with open(tmppath, "wt") as outfh:
+            outfh.write(contenu)
+            outfh.flush()
+            os.fsync(outfh.fileno())
+    for path in contenus:
+        os.replace(path.with_name(f".{path.name}.{pid}.tmp"), path)
+    for repertoire in {path.parent for path in contenus}:
+        fd = os.open(repertoire, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def ecrire_atomique(path: Path, contenu: str) -> None:
+    """Écrire un fichier en le remplaçant atomiquement"""
+    ecrire_fichiers([(path, contenu)])
+
+
+def credit(activite: Union[Activite, None]) -> Union[Tuple[str, bool], None]:
+    """Ville (et statut) à qui une activité donne un crédit"""
+    if activite is None:
+        return None
+    return credit_plateau(activite.plateau, activite.confirme)
+
+
+def credit_plateau(plateau: UUID, confirme: bool) -> Union[Tuple[str, bool], None]:
+    """Ville (et statut) à qui une activité sur un plateau donne un crédit"""
+    ville = Plateau.ville_de(plateau)
+    if ville is None:
+        return None
+    return (ville, bool(confirme))
+
+
+def compter(activites: Iterable[Activite]) -> Compteurs:
+    """Calculer les compteurs du palmarès à partir des activités"""
+    compteurs: Compteurs = {}
+    for act in activites:
+        cle = credit(act)
+        if cle is not None:
+            compteurs[cle] = compteurs.get(cle, 0) + 1
+    return compteurs
+
+
+def cases(activite: Union[Activite, None]) -> List[Tuple[str, str, str, bool]]:
+    """Cases des cumuls quotidiens auxquelles une activité contribue"""
+    cle = credit(activite)
+    if cle is None:
+        return []
+    assert activite is not None
+    ville, confirme = cle
+    jour = activite.date.date().isoformat()
+    return [
+        (sport, jour, ville, confirme) for sport in (TOUS, *sorted(set(activite.sport)))
+    ]
+
+
+def cumuler(activites: Iterable[Activite]) -> Cumuls:
+    """Calculer les cumuls quotidiens du palmarès à partir des activités"""
+    cumuls: Cumuls = {}
+    for act in activites:
+        for cle in cases(act):
+            cumuls[cle] = cumuls.get(cle, 0) + 1
+    return cumuls
+
+
+def scores_cumuls(
+    cumuls: Cumuls,
+    confirme: bool = False,
+    debut: Union[datetime.date, None] = None,
+    fin: Union[datetime.date, None] = None,
+    sport: Union[str, None] = None,
+) -> Dict[str, int]:
+    """Scores par ville sur les jours de `debut` à `fin` (exclue) et un sport"""
+    sport = TOUS if sport is None else sport
+    premier = "" if debut is None else debut.isoformat()
+    dernier = None if fin is None else fin.isoformat()
+    scores: Dict[str, int] = {}
+    for (s, jour, ville, conf), n in cumuls.items():
+        if s != sport or jour < premier or (dernier is not None and jour >= dernier):
+            continue
+        if conf or not confirme:
+            scores[ville] = scores.get(ville, 0) + n
+    return {ville: n for ville, n in scores.items() if n}
+
+
+def par_periode(
+    debut: Union[datetime.date, None],
+    fin: Union[datetime.date, None],
+    sport: Union[str, None],
+) -> bool:
+    """Le palmarès demandé doit-il être calculé à partir des cumuls?"""
+    return debut is not None or fin is not None or sport is not None
+
+
+def scores(compteurs: Compteurs, confirme: bool = False) -> Dict[str, int]:
+    """Scores par ville, de toutes les activités ou seulement celles confirmées"""
+    scores: Dict[str, int] = {}
+    for (ville, conf), n in compteurs.items():
+        if conf or not confirme:
+            scores[ville] = scores.get(ville, 0) + n
+    return scores
+
+
+def garder_photos(
+    obs: Observation, ancienne: Union[Observation, None]
+) -> Observation:
+    """Observation mise à jour gardant les photos déjà associées"""
+    if ancienne is None or not ancienne.photos:
+        return obs
+    photos = [*ancienne.photos, *(p for p in obs.photos if p not in ancienne.photos)]
+    return obs.model_copy(update={"photos": photos})
+
+
+def tuiles_observation(
+    obs: Union[Observation, None]
+) -> List[Tuple[int, int, int, str]]:
+    """Tuiles (et espèce) auxquelles une observation contribue"""
+    if obs is None:
+        return []
+    longitude, latitude = obs.emplacement.coordinates[:2]
+    return [(*t, obs.code_espece) for t in tuiles(longitude, latitude)]
+
+
+def densites_boite(
+    obss: Iterable[Observation],
+    z: int,
+    boite: Boite,
+    codes: Union[Iterable[str], None] = None,
+) -> Densites:
+    """Nombre d'observations par tuile au niveau `z` dans une boîte"""
+    xmin, xmax, ymin, ymax = plage(boite, z)
+    especes = None if codes is None else set(codes)
+    densites: Densites = {}
+    for obs in obss:
+        if especes is not None and obs.code_espece not in especes:
+            continue
+        longitude, latitude = obs.emplacement.coordinates[:2]
+        x, y = tuile(longitude, latitude, z)
+        if xmin <= x <= xmax and ymin <= y <= ymax:
+            cle = (z, x, y, obs.code_espece)
+            densites[cle] = densites.get(cle, 0) + 1
+    return densites
+
+
+def proches(
+    latitude: float,
+    longitude: float,
+    obss: List[Observation],
+    proximite: float,
+    limite: int,
+) -> List[Tuple[float, Observation]]:
+    """Sélectionner les observations les plus proches parmi des candidates"""
+    coords = np.array(
+        [obs.emplacement.coordinates for obs in obss], dtype=float
+    ).reshape(-1, 2)
+    idx, distances = plus_proches(
+        latitude, longitude, coords[:, 0], coords[:, 1], proximite, limite
+    )
+    return [(float(dist), obss[i]) for i, dist in zip(idx, distances)]
+
+
+class Stockage(ABC):
+    """
+    Interface commune des moteurs de stockage.
+    """
+
+    def __init__(self, datadir: Path):
+        self.datadir = datadir
+
+    @abstractmethod
+    def put_activite(self, activite: Activite) -> None:
+        """Créer ou mettre à jour une activité"""
+        raise NotImplementedError
+
+    def put_activites(self, activites: Iterable[Activite]) -> None:
+        """Créer ou mettre à jour plusieurs activités"""
+        for activite in activites:
+            self.put_activite(activite)
+
+    @abstractmethod
+    def get_activite(self, id: UUID) -> Union[Activite, None]:
+        """Obtenir une activité par identificateur"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def activites(
+        self,
+        user: Union[UUID, None] = None,
+        apres: Union[UUID, None] = None,
+        limite: Union[int, None] = None,
+    ) -> Iterator[Activite]:
+        """
+        Parcourir les activités, optionnellement d'un seul utilisateur,
+        par ordre d'identificateur à partir de `apres` (exclus).
+        """
+        raise NotImplementedError
+
+    def scores(
+        self,
+        confirme: bool = False,
+        debut: Union[datetime.date, None] = None,
+        fin: Union[datetime.date, None] = None,
+        sport: Union[str, None] = None,
+    ) -> Dict[str, int]:
+        """
+        Nombre d'activités (optionnellement confirmées) par ville, depuis
+        toujours ou seulement du jour `debut` au jour `fin` (exclu), et
+        optionnellement d'un seul sport.
+        """
+        if par_periode(debut, fin, sport):
+            return scores_cumuls(
+                cumuler(self.activites()), confirme, debut, fin, sport
+            )
+        return scores(compter(self.activites()), confirme)
+
+    @abstractmethod
+    def put_observation(self, obs: Observation) -> None:
+        """Créer ou mettre à jour une observation"""
+        raise NotImplementedError
+
+    def put_observations(self, obss: Iterable[Observation]) -> None:
+        """Créer ou mettre à jour plusieurs observations"""
+        for obs in obss:
+            self.put_observation(obs)
+
+    @abstractmethod
+    def get_observation(self, id: UUID) -> Union[Observation, None]:
+        """Obtenir une observation par identificateur"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def ajouter_photo(self, id: UUID, photo: str) -> Union[Observation, None]:
+        """
+        Associer une photo à une observation (None si elle n'existe pas).
+        Les photos déjà associées sont gardées par `put_observations`.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def observations(
+        self,
+        user: Union[UUID, None] = None,
+        apres: Union[UUID, None] = None,
+        limite: Union[int, None] = None,
+    ) -> Iterator[Observation]:
+        """
+        Parcourir les observations, optionnellement d'un seul utilisateur,
+        par ordre d'identificateur à partir de `apres` (exclus).
+        """
+        raise NotImplementedError
+
+    def observations_proches(
+        self,
+        latitude: float,
+        longitude: float,
+        proximite: float = 10,
+        limite: int = 10,
+        code_espece: Union[str, None] = None,
+        debut: Union[datetime.datetime, None] = None,
+        fin: Union[datetime.datetime, None] = None,
+    ) -> List[Tuple[float, Observation]]:
+        """Observations à proximité d'un emplacement et leurs distances"""
+        obss = [
+            obs
+            for obs in self.observations()
+            if (code_espece is None or obs.code_espece == code_espece)
+            and (debut is None or obs.date >= debut)
+            and (fin is None or obs.date < fin)
+        ]
+        return proches(latitude, longitude, obss, proximite, limite)
+
+    def densites(
+        self, z: int, boite: Boite, codes: Union[Iterable[str], None] = None
+    ) -> Densites:
+        """
+        Nombre d'observations par tuile au niveau `z` dans une boîte (ouest,
+        sud, est, nord) et par espèce, optionnellement de certaines espèces.
+        """
+        return densites_boite(self.observations(), z, boite, codes)
+
+    @abstractmethod
+    def put_user(self, user: Utilisateur) -> None:
+        """Créer ou mettre à jour un utilisateur (NomPris si le nom est pris)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_user(self, id: UUID) -> Union[Utilisateur, None]:
+        """Obtenir un utilisateur par identificateur"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_user_nom(self, nom: str) -> Union[Utilisateur, None]:
+        """Obtenir un utilisateur par nom"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def users(self) -> Iterator[Utilisateur]:
+        """Parcourir les utilisateurs"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Fermer le stockage"""
+        pass
+
+
+class StockageFichiers(Stockage):
+    """
+    Stockage en fichiers JSON (ancienne disposition).
+
+    Les compteurs du palmarès et ses cumuls quotidiens sont tenus en
+    mémoire et sauvegardés dans `palmares.json`, qui est validé contre les
+    fichiers d'activités à l'ouverture.
+
+    L'index des noms d'utilisateurs est un répertoire `users/noms` avec
+    un fichier par nom contenant l'identificateur.  Une entrée n'est
+    valide que si le fichier de l'utilisateur porte le même nom, ce qui
+    garde l'index cohérent même après un plantage en cours d'écriture.
+
+    Plusieurs processus peuvent partager un DATADIR: les écritures des
+    activités et des utilisateurs sont sérialisées par un verrou sur
+    `.verrou`, et chaque processus recharge les compteurs lorsque
+    `palmares.json` a été remplacé par un autre.
+    """
+
+    def __init__(self, datadir: Path):
+        super().__init__(datadir)
+        datadir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # Version (inode, mtime) de palmares.json en mémoire
+        self.version = (0, 0)
+        with self.verrou():
+            self.nactivites, self.mtime = self.etat_activites()
+            self.compteurs, self.cumuls = self.charger_compteurs()
+            self.indexer_noms()
+
+    @contextmanager
+    def verrou(self) -> Iterator[None]:
+        """Verrou exclusif entre fils d'exécution et entre processus"""
+        with self.lock, open(self.datadir / ".verrou", "ab") as fh:
+            if fcntl is not None:
+                fcntl.flock(fh, fcntl.LOCK_EX)  # Libéré à la fermeture
+            yield
+
+    def version_palmares(self) -> Tuple[int, int]:
+        """Version (inode, mtime) de palmares.json"""
+        try:
+            st = os.stat(self.datadir / "palmares.json")
+        except FileNotFoundError:
+            return (0, 0)
+        return (st.st_ino, st.st_mtime_ns)
+
+    def lire_palmares(self) -> Tuple[int, int, Compteurs, Cumuls]:
+        """Lire l'état des activités, les compteurs et les cumuls sauvegardés"""
+        with open(self.datadir / "palmares.json", "rt") as infh:
+            snapshot = json.load(infh)
+        return (
+            snapshot["activites"],
+            snapshot["mtime"],
+            {
+                (ville, confirme): score
+                for ville, confirme, score in snapshot["compteurs"]
+            },
+            {
+                (sport, jour, ville, confirme): score
+                for sport, jour, ville, confirme, score in snapshot["cumuls"]
+            },
+        )
+
+    def rafraichir(self) -> None:
+        """Recharger les compteurs sauvegardés entretemps par un autre processus"""
+        version = self.version_palmares()
+        if version == self.version:
+            return
+        try:
+            etat = self.lire_palmares()
+        except (FileNotFoundError, ValueError, KeyError):
+            return
+        self.nactivites, self.mtime, self.compteurs, self.cumuls = etat
+        self.version = version
+
+    def etat_activites(self) -> Tuple[int, int]:
+        """Nombre de fichiers d'activités et leur dernière modification"""
+        acdir = self.datadir / "activites"
+        if not acdir.exists():
+            return 0, 0
+        n = mtime = 0
+        for entry in os.scandir(acdir):
+            if entry.name.endswith(".json"):
+                n += 1
+                mtime = max(mtime, entry.stat().st_mtime_ns)
+        return n, mtime
+
+    def charger_compteurs(self) -> Tuple[Compteurs, Cumuls]:
+        """Charger les compteurs et cumuls sauvegardés s'ils sont à jour"""
+        n, mtime = self.nactivites, self.mtime
+        try:
+            version = self.version_palmares()
+            nsauve, mtimesauve, compteurs, cumuls = self.lire_palmares()
+            if nsauve == n and mtimesauve >= mtime:
+                self.version = version
+                return compteurs, cumuls
+            LOGGER.warning("Compteurs du palmarès périmés, recalcul")
+        except FileNotFoundError:
+            if n:
+                LOGGER.info("Compteurs du palmarès absents, calcul")
+        except (ValueError, KeyError):
+            LOGGER.warning("Compteurs du palmarès illisibles, recalcul")
+        activites = list(self.activites())
+        compteurs, cumuls = compter(activites), cumuler(activites)
+        self.sauver_compteurs(compteurs, cumuls, n, mtime)
+        return compteurs, cumuls
+
+    def sauver_compteurs(
+        self, compteurs: Compteurs, cumuls: Cumuls, n: int, mtime: int
+    ) -> None:
+        """Sauvegarder les compteurs et cumuls avec l'état des activités"""
+        self.datadir.mkdir(parents=True, exist_ok=True)
+        snapshot = {
+            "activites": n,
+            "mtime": mtime,
+            "compteurs": [[v, c, s] for (v, c), s in compteurs.items()],
+            "cumuls": [[*cle, s] for cle, s in cumuls.items()],
+        }
+        ecrire_atomique(self.datadir / "palmares.json", json.dumps(snapshot))
+        self.version = self.version_palmares()
+
+    def put_activite(self, activite: Activite) -> None:
+        self.put_activites([activite])
+
+    def put_activites(self, activites: Iterable[Activite]) -> None:
+        acdir = self.datadir / "activites"
+        acdir.mkdir(parents=True, exist_ok=True)
+        with self.verrou():
+            self.rafraichir()
+            # Compteurs modifiés seulement si les écritures réussissent
+            compteurs, n, mtime = dict(self.compteurs), self.nactivites, self.mtime
+            cumuls = dict(self.cumuls)
+            lot: Dict[UUID, Activite] = {}
+            for activite in activites:
+                if activite.id in lot:
+                    ancien: Union[Activite, None] = lot[activite.id]
+                else:
+                    ancien = self.get_activite(activite.id)
+                for cle, delta in ((credit(ancien), -1), (credit(activite), 1)):
+                    if cle is not None:
+                        compteurs[cle] = compteurs.get(cle, 0) + delta
+                for case in cases(ancien):
+                    cumuls[case] = cumuls.get(case, 0) - 1
+                    if cumuls[case] == 0:
+                        del cumuls[case]
+                for case in cases(activite):
+                    cumuls[case] = cumuls.get(case, 0) + 1
+                if ancien is None:
+                    n += 1
+                lot[activite.id] = activite
+            if not lot:
+                return
+            paths = [acdir / f"{id}.json" for id in lot]
+            ecrire_fichiers(
+                (path, act.model_dump_json(indent=2) + "\n")
+                for path, act in zip(paths, lot.values())
+            )
+            for path in paths:
+                mtime = max(mtime, path.stat().st_mtime_ns)
+            self.compteurs, self.nactivites, self.mtime = compteurs, n, mtime
+            self.cumuls = cumuls
+            self.sauver_compteurs(compteurs, cumuls, n, mtime)
+
+    def scores(
+        self,
+        confirme: bool = False,
+        debut: Union[datetime.date, None] = None,
+        fin: Union[datetime.date, None] = None,
+        sport: Union[str, None] = None,
+    ) -> Dict[str, int]:
+        with self.lock:
+            self.rafraichir()
+            if par_periode(debut, fin, sport):
+                return scores_cumuls(self.cumuls, confirme, debut, fin, sport)
+            return scores(self.compteurs, confirme)
+
+    def get_activite(self, id: UUID) -> Union[Activite, None]:
+        acpath = self.datadir / "activites" / f"{id}.json"
+        try:
+            with open(acpath, "rt") as infh:
+                return Activite.model_validate_json(infh.read())
+        except FileNotFoundError:
+            return None
+
+    def activites(
+        self,
+        user: Union[UUID, None] = None,
+        apres: Union[UUID, None] = None,
+        limite: Union[int, None] = None,
+    ) -> Iterator[Activite]:
+        # FIXME: Faut clairement une vraie DB!!! (d'où StockageSQLite)
+        acts = (
+            Activite.model_validate_json(data)
+            for data in self.lire_repertoire(self.datadir / "activites", apres)
+        )
+        yield from filtrer(acts, user, limite)
+
+    def put_observation(self, obs: Observation) -> None:
+        self.put_observations([obs])
+
+    def put_observations(self, obss: Iterable[Observation]) -> None:
+        obdir = self.datadir / "observations"
+        obdir.mkdir(parents=True, exist_ok=True)
+        with self.verrou():
+            # Les photos déjà associées sont relues sous le verrou
+            obss = (garder_photos(obs, self.get_observation(obs.id)) for obs in obss)
+            ecrire_fichiers(
+                (obdir / f"{obs.id}.json", obs.model_dump_json(indent=2) + "\n")
+                for obs in obss
+            )
+
+    def ajouter_photo(self, id: UUID, photo: str) -> Union[Observation, None]:
+        with self.verrou():
+            obs = self.get_observation(id)
+            if obs is not None and photo not in obs.photos:
+                obs = obs.model_copy(update={"photos": [*obs.photos, photo]})
+                ecrire_atomique(
+                    self.datadir / "observations" / f"{id}.json",
+                    obs.model_dump_json(indent=2) + "\n",
+                )
+            return obs
+
+    def get_observation(self, id: UUID) -> Union[Observation, None]:
+        obpath = self.datadir / "observations" / f"{id}.json"
+        try:
+            with open(obpath, "rt") as infh:
+                return Observation.model_validate_json(infh.read())
+        except FileNotFoundError:
+            return None
+
+    def observations(
+        self,
+        user: Union[UUID, None] = None,
+        apres: Union[UUID, None] = None,
+        limite: Union[int, None] = None,
+    ) -> Iterator[Observation]:
+        obss = (
+            Observation.model_validate_json(data)
+            for data in self.lire_repertoire(self.datadir / "observations", apres)
+        )
+        yield from filtrer(obss, user, limite)
+
+    def lire_repertoire(
+        self, repertoire: Path, apres: Union[UUID, None] = None
+    ) -> Iterator[str]:
+        """Lire les fichiers JSON d'un répertoire par ordre de nom"""
+        if not repertoire.exists():
+            return
+        debut = "" if apres is None else f"{apres}.json"
+        noms = sorted(
+            entry.name
+            for entry in os.scandir(repertoire)
+            if entry.name.endswith(".json") and entry.name > debut
+        )
+        for nom in noms:
+            try:
+                with open(repertoire / nom, "rt") as infh:
+                    yield infh.read()
+            except FileNotFoundError:
+                continue  # Supprimé entretemps
+
+    def path_nom(self, nom: str) -> Path:
+        """Entrée de l'index des noms"""
+        return self.datadir / "users" / "noms" / urllib.parse.quote(nom, safe="")
+
+    def indexer_noms(self) -> None:
+        """Construire l'index des noms s'il n'existe pas"""
+        nomdir = self.datadir / "users" / "noms"
+        if nomdir.exists() or not (self.datadir / "users").exists():
+            return
+        LOGGER.info("Construction de l'index des noms d'utilisateurs")
+        nomdir.mkdir(parents=True)
+        for user in self.users():
+            path = self.path_nom(user.nom)
+            if path.exists():
+                LOGGER.warning("Nom d'utilisateur %s en double", user.nom)
+                continue
+            ecrire_atomique(path, str(user.id))
+
+    def id_nom(self, nom: str) -> Union[UUID, None]:
+        """Identificateur de l'utilisateur qui porte un nom"""
+        try:
+            with open(self.path_nom(nom), "rt") as infh:
+                id = UUID(infh.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+        user = self.get_user(id)
+        if user is None or user.nom != nom:
+            return None  # Entrée périmée
+        return id
+
+    def put_user(self, user: Utilisateur) -> None:
+        userpath = self.datadir / "users" / f"{user.id}.json"
+        nompath = self.path_nom(user.nom)
+        nompath.parent.mkdir(parents=True, exist_ok=True)
+        with self.verrou():
+            id = self.id_nom(user.nom)
+            if id is not None and id != user.id:
+                raise NomPris(f"Nom d'utilisateur {user.nom} déjà pris")
+            ancien = self.get_user(user.id)
+            # Réserver le nouveau nom, écrire l'utilisateur, libérer l'ancien
+            if id is None:
+                ecrire_atomique(nompath, str(user.id))
+            ecrire_atomique(userpath, user.model_dump_json(indent=2) + "\n")
+            if ancien is not None and ancien.nom != user.nom:
+                self.path_nom(ancien.nom).unlink(missing_ok=True)
+
+    def get_user(self, id: UUID) -> Union[Utilisateur, None]:
+        userpath = self.datadir / "users" / f"{id}.json"
+        try:
+            with open(userpath, "rt") as infh:
+                return Utilisateur.model_validate_json(infh.read())
+        except FileNotFoundError:
+            return None
+
+    def get_user_nom(self, nom: str) -> Union[Utilisateur, None]:
+        id = self.id_nom(nom)
+        if id is None:
+            return None
+        return self.get_user(id)
+
+    def users(self) -> Iterator[Utilisateur]:
+        userdir = self.datadir / "users"
+        if not userdir.exists():
+            return
+        for path in userdir.iterdir():
+            if path.suffix != ".json":
+                continue
+            with open(path, "rt") as infh:
+                yield Utilisateur.model_validate_json(infh.read())
+
+
+class StockageSQLite(Stockage):
+    """
+    Stockage dans une base SQLite en mode WAL.
+    """
+
+    def __init__(self, datadir: Path):
+        super().__init__(datadir)
+        datadir.mkdir(parents=True, exist_ok=True)
+        self.path = datadir / "points-air.sqlite3"
+        self.local = threading.local()
+        self.connections: List[sqlite3.Connection] = []
+        self.connections_lock = threading.Lock()
+        self.lock = threading.Lock()
+        db = self.db
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        self.verifier_compteurs()
+        self.verifier_densites()
+
+    def verifier_compteurs(self) -> None:
+        """Recalculer les compteurs s'ils ne correspondent pas aux activités"""
+        with self.transaction() as db:
+            (n,) = db.execute("SELECT COUNT(*) FROM activites").fetchone()
+            row = db.execute("SELECT valeur FROM meta WHERE cle = 'activites'").fetchone()
+            # Les cumuls sont absents d'une base créée avant leur ajout
+            cumuls_ok = n == 0 or db.execute("SELECT 1 FROM cumuls LIMIT 1").fetchone()
+            if row is None or row[0] != n or not cumuls_ok:
+                compteurs: Compteurs = {}
+                cumuls: Cumuls = {}
+                for plateau, confirme, jour, sports, count in db.execute(
+                    "SELECT plateau, confirme, substr(date, 1, 10) AS jour,"
+                    " json_extract(json, '$.sport') AS sports, COUNT(*)"
+                    " FROM activites GROUP BY plateau, confirme, jour, sports"
+                ):
+                    cle = credit_plateau(UUID(plateau), confirme)
+                    if cle is None:
+                        continue
+                    compteurs[cle] = compteurs.get(cle, 0) + count
+                    for sport in (TOUS, *sorted(set(json.loads(sports)))):
+                        case = (sport, jour, *cle)
+                        cumuls[case] = cumuls.get(case, 0) + count
+                anciens = {
+                    (ville, bool(confirme)): score
+                    for ville, confirme, score in db.execute(
+                        "SELECT ville, confirme, score FROM compteurs"
+                    )
+                }
+                if anciens != {k: v for k, v in compteurs.items() if v}:
+                    LOGGER.warning("Compteurs du palmarès périmés, recalcul")
+                db.execute("DELETE FROM compteurs")
+                db.execute("DELETE FROM cumuls")
+                db.execute("DELETE FROM meta WHERE cle = 'activites'")
+                self.ajouter_compteurs(compteurs, cumuls, n)
+
+    def ajouter_compteurs(
+        self, deltas: Compteurs, cumuls: Cumuls, nouveaux: int
+    ) -> None:
+        """Ajouter aux compteurs et aux cumuls (dans une transaction)"""
+        db = self.db
+        db.executemany(
+            "INSERT INTO compteurs (ville, confirme, score) VALUES (?, ?, ?)"
+            " ON CONFLICT (ville, confirme) DO UPDATE"
+            " SET score = score + excluded.score",
+            ((ville, confirme, n) for (ville, confirme), n in deltas.items() if n),
+        )
+        db.executemany(
+            "INSERT INTO cumuls (sport, jour, ville, confirme, n)"
+            " VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (sport, jour, ville, confirme) DO UPDATE"
+            " SET n = n + excluded.n",
+            ((*case, n) for case, n in cumuls.items() if n),
+        )
+        db.execute(
+            "INSERT INTO meta (cle, valeur) VALUES ('activites', ?)"
+            " ON CONFLICT (cle) DO UPDATE SET valeur = valeur + excluded.valeur",
+            (nouveaux,),
+        )
+
+    def verifier_densites(self) -> None:
+        """Recalculer les densités si elles ne correspondent pas aux observations"""
+        with self.transaction() as db:
+            (n,) = db.execute("SELECT COUNT(*) FROM observations").fetchone()
+            row = db.execute(
+                "SELECT valeur FROM meta WHERE cle = 'observations'"
+            ).fetchone()
+            if (0 if row is None else row[0]) != n:
+                LOGGER.warning("Densités des observations périmées, recalcul")
+                densites: Densites = {}
+                for code_espece, longitude, latitude, count in db.execute(
+                    "SELECT code_espece, longitude, latitude, COUNT(*)"
+                    " FROM observations GROUP BY code_espece, longitude, latitude"
+                ):
+                    for t in tuiles(longitude, latitude):
+                        cle = (*t, code_espece)
+                        densites[cle] = densites.get(cle, 0) + count
+                db.execute("DELETE FROM densites")
+                db.execute("DELETE FROM meta WHERE cle = 'observations'")
+                self.ajouter_densites(densites, n)
+
+    def ajouter_densites(self, deltas: Densites, nouvelles: int) -> None:
+        """Ajouter aux densités des observations (dans une transaction)"""
+        db = self.db
+        db.executemany(
+            "INSERT INTO densites (z, x, y, code_espece, n) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (z, x, y, code_espece) DO UPDATE SET n = n + excluded.n",
+            ((*cle, n) for cle, n in deltas.items() if n),
+        )
+        # Tuiles vidées par des déplacements
+        db.executemany(
+            "DELETE FROM densites"
+            " WHERE z = ? AND x = ? AND y = ? AND code_espece = ? AND n <= 0",
+            (cle for cle, n in deltas.items() if n < 0),
+        )
+        db.execute(
+            "INSERT INTO meta (cle, valeur) VALUES ('observations', ?)"
+            " ON CONFLICT (cle) DO UPDATE SET valeur = valeur + excluded.valeur",
+            (nouvelles,),
+        )
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """Connexion propre au fil d'exécution courant"""
+        db = getattr(self.local, "db", None)
+        if db is None:
+            # Utilisée par un seul fil, mais fermée par close()
+            db = sqlite3.connect(
+                self.path, isolation_level=None, timeout=30, check_same_thread=False
+            )
+            # Chaque COMMIT est durable, l'écrivain les regroupe
+            db.execute("PRAGMA synchronous=FULL")
+            with self.connections_lock:
+                self.connections.append(db)
+            self.local.db = db
+        return db
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Transaction d'écriture (sérialisée entre les fils d'exécution)"""
+        db = self.db
+        with self.lock:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def put_activite(self, activite: Activite) -> None:
+        self.put_activites([activite])
+
+    def put_activites(self, activites: Iterable[Activite]) -> None:
+        with self.transaction() as db:
+            deltas: Compteurs = {}
+            cumuls: Cumuls = {}
+            nouveaux = 0
+            for act in activites:
+                row = db.execute(
+                    "SELECT json FROM activites WHERE id = ?", (str(act.id),)
+                ).fetchone()
+                if row is None:
+                    nouveaux += 1
+                    ancien = None
+                else:
+                    ancien = Activite.model_validate_json(row[0])
+                for cle, delta in ((credit(ancien), -1), (credit(act), 1)):
+                    if cle is not None:
+                        deltas[cle] = deltas.get(cle, 0) + delta
+                for ancienne, nouvelle in ((ancien, -1), (act, 1)):
+                    for case in cases(ancienne):
+                        cumuls[case] = cumuls.get(case, 0) + nouvelle
+                db.execute(
+                    "INSERT OR REPLACE INTO activites"
+                    " (id, user, plateau, date, confirme, json)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        str(act.id),
+                        str(act.user),
+                        str(act.plateau),
+                        act.date.isoformat(),
+                        act.confirme,
+                        act.model_dump_json(),
+                    ),
+                )
+            self.ajouter_compteurs(deltas, cumuls, nouveaux)
+
+    def get_activite(self, id: UUID) -> Union[Activite, None]:
+        row = self.db.execute(
+            "SELECT json FROM activites WHERE id = ?", (str(id),)
+        ).fetchone()
+        if row is None:
+            return None
+        return Activite.model_validate_json(row[0])
+
+    def activites(
+        self,
+        user: Union[UUID, None] = None,
+        apres: Union[UUID, None] = None,
+        limite: Union[int, None] = None,
+    ) -> Iterator[Activite]:
+        for data in self.parcourir("activites", user, apres, limite):
+            yield Activite.model_validate_json(data)
+
+    def scores(
+        self,
+        confirme: bool = False,
+        debut: Union[datetime.date, None] = None,
+        fin: Union[datetime.date, None] = None,
+        sport: Union[str, None] = None,
+    ) -> Dict[str, int]:
+        if par_periode(debut, fin, sport):
+            # Somme sur les cases (sport, jour) plutôt que sur les activités
+            sql = "SELECT ville, SUM(n) FROM cumuls WHERE sport = ?"
+            params: List[Union[str, int]] = [TOUS if sport is None else sport]
+            if debut is not None:
+                sql += " AND jour >= ?"
+                params.append(debut.isoformat())
+            if fin is not None:
+                sql += " AND jour < ?"
+                params.append(fin.isoformat())
+            if confirme:
+                sql += " AND confirme = 1"
+            sql += " GROUP BY ville HAVING SUM(n) != 0"
+            return dict(self.db.execute(sql, params).fetchall())
+        compteurs = {
+            (ville, bool(conf)): score
+            for ville, conf, score in self.db.execute(
+                "SELECT ville, confirme, score FROM compteurs"
+            )
+        }
+        return scores(compteurs, confirme)
+
+    def put_observation(self, obs: Observation) -> None:
+        self.put_observations([obs])
+
+    def put_observations(self, obss: Iterable[Observation]) -> None:
+        with self.transaction() as db:
+            # Une seule version par observation dans un lot: la dernière gagne
+            obss = list({obs.id: obs for obs in obss}.values())
+            deltas: Densites = {}
+            nouvelles = 0
+            for i, obs in enumerate(obss):
+                row = db.execute(
+                    "SELECT json FROM observations WHERE id = ?", (str(obs.id),)
+                ).fetchone()
+                if row is None:
+                    nouvelles += 1
+                    ancienne = None
+                else:
+                    ancienne = Observation.model_validate_json(row[0])
+                obss[i] = obs = garder_photos(obs, ancienne)
+                # Une observation déplacée (ou corrigée) change de tuiles
+                for o, delta in ((ancienne, -1), (obs, 1)):
+                    for cle in tuiles_observation(o):
+                        deltas[cle] = deltas.get(cle, 0) + delta
+            # Pas de INSERT OR REPLACE pour garder le rowid (et l'index R*Tree)
+            db.executemany(
+                "INSERT INTO observations"
+                " (id, user, code_espece, date, longitude, latitude, json)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (id) DO UPDATE SET"
+                " user = excluded.user, code_espece = excluded.code_espece,"
+                " date = excluded.date, longitude = excluded.longitude,"
+                " latitude = excluded.latitude, json = excluded.json",
+                (
+                    (
+                        str(obs.id),
+                        str(obs.user),
+                        obs.code_espece,
+                        obs.date.isoformat(),
+                        obs.emplacement.coordinates[0],
+                        obs.emplacement.coordinates[1],
+                        obs.model_dump_json(),
+                    )
+                    for obs in obss
+                ),
+            )
+            self.ajouter_densites(deltas, nouvelles)
+
+    def get_observation(self, id: UUID) -> Union[Observation, None]:
+        row = self.db.execute(
+            "SELECT json FROM observations WHERE id = ?", (str(id),)
+        ).fetchone()
+        if row is None:
+            return None
+        return Observation.model_validate_json(row[0])
+
+    def ajouter_photo(self, id: UUID, photo: str) -> Union[Observation, None]:
+        with self.transaction() as db:
+            obs = self.get_observation(id)
+            if obs is not None and photo not in obs.photos:
+                obs = obs.model_copy(update={"photos": [*obs.photos, photo]})
+                db.execute(
+                    "UPDATE observations SET json = ? WHERE id = ?",
+                    (obs.model_dump_json(), str(id)),
+                )
+            return obs
+
+    def observations(
+        self,
+        user: Union[UUID, None] = None,
+        apres: Union[UUID, None] = None,
+        limite: Union[int, None] = None,
+    ) -> Iterator[Observation]:
+        for data in self.parcourir("observations", user, apres, limite):
+            yield Observation.model_validate_json(data)
+
+    def parcourir(
+        self,
+        table: str,
+        user: Union[UUID, None] = None,
+        apres: Union[UUID, None] = None,
+        limite: Union[int, None] = None,
+    ) -> Iterator[str]:
+        """Parcourir une table par ordre d'identificateur"""
+        sql = f"SELECT json FROM {table}"
+        conditions: List[str] = []
+        params: List[Union[str, int]] = []
+        if user is not None:
+            conditions.append("user = ?")
+            params.append(str(user))
+        if apres is not None:
+            conditions.append("id > ?")
+            params.append(str(apres))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY id"
+        if limite is not None:
+            sql += " LIMIT ?"
+            params.append(limite)
+        for (data,) in self.db.execute(sql, params):
+            yield data
+
+    def observations_proches(
+        self,
+        latitude: float,
+        longitude: float,
+        proximite: float = 10,
+        limite: int = 10,
+        code_espece: Union[str, None] = None,
+        debut: Union[datetime.datetime, None] = None,
+        fin: Union[datetime.datetime, None] = None,
+    ) -> List[Tuple[float, Observation]]:
+        minx, miny, maxx, maxy = boite_wgs84(latitude, longitude, proximite)
+        sql = (
+            "SELECT o.json FROM observations_rtree r"
+            " JOIN observations o ON o.rowid = r.id"
+            " WHERE r.maxx >= ? AND r.minx <= ? AND r.maxy >= ? AND r.miny <= ?"
+        )
+        params: List[Union[str, float]] = [minx, maxx, miny, maxy]
+        if code_espece is not None:
+            sql += " AND o.code_espece = ?"
+            params.append(code_espece)
+        if debut is not None:
+            sql += " AND o.date >= ?"
+            params.append(debut.isoformat())
+        if fin is not None:
+            sql += " AND o.date < ?"
+            params.append(fin.isoformat())
+        obss = [
+            Observation.model_validate_json(data)
+            for (data,) in self.db.execute(sql, params)
+        ]
+        return proches(latitude, longitude, obss, proximite, limite)
+
+    def densites(
+        self, z: int, boite: Boite, codes: Union[Iterable[str], None] = None
+    ) -> Densites:
+        xmin, xmax, ymin, ymax = plage(boite, z)
+        sql = (
+            "SELECT z, x, y, code_espece, n FROM densites"
+            " WHERE z = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?"
+        )
+        params: List[Union[int, str]] = [z, xmin, xmax, ymin, ymax]
+        if codes is not None:
+            codes = list(codes)
+            sql += f" AND code_espece IN ({', '.join('?' * len(codes))})"
+            params.extend(codes)
+        return {
+            (z, x, y, code_espece): n
+            for z, x, y, code_espece, n in self.db.execute(sql, params)
+        }
+
+    def put_user(self, user: Utilisateur) -> None:
+        try:
+            with self.transaction() as db:
+                db.execute(
+                    "INSERT INTO users (id, nom, json) VALUES (?, ?, ?)"
+                    " ON CONFLICT (id) DO UPDATE"
+                    " SET nom = excluded.nom, json = excluded.json",
+                    (str(user.id), user.nom, user.model_dump_json()),
+                )
+        except sqlite3.IntegrityError:
+            raise NomPris(f"Nom d'utilisateur {user.nom} déjà pris")
+
+    def get_user(self, id: UUID) -> Union[Utilisateur, None]:
+        row = self.db.execute(
+            "SELECT json FROM users WHERE id = ?", (str(id),)
+        ).fetchone()
+        if row is None:
+            return None
+        return Utilisateur.model_validate_json(row[0])
+
+    def get_user_nom(self, nom: str) -> Union[Utilisateur, None]:
+        row = self.db.execute("SELECT json FROM users WHERE nom = ?", (nom,)).fetchone()
+        if row is None:
+            return None
+        return Utilisateur.model_validate_json(row[0])
+
+    def users(self) -> Iterator[Utilisateur]:
+        for (data,) in self.db.execute("SELECT json FROM users"):
+            yield Utilisateur.model_validate_json(data)
+
+    def close(self) -> None:
+        with self.connections_lock:
+            for db in self.connections:
+                db.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+
+MOTEURS = {
+    "fichiers": StockageFichiers,
+    "sqlite": StockageSQLite,
+}
+
+
+def ouvrir(moteur: str, datadir: Path) -> Stockage:
+    """Ouvrir un stockage selon le nom de son moteur"""
+    try:
+        cls = MOTEURS[moteur]
+    except KeyError:
+        raise ValueError(
+            f"Moteur de stockage {moteur} inconnu (choix: {', '.join(MOTEURS)})"
+        )
+    return cls(datadir)
+
+
+def migrer(source: Stockage, dest: Stockage) -> int:
+    """Copier toutes les données d'un stockage à l'autre"""
+    n = 0
+
+    def compter(enregistrements: Iterable[M]) -> Iterator[M]:
+        nonlocal n
+        for e in enregistrements:
+            n += 1
+            yield e
+
+    dest.put_activites(compter(source.activites()))
+    dest.put_observations(compter(source.observations()))
+    for user in source.users():
+        try:
+            dest.put_user(user)
+            n += 1
+        except NomPris:
+            LOGGER.warning("Nom d'utilisateur %s en double, %s ignoré", user.nom, user.id)
+    return n
+
+
+def main():
+    """Importer les fichiers JSON existants dans la base SQLite."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "datadir", help="Répertoire de données", type=Path, nargs="?", default="data"
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="Informations verboses pour debug", action="store_true"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    source = StockageFichiers(args.datadir)
+    dest = StockageSQLite(args.datadir)
+    n = migrer(source, dest)
+    dest.close()
+    LOGGER.info("%d enregistrements importés dans %s", n, dest.path)
+
+
+if __name__ == "__main__":
+    main()
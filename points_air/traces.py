@@ -0,0 +1,243 @@
+"""Traces GPS (GPX ou GeoJSON) pour confirmer les activités.
+
+Les points d'une trace GPX sont lus au fur et à mesure de la réception
+du fichier, sans en construire l'arbre, puis testés d'un coup contre la
+géométrie préparée du plateau avec `shapely.contains_xy`.
+
+Une activité est confirmée si au moins `couverture_min` des points de
+la trace sont sur le plateau et si le temps passé sur le plateau (entre
+deux points consécutifs dedans, selon leurs heures) atteint `duree_min`
+secondes.  Sans heures (p.ex. une trace GPX sans `<time>`), seule la
+couverture est vérifiée.
+"""
+
+import datetime
+import json
+import math
+from typing import Any, Dict, Iterable, List, NamedTuple, Sequence, Union
+from xml.parsers import expat
+
+import numpy as np
+import shapely  # type: ignore
+from pydantic import BaseModel, Field
+
+GPX = "application/gpx+xml"
+GEOJSON = "application/geo+json"
+# Taille maximale d'une trace (octets)
+TAILLE_MAX = 64 * 1024 * 1024
+# Seuils par défaut pour confirmer une activité
+COUVERTURE_MIN = 0.5
+DUREE_MIN = 600.0
+
+
+class TraceInvalide(ValueError):
+    """La trace n'a pu être lue"""
+
+
+class Trace(NamedTuple):
+    """Points d'une trace: longitudes, latitudes et heures (secondes, ou NaN)"""
+
+    x: np.ndarray
+    y: np.ndarray
+    t: np.ndarray
+
+
+class Verification(BaseModel):
+    """Résultat de la vérification d'une trace contre un plateau"""
+
+    points: int = Field(description="Nombre de points de la trace")
+    dedans: int = Field(description="Nombre de points sur le plateau")
+    couverture: float = Field(description="Fraction des points sur le plateau")
+    duree: Union[float, None] = Field(
+        None, description="Temps passé sur le plateau (secondes), si horodatée"
+    )
+    confirme: bool = Field(description="Les seuils de confirmation sont atteints")
+
+
+def secondes(heure: Union[str, None]) -> float:
+    """Heure ISO 8601 en secondes depuis l'époque (NaN si absente ou invalide)"""
+    if not heure:
+        return math.nan
+    heure = heure.strip()
+    if heure.endswith("Z"):
+        heure = heure[:-1] + "+00:00"
+    try:
+        date = datetime.datetime.fromisoformat(heure)
+    except ValueError:
+        return math.nan
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+def horodater(heures: Sequence[Union[str, None]]) -> np.ndarray:
+    """
+    Heures ISO 8601 en secondes depuis l'époque (NaN si absentes ou
+    invalides).  Les heures UTC (le cas habituel) sont converties d'un
+    coup par numpy, les autres une à une.
+    """
+    utc = [h[:-1] if h and h.endswith("Z") else "NaT" for h in heures]
+    try:
+        dates = np.array(utc, dtype="datetime64[ms]")
+    except ValueError:
+        dates = np.full(len(heures), np.datetime64("NaT"), dtype="datetime64[ms]")
+    t = dates.astype(np.int64) / 1000
+    for i in np.flatnonzero(np.isnat(dates)):
+        t[i] = secondes(heures[int(i)])
+    return t
+
+
+def coordonnees(valeurs: Sequence[Any]) -> np.ndarray:
+    """Tableau de coordonnées (lues du texte ou du JSON)"""
+    try:
+        return np.array(valeurs, dtype=float)
+    except (TypeError, ValueError):
+        raise TraceInvalide("Coordonnées invalides")
+
+
+class LecteurGPX:
+    """
+    Lecture incrémentale des points (trkpt) d'un fichier GPX avec expat:
+    aucun arbre n'est construit, seuls les attributs lat/lon et l'heure
+    de chaque point sont gardés.
+    """
+
+    def __init__(self) -> None:
+        self.parser = expat.ParserCreate(namespace_separator=" ")
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.debut
+        self.parser.EndElementHandler = self.fin
+        self.lat: List[Union[str, None]] = []
+        self.lon: List[Union[str, None]] = []
+        self.heures: List[Union[str, None]] = []
+        self.texte: List[str] = []
+        self.heure = False
+
+    def debut(self, nom: str, attributs: Dict[str, str]) -> None:
+        if nom == "trkpt" or nom.endswith(" trkpt"):
+            self.lat.append(attributs.get("lat"))
+            self.lon.append(attributs.get("lon"))
+            self.heures.append(None)
+        elif (nom == "time" or nom.endswith(" time")) and self.heures:
+            # Texte lu seulement pour les heures
+            self.heure = True
+            self.parser.CharacterDataHandler = self.texte.append
+
+    def fin(self, nom: str) -> None:
+        if self.heure:
+            self.heures[-1] = "".join(self.texte).strip()
+            self.texte.clear()
+            self.heure = False
+            self.parser.CharacterDataHandler = None
+
+    def lire(self, donnees: bytes, fin: bool) -> None:
+        try:
+            self.parser.Parse(donnees, fin)
+        except expat.ExpatError as e:
+            raise TraceInvalide(f"GPX invalide: {e}")
+
+    def feed(self, donnees: bytes) -> None:
+        self.lire(donnees, False)
+
+    def close(self) -> Trace:
+        self.lire(b"", True)
+        return Trace(
+            coordonnees(self.lon), coordonnees(self.lat), horodater(self.heures)
+        )
+
+
+class LecteurGeoJSON:
+    """
+    Lecture des points d'un GeoJSON (LineString ou MultiLineString, seule
+    ou dans un Feature ou une FeatureCollection).  Les heures sont lues
+    de la propriété `coordTimes` si elle est présente.  Le document est
+    analysé une fois reçu, et limité à `TAILLE_MAX` octets.
+    """
+
+    def __init__(self) -> None:
+        self.morceaux: List[bytes] = []
+
+    def feed(self, donnees: bytes) -> None:
+        self.morceaux.append(donnees)
+
+    def close(self) -> Trace:
+        try:
+            document = json.loads(b"".join(self.morceaux))
+        except ValueError as e:
+            raise TraceInvalide(f"GeoJSON invalide: {e}")
+        coords: List[List[float]] = []
+        heures: List[Union[str, None]] = []
+        for geometrie, temps in lignes(document):
+            coords.extend(geometrie)
+            if temps is None or len(temps) != len(geometrie):
+                temps = [None] * len(geometrie)
+            heures.extend(temps)
+        xy = coordonnees([c[:2] if isinstance(c, list) else c for c in coords])
+        xy = xy.reshape(-1, 2)
+        return Trace(xy[:, 0], xy[:, 1], horodater(heures))
+
+
+def lignes(document: Any) -> Iterable[Any]:
+    """Coordonnées des lignes d'un GeoJSON et leurs heures (ou None)"""
+    if not isinstance(document, dict):
+        raise TraceInvalide("Objet GeoJSON attendu")
+    genre = document.get("type")
+    if genre == "FeatureCollection":
+        for feature in document.get("features", []):
+            yield from lignes(feature)
+    elif genre == "Feature":
+        proprietes = document.get("properties") or {}
+        temps = proprietes.get("coordTimes")
+        geometrie = document.get("geometry") or {}
+        if geometrie.get("type") == "MultiLineString":
+            temps = temps or [None] * len(geometrie.get("coordinates", []))
+            for ligne, t in zip(geometrie.get("coordinates", []), temps):
+                yield ligne, t
+        elif geometrie.get("type") == "LineString":
+            yield geometrie.get("coordinates", []), temps
+    elif genre == "LineString":
+        yield document.get("coordinates", []), None
+    elif genre == "MultiLineString":
+        for ligne in document.get("coordinates", []):
+            yield ligne, None
+    else:
+        raise TraceInvalide(f"Type GeoJSON {genre} non pris en charge")
+
+
+def lecteur(content_type: str) -> Union[LecteurGPX, LecteurGeoJSON]:
+    """Lecteur de trace selon le type de contenu"""
+    if "json" in content_type:
+        return LecteurGeoJSON()
+    return LecteurGPX()
+
+
+def verifier(
+    trace: Trace,
+    plateau: shapely.Geometry,
+    couverture_min: float = COUVERTURE_MIN,
+    duree_min: float = DUREE_MIN,
+) -> Verification:
+    """Vérifier une trace contre la géométrie (préparée) d'un plateau"""
+    n = len(trace.x)
+    if n == 0:
+        return Verification(
+            points=0, dedans=0, couverture=0.0, duree=None, confirme=False
+        )
+    dedans = shapely.contains_xy(plateau, trace.x, trace.y)
+    ndedans = int(np.count_nonzero(dedans))
+    couverture = ndedans / n
+    duree = None
+    if not np.isnan(trace.t).all():
+        # Intervalles entre deux points consécutifs sur le plateau
+        intervalles = np.diff(trace.t)
+        sur_plateau = dedans[:-1] & dedans[1:] & (intervalles > 0)
+        duree = float(np.nansum(intervalles[sur_plateau]))
+    # Sans heures, seule la couverture est vérifiée
+    confirme = couverture >= couverture_min and (duree is None or duree >= duree_min)
+    return Verification(
+        points=n,
+        dedans=ndedans,
+        couverture=couverture,
+        duree=duree,
+        confirme=confirme,
+    )
@@ -0,0 +1,85 @@
+"""Grille hiérarchique de tuiles (Web Mercator, quadkeys).
+
+Les observations sont comptées par tuile `(z, x, y)` à chaque niveau
+de 0 à `NIVEAU_MAX`, comme les tuiles des cartes web: au niveau `z`,
+le monde est divisé en 2^z × 2^z tuiles, chacune divisée en quatre au
+niveau suivant.  Une tuile est aussi identifiée par son quadkey, dont
+les préfixes sont ses tuiles parentes.
+"""
+
+import math
+from typing import List, Tuple, Union
+
+from pydantic import BaseModel, Field
+
+# Niveau le plus fin (environ 400 m de côté au Québec)
+NIVEAU_MAX = 16
+LATITUDE_MAX = 85.05112878
+# Ouest, sud, est, nord (WGS84)
+Boite = Tuple[float, float, float, float]
+
+
+class Densite(BaseModel):
+    """Nombre d'observations dans une tuile"""
+
+    quadkey: str = Field(description="Quadkey de la tuile")
+    z: int = Field(description="Niveau de la tuile")
+    x: int = Field(description="Colonne de la tuile")
+    y: int = Field(description="Rangée de la tuile (à partir du nord)")
+    boite: List[float] = Field(description="Limites (ouest, sud, est, nord) WGS84")
+    code_espece: Union[str, None] = Field(
+        None, description="Espèce, si regroupées par espèce"
+    )
+    categorie: Union[str, None] = Field(
+        None, description="Catégorie d'espèces, si regroupées par catégorie"
+    )
+    n: int = Field(description="Nombre d'observations")
+
+
+def tuile(longitude: float, latitude: float, z: int) -> Tuple[int, int]:
+    """Tuile (x, y) contenant un point au niveau `z`"""
+    cote = 1 << z
+    latitude = max(-LATITUDE_MAX, min(LATITUDE_MAX, latitude))
+    x = int((longitude + 180.0) / 360.0 * cote)
+    y = int(
+        (1.0 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2.0 * cote
+    )
+    return min(max(x, 0), cote - 1), min(max(y, 0), cote - 1)
+
+
+def tuiles(longitude: float, latitude: float) -> List[Tuple[int, int, int]]:
+    """Tuiles (z, x, y) contenant un point, à tous les niveaux"""
+    x, y = tuile(longitude, latitude, NIVEAU_MAX)
+    return [
+        (z, x >> (NIVEAU_MAX - z), y >> (NIVEAU_MAX - z))
+        for z in range(NIVEAU_MAX + 1)
+    ]
+
+
+def plage(boite: Boite, z: int) -> Tuple[int, int, int, int]:
+    """Tuiles (xmin, xmax, ymin, ymax) couvrant une boîte au niveau `z`"""
+    ouest, sud, est, nord = boite
+    xmin, ymin = tuile(ouest, nord, z)
+    xmax, ymax = tuile(est, sud, z)
+    return xmin, xmax, ymin, ymax
+
+
+def quadkey(z: int, x: int, y: int) -> str:
+    """Quadkey d'une tuile"""
+    chiffres = []
+    for i in range(z, 0, -1):
+        masque = 1 << (i - 1)
+        chiffres.append(str((1 if x & masque else 0) + (2 if y & masque else 0)))
+    return "".join(chiffres)
+
+
+def boite(z: int, x: int, y: int) -> Boite:
+    """Limites (ouest, sud, est, nord) d'une tuile"""
+    cote = 1 << z
+
+    def latitude(rangee: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * rangee / cote))))
+
+    ouest = x / cote * 360.0 - 180.0
+    est = (x + 1) / cote * 360.0 - 180.0
+    return ouest, latitude(y + 1), est, latitude(y)
@@ -1,16 +1,23 @@
 """Villes de compétition et leurs emplacements."""
 
+import datetime
 import logging
+import weakref
 from pathlib import Path
-from typing import Dict, Union, List
+from typing import Dict, Literal, Mapping, NamedTuple, Sequence, Tuple, Union, List
 
+import numpy as np
 import shapely  # type: ignore
 from pydantic import BaseModel, RootModel, Field
 from pydantic_geojson import FeatureModel, PointModel  # type: ignore
 
+from . import geodonnees, instantane
+
 LOGGER = logging.getLogger("points-air-villes")
-SHAPES: Dict[str, shapely.Geometry] = {}
-VILLES: Dict[str, "Ville"]
+# Vues sur la version actuelle des données (voir `Donnees`)
+SHAPES: Mapping[str, shapely.Geometry] = geodonnees.Vue("villes", lambda d: d.shapes)
+FICHES: Mapping[str, "FicheVille"] = geodonnees.Vue("villes", lambda d: d.fiches)
+VILLES: Mapping[str, "Ville"] = geodonnees.Vue("villes", lambda d: d.villes)
 
 
 class Ville(BaseModel):
@@ -33,17 +40,78 @@ class Ville(BaseModel):
         examples=[PointModel(coordinates=(-73.47093577802768, 45.76110925573926))],
     )
     feature: Union[FeatureModel, None] = Field(
-        None,
+        default=None,
         description="Feature GeoJSON de cette ville (fort probablement une MultiPolygon)",
     )
 
     @classmethod
     def from_wgs84(self, latitude: float, longitude: float) -> Union["Ville", None]:
-        p = shapely.Point(longitude, latitude)
-        for v, s in SHAPES.items():
-            if s.contains(p):
-                return VILLES[v]
-        return None
+        (ville,) = villes_wgs84([latitude], [longitude])
+        if ville is None:
+            return None
+        return VILLES[ville]
+
+    def avec_feature(self) -> "Ville":
+        """Cette ville avec son feature GeoJSON (reconstruit au besoin)"""
+        d = donnees()
+        if self.feature is not None or self.id not in d.shapes:
+            return self
+        ville = d.features.get(self.id)
+        if ville is None:
+            ville = self.model_copy(
+                update={"feature": instantane.feature(d.shapes[self.id])}
+            )
+            d.features[self.id] = ville
+        return ville
+
+
+class FicheVille(NamedTuple):
+    """Représentation compacte (sans géométrie) d'une ville"""
+
+    id: str
+    nom: str
+    overpass: Union[int, None]
+    centroide: Tuple[float, float]
+
+    @classmethod
+    def de_modele(cls, v: Ville) -> "FicheVille":
+        return cls(v.id, v.nom, v.overpass, tuple(v.centroide.coordinates))
+
+    @classmethod
+    def de_attributs(cls, attributs: Dict) -> "FicheVille":
+        return cls(
+            attributs["id"],
+            attributs["nom"],
+            attributs["overpass"],
+            tuple(attributs["centroide"]["coordinates"]),
+        )
+
+    def ville(self) -> Ville:
+        return Ville(
+            id=self.id,
+            nom=self.nom,
+            overpass=self.overpass,
+            centroide=PointModel(coordinates=self.centroide),
+        )
+
+
+def villes_wgs84(
+    latitudes: Sequence[float], longitudes: Sequence[float]
+) -> List[Union[str, None]]:
+    """Identificateurs des villes contenant chacun des emplacements"""
+    x = np.asarray(longitudes, dtype=float)
+    y = np.asarray(latitudes, dtype=float)
+    villes: List[Union[str, None]] = [None] * len(x)
+    if len(x) == 0:
+        return villes
+    # Candidats par boîte englobante, puis test exact sur les géométries préparées
+    d = donnees()
+    pidx, vidx = d.index.query(shapely.points(x, y))
+    dedans = shapely.contains_xy(d.geoms[vidx], x[pidx], y[pidx])
+    for p, v in zip(pidx[dedans], vidx[dedans]):
+        if villes[p] is None:
+            villes[p] = d.ids[v]
+    return villes
 
 
 class Score(BaseModel):
@@ -54,19 +122,125 @@ class Score(BaseModel):
 
 
 Palmares = RootModel[List[Score]]
+Periode = Literal["semaine", "mois", "saison"]
+
+
+def plus_mois(jour: datetime.date, mois: int) -> datetime.date:
+    """Premier du mois `mois` mois après celui d'un jour"""
+    n = jour.year * 12 + jour.month - 1 + mois
+    return datetime.date(n // 12, n % 12 + 1, 1)
+
+
+def bornes_periode(
+    periode: Periode, jour: datetime.date
+) -> Tuple[datetime.date, datetime.date]:
+    """
+    Premier jour et lendemain du dernier jour de la période qui contient
+    un jour: semaine du lundi au dimanche, mois civil, ou saison
+    météorologique (hiver de décembre à février, etc.).
+    """
+    if periode == "semaine":
+        debut = jour - datetime.timedelta(days=jour.weekday())
+        return debut, debut + datetime.timedelta(days=7)
+    if periode == "mois":
+        debut = jour.replace(day=1)
+        return debut, plus_mois(debut, 1)
+    debut = plus_mois(jour.replace(day=1), -(jour.month % 3))
+    return debut, plus_mois(debut, 3)
+
 
 THISDIR = Path(__file__).parent
+SOURCE = THISDIR / "villes.json"
+INSTANTANE = THISDIR / "villes.instantane"
 VilleCollection = RootModel[Dict[str, Ville]]
-with open(THISDIR / "villes.json") as infh:
-    data = infh.read()
-    VILLES = VilleCollection.model_validate_json(data).root
-    for v in VILLES.values():
+Chargement = Tuple[Dict[str, FicheVille], np.ndarray]
+
+
+def lire_json(path: Path) -> Chargement:
+    """Lire les villes et leurs géométries en GeoJSON"""
+    with open(path) as infh:
+        villes = VilleCollection.model_validate_json(infh.read()).root
+    fiches = {}
+    geometries: List[Union[shapely.Geometry, None]] = []
+    for cle, v in villes.items():
+        fiches[cle] = FicheVille.de_modele(v)
         if v.feature is None:
             LOGGER.warning(
                 "feature pour %s ne devrait pas être None dans villes.json", v.id
             )
+            geometries.append(None)
             continue
         # FIXME: THERE MUST BE A BETTER WAY
-        shape = shapely.from_geojson(v.feature.model_dump_json())
-        shapely.prepare(shape)
-        SHAPES[v.id] = shape
+        geometries.append(shapely.from_geojson(v.feature.model_dump_json()))
+    return fiches, np.array(geometries, dtype=object)
+
+
+def lire_instantane(path: Path, source: Path) -> Union[Chargement, None]:
+    """Lire les villes et leurs géométries d'un instantané à jour"""
+    try:
+        inst = instantane.lire(path)
+    except FileNotFoundError:
+        return None
+    if inst.source != instantane.empreinte(source):
+        LOGGER.warning("Instantané %s périmé, lecture de %s", path, source)
+        return None
+    fiches = {
+        inst.cles[groupe]: FicheVille.de_attributs(attributs)
+        for groupe, attributs in zip(inst.groupes, inst.attributs)
+    }
+    return fiches, inst.geometries
+
+
+def ecrire_instantane(path: Path = INSTANTANE, source: Path = SOURCE) -> None:
+    """Construire l'instantané des villes à partir du GeoJSON"""
+    fiches, geometries = lire_json(source)
+    instantane.ecrire(
+        path,
+        instantane.empreinte(source),
+        list(fiches.keys()),
+        list(range(len(fiches))),
+        [
+            f.ville().model_dump(mode="json", exclude={"feature"})
+            for f in fiches.values()
+        ],
+        geometries,
+    )
+
+
+class Donnees:
+    """Une version des villes, de leurs géométries et de leur index"""
+
+    def __init__(self, fiches: Dict[str, FicheVille], geometries: np.ndarray):
+        # Fiches compactes des villes, matérialisées en Ville à la demande
+        self.fiches = fiches
+        self.shapes: Dict[str, shapely.Geometry] = {}
+        for fiche, shape in zip(fiches.values(), geometries):
+            if shape is None:
+                continue
+            shapely.prepare(shape)
+            self.shapes[fiche.id] = shape
+        self.villes = instantane.Materialises(fiches, FicheVille.ville)
+        # Villes avec leur feature GeoJSON, tant qu'une requête s'en sert
+        self.features: "weakref.WeakValueDictionary[str, Ville]" = (
+            weakref.WeakValueDictionary()
+        )
+        # Géométries des shapes, dans le même ordre que ids
+        self.ids = list(self.shapes.keys())
+        self.geoms = np.array(list(self.shapes.values()), dtype=object)
+        self.index = shapely.STRtree(self.geoms)
+
+
+def charger(path: Path = INSTANTANE, source: Path = SOURCE) -> Donnees:
+    """Construire une version des villes (de l'instantané s'il est à jour)"""
+    charge = lire_instantane(path, source)
+    if charge is None:
+        charge = lire_json(source)
+    return Donnees(*charge)
+
+
+def donnees() -> Donnees:
+    """Version actuelle des villes"""
+    return geodonnees.donnees("villes")
+
+
+geodonnees.publier(villes=charger())
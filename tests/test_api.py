@@ -1,7 +1,11 @@
+import gzip
+import json
 import tempfile
+import uuid
 from pathlib import Path
 
 import points_air.api
+import points_air.reponses
 from fastapi.testclient import TestClient
 
 tempdir = tempfile.TemporaryDirectory()
@@ -22,6 +26,70 @@ def test_villes():
     assert len(villes) > 0
 
 
+def test_etag():
+    response = client.get("/villes?geometrie=true")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert "max-age" in response.headers["cache-control"]
+    response = client.get("/villes?geometrie=true", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    response = client.get("/villes", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    response = client.get("/plateau/17aa7a09-e295-499c-845a-41a01e061a64")
+    assert response.json()["feature"] is None
+    assert client.get("/ville/ville-de-nulle-part").status_code == 404
+
+
+def test_compression():
+    url = "/villes?geometrie=true"
+    identite = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in identite.headers
+    assert "Accept-Encoding" in identite.headers["vary"]
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert response.content == identite.content  # Décompressé par httpx
+    etag = response.headers["etag"]
+    assert etag != identite.headers["etag"]
+    response = client.get(
+        url, headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    # Chaque réponse et variante gardée est comptée une fois
+    assert points_air.reponses.taille == sum(
+        len(r.contenu) + sum(map(len, r.variantes.values()))
+        for r in points_air.reponses.REPONSES.values()
+    )
+    # Réponses dynamiques compressées au-delà du seuil
+    response = client.get(
+        "/plateaux/48.4,-68.5?limite=20&proximite=100&geometrie=true",
+        headers={"Accept-Encoding": "gzip"},
+    )
+    assert response.headers["content-encoding"] == "gzip"
+    assert len(response.json()) > 1
+    response = client.get("/palmares", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+
+
+def test_encodage():
+    assert points_air.reponses.encodage(None) is None
+    assert points_air.reponses.encodage("gzip, deflate") == "gzip"
+    assert points_air.reponses.encodage("gzip;q=0, deflate") is None
+    assert points_air.reponses.encodage("*") is not None
+    data = gzip.decompress(points_air.reponses.compresser(b"[]" * 1000, "gzip"))
+    assert data == b"[]" * 1000
+
+
+def test_villes_emplacements():
+    response = client.post(
+        "/villes/emplacements", json=[[45.768380, -73.431657], [45.628861, -73.804224]]
+    )
+    assert response.status_code == 200
+    assert response.json() == ["ville-de-repentigny", None]
+
+
 def test_crud():
     response = client.get("/plateaux/45.768380,-73.431657?limite=1&proximite=1000")
     assert response.status_code == 200
@@ -42,6 +110,11 @@ def test_crud():
     assert user["id"]
     assert user["debut"]
     assert user["dernier"]
+    response = client.get("/user/foobie")
+    assert response.status_code == 200
+    assert response.json() == user
+    response = client.put("/user", json={"nom": "foobie", "sports": ["Vélo"]})
+    assert response.status_code == 409
     response = client.put(
         "/activite",
         json={"user": user["id"], "sport": ["Marche"], "plateau": plateau["id"]},
@@ -65,3 +138,309 @@ def test_crud():
     response = client.get("/palmares")
     palmares = response.json()
     assert {"ville": "ville-de-repentigny", "score": 2} in palmares
+
+
+def test_palmares_periode():
+    user = str(uuid.uuid4())
+    # Le Bic
+    plateau = "17aa7a09-e295-499c-845a-41a01e061a64"
+    for date, sport in (
+        ("2023-12-30T10:00:00", "Marche"),
+        ("2024-01-02T10:00:00", "Vélo"),
+        ("2024-01-20T10:00:00", "Marche"),
+    ):
+        response = client.put(
+            "/activite",
+            json={"user": user, "sport": [sport], "plateau": plateau, "date": date},
+        )
+        assert response.status_code == 200
+
+    def score(**params):
+        response = client.get("/palmares", params=params)
+        assert response.status_code == 200
+        return {s["ville"]: s["score"] for s in response.json()}["ville-de-rimouski"]
+
+    assert score(periode="semaine", jour="2024-01-03") == 1
+    assert score(periode="mois", jour="2024-01-03") == 2
+    assert score(periode="saison", jour="2024-01-03") == 3
+    assert score(periode="saison", jour="2024-01-03", sport="Marche") == 2
+    assert score(debut="2024-01-01", fin="2024-01-03") == 1
+    assert score(periode="mois", jour="2024-01-03", fin="2024-01-10") == 1
+    response = client.get("/palmares", params={"periode": "annee"})
+    assert response.status_code == 422
+
+
+def test_observations():
+    user = "bd4e6b1a-6f6d-4a8e-8bd0-2b8f4cb50d1b"
+    response = client.put(
+        "/observation",
+        json={
+            "user": user,
+            "date": "2024-06-01T12:00:00",
+            "code_espece": "COCCA",
+            "emplacement": {"type": "Point", "coordinates": [-73.432, 45.769]},
+        },
+    )
+    assert response.status_code == 200
+    obs = response.json()
+    assert obs["id"]
+    response = client.get(f"/observations?user={user}")
+    assert response.json() == [obs]
+    response = client.get("/observations/45.768380,-73.431657?proximite=1")
+    assert response.status_code == 200
+    [(dist, proche)] = response.json()
+    assert proche == obs
+    assert dist < 100
+    response = client.get("/observations/45.768380,-73.431657?code_espece=zzz")
+    assert response.json() == []
+
+
+def test_pagination(monkeypatch):
+    monkeypatch.setattr(points_air.reponses, "TAILLE_PAGE", 2)
+    user = str(uuid.uuid4())
+    obss = []
+    for _ in range(5):
+        response = client.put(
+            "/observation",
+            json={
+                "user": user,
+                "date": "2024-06-01T12:00:00",
+                "code_espece": "COCCA",
+                "emplacement": {"type": "Point", "coordinates": [-68.5, 48.4]},
+            },
+        )
+        obss.append(response.json())
+    obss.sort(key=lambda o: o["id"])
+    # Diffusion complète par pages de TAILLE_PAGE
+    response = client.get(f"/observations?user={user}")
+    assert response.json() == obss
+    response = client.get(
+        f"/observations?user={user}", headers={"Accept": "application/x-ndjson"}
+    )
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == obss
+    # Pagination par curseur
+    pages = []
+    url = f"/observations?user={user}&limite=3"
+    while url:
+        response = client.get(url)
+        pages.extend(response.json())
+        url = response.links.get("next", {}).get("url")
+    assert pages == obss
+
+
+def test_ouverture():
+    points_air.api.fermer()
+    with TestClient(points_air.api.apiv1):
+        # Ouvert au démarrage, avant toute requête
+        assert points_air.api.STOCKAGE is not None
+        assert points_air.api.ECRIVAIN is not None
+    assert points_air.api.STOCKAGE is None
+
+
+def test_lots():
+    user = str(uuid.uuid4())
+    plateau = "17aa7a09-e295-499c-845a-41a01e061a64"
+    avant = {s["ville"]: s["score"] for s in client.get("/palmares").json()}
+    response = client.put(
+        "/activites",
+        json=[
+            {"user": user, "sport": ["Marche"], "plateau": plateau},
+            {"user": user, "sport": ["Marche"]},
+            {"user": user, "sport": ["Vélo"], "plateau": plateau},
+        ],
+    )
+    assert response.status_code == 200
+    resultats = response.json()
+    assert [r["erreur"] is None for r in resultats] == [True, False, True]
+    assert "plateau" in resultats[1]["erreur"]
+    apres = {s["ville"]: s["score"] for s in client.get("/palmares").json()}
+    assert apres["ville-de-rimouski"] == avant["ville-de-rimouski"] + 2
+    response = client.get(f"/activites?user={user}")
+    assert sorted(a["id"] for a in response.json()) == sorted(
+        r["id"] for r in resultats if r["id"]
+    )
+    obss = [
+        {
+            "user": user,
+            "date": "2024-06-01T12:00:00",
+            "code_espece": "COCCA",
+            "emplacement": {"type": "Point", "coordinates": [-68.5, 48.4]},
+        }
+        for _ in range(3)
+    ]
+    response = client.put(
+        "/observations",
+        content="".join(json.dumps(o) + "\n" for o in obss) + "{\n",
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    resultats = response.json()
+    assert [r["erreur"] is None for r in resultats] == [True, True, True, False]
+    response = client.get(f"/observations?user={user}")
+    assert len(response.json()) == 3
+    response = client.put("/observations", json={"pas": "un tableau"})
+    assert response.status_code == 422
+
+
+def test_trace():
+    user = str(uuid.uuid4())
+    plateau = "17aa7a09-e295-499c-845a-41a01e061a64"
+    response = client.put(
+        "/activite", json={"user": user, "sport": ["Marche"], "plateau": plateau}
+    )
+    id = response.json()["id"]
+    points = [(-68.805, 48.355, 0), (-68.806, 48.356, 5), (-68.5, 48.4, 20)]
+    trace = {
+        "type": "Feature",
+        "properties": {
+            "coordTimes": [f"2024-06-01T10:{m:02d}:00Z" for _, _, m in points]
+        },
+        "geometry": {
+            "type": "LineString",
+            "coordinates": [[lon, lat] for lon, lat, _ in points],
+        },
+    }
+    headers = {"Content-Type": "application/geo+json"}
+    response = client.put(f"/activite/{id}/trace", json=trace, headers=headers)
+    assert response.status_code == 200
+    verification = response.json()
+    assert verification["dedans"] == 2
+    assert verification["duree"] == 300
+    assert not verification["confirme"]
+    activites = client.get(f"/activites?user={user}").json()
+    assert not activites[0]["confirme"]
+    trace["properties"]["coordTimes"][1] = "2024-06-01T10:15:00Z"
+    response = client.put(f"/activite/{id}/trace", json=trace, headers=headers)
+    assert response.json()["confirme"]
+    activites = client.get(f"/activites?user={user}").json()
+    assert activites[0]["confirme"]
+    response = client.put(
+        f"/activite/{id}/trace",
+        content="<gpx><trk>",
+        headers={"Content-Type": "application/gpx+xml"},
+    )
+    assert response.status_code == 422
+    response = client.put(f"/activite/{uuid.uuid4()}/trace", json=trace)
+    assert response.status_code == 404
+
+
+def test_photo():
+    response = client.put(
+        "/observation",
+        json={
+            "user": str(uuid.uuid4()),
+            "date": "2024-06-01T12:00:00",
+            "code_espece": "COCCA",
+            "emplacement": {"type": "Point", "coordinates": [-68.5, 48.4]},
+        },
+    )
+    id = response.json()["id"]
+    assert response.json()["photos"] == []
+    photo = b"\xff\xd8\xff\xe0" + bytes(range(256)) * 1000
+    headers = {"Content-Type": "image/jpeg"}
+    response = client.put(f"/observation/{id}/photo", content=photo, headers=headers)
+    assert response.status_code == 200
+    [nom] = response.json()["photos"]
+    assert nom.endswith(".jpg")
+    # Une photo identique n'est conservée qu'une fois
+    response = client.put(f"/observation/{id}/photo", content=photo, headers=headers)
+    assert response.json()["photos"] == [nom]
+    autre = b"\x89PNG\r\n\x1a\n" + bytes(1000)
+    response = client.put(
+        f"/observation/{id}/photo", content=autre, headers={"Content-Type": "image/png"}
+    )
+    [_, nom_png] = response.json()["photos"]
+    # Les photos ne sont pas écrasées par une mise à jour de l'observation
+    observation = {**response.json(), "code_espece": "LONGI", "photos": ["x.jpg"]}
+    response = client.put("/observation", json=observation)
+    assert response.json()["photos"] == [nom, nom_png]
+    del observation["photos"]
+    client.put("/observations", json=[observation])
+    response = client.put("/observation", json=observation)
+    assert response.json()["photos"] == [nom, nom_png]
+    assert response.json()["code_espece"] == "LONGI"
+    magasin = points_air.api.DATADIR / "medias"
+    assert len(list(magasin.glob("*/*.jpg"))) == 1
+    assert not list((magasin / "tmp").iterdir())
+    response = client.get(f"/photo/{nom}")
+    assert response.status_code == 200
+    assert response.content == photo
+    assert response.headers["content-type"] == "image/jpeg"
+    assert "immutable" in response.headers["cache-control"]
+    assert "content-encoding" not in response.headers
+    # Pas de compression des photos, même hors des formats exclus par défaut
+    heic = b"\x00\x00\x00\x18ftypheic" + bytes(10000)
+    response = client.put(
+        f"/observation/{id}/photo", content=heic, headers={"Content-Type": "image/heic"}
+    )
+    nom_heic = response.json()["photos"][-1]
+    response = client.get(f"/photo/{nom_heic}", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-type"] == "image/heic"
+    assert "content-encoding" not in response.headers
+    response = client.get(f"/photo/{nom}", headers={"Range": "bytes=4-13"})
+    assert response.status_code == 206
+    assert response.content == bytes(range(10))
+    response = client.get(f"/photo/{nom}?vignette=true")
+    assert response.status_code == 200
+    response = client.put(f"/observation/{id}/photo", content=b"pas une photo")
+    assert response.status_code == 415
+    assert not list((magasin / "tmp").iterdir())
+    response = client.put(f"/observation/{uuid.uuid4()}/photo", content=photo)
+    assert response.status_code == 404
+    response = client.get("/photo/../points-air.sqlite3")
+    assert response.status_code == 404
+    response = client.get(f"/photo/{'0' * 64}.jpg")
+    assert response.status_code == 404
+
+
+def test_densites():
+    # Gaspé, loin des observations des autres tests
+    for code_espece in ("COCCA", "COCCA", "LONGI", "ALLIA"):
+        client.put(
+            "/observation",
+            json={
+                "user": str(uuid.uuid4()),
+                "date": "2024-06-01T12:00:00",
+                "code_espece": code_espece,
+                "emplacement": {"type": "Point", "coordinates": [-64.48, 48.83]},
+            },
+        )
+    params = {"boite": "-65,48.5,-64,49", "z": 10}
+    response = client.get("/densites", params=params)
+    assert response.status_code == 200
+    [tuile] = response.json()
+    assert tuile["n"] == 4
+    assert len(tuile["quadkey"]) == 10
+    ouest, sud, est, nord = tuile["boite"]
+    assert ouest <= -64.48 < est and sud < 48.83 <= nord
+    response = client.get("/densites", params={**params, "par": "categorie"})
+    assert {t["categorie"]: t["n"] for t in response.json()} == {
+        "Insectes": 3,
+        "Plantes de milieux terrestres": 1,
+    }
+    response = client.get("/densites", params={**params, "par": "espece"})
+    assert {t["code_espece"]: t["n"] for t in response.json()} == {
+        "COCCA": 2,
+        "LONGI": 1,
+        "ALLIA": 1,
+    }
+    response = client.get(
+        "/densites", params={**params, "categorie": "Insectes", "code_espece": "ALLIA"}
+    )
+    assert response.json() == []
+    response = client.get("/densites", params={**params, "code_espece": "LONGI"})
+    assert [t["n"] for t in response.json()] == [1]
+    response = client.get("/densites", params={"boite": "-64,48.5,-65,49"})
+    assert response.status_code == 422
+    response = client.get("/densites", params={"boite": "partout"})
+    assert response.status_code == 422
+    for boite in ("nan,48.5,-64,49", "-inf,48.5,-64,49", "-65,48.5,-64,inf"):
+        response = client.get("/densites", params={"boite": boite})
+        assert response.status_code == 422
+    # Longitudes ramenées à ±180
+    response = client.get("/densites", params={"boite": "-1e300,-80,1e300,80", "z": 0})
+    assert response.status_code == 200
+    response = client.get(
+        "/densites", params={**params, "categorie": "Nope", "code_espece": "ACNE"}
+    )
+    assert response.status_code == 422
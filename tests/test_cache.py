@@ -0,0 +1,76 @@
+import asyncio
+import tempfile
+from pathlib import Path
+from typing import Dict
+
+import httpx
+
+import points_air.cache
+from points_air.cache import CacheHTTP, Limite
+
+URL = "https://example.com/parcs.geojson"
+
+
+def test_cache():
+    requetes = []
+
+    def repondre(request: httpx.Request) -> httpx.Response:
+        requetes.append(request)
+        if request.headers.get("If-None-Match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, content=b'{"parcs": 1}', headers={"ETag": '"v1"'})
+
+    async def lancer(cache: CacheHTTP) -> httpx.Response:
+        return await cache.get(URL)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        client = httpx.AsyncClient(transport=httpx.MockTransport(repondre))
+        cache = CacheHTTP(client, Path(tempdir))
+        r = asyncio.run(lancer(cache))
+        assert r.status_code == 200
+        assert r.json() == {"parcs": 1}
+        # Revalidation avec l'ETag
+        r = asyncio.run(lancer(cache))
+        assert requetes[-1].headers["If-None-Match"] == '"v1"'
+        assert r.status_code == 200
+        assert r.json() == {"parcs": 1}
+        assert len(list((Path(tempdir) / "objets").glob("*/*"))) == 1
+        # Hors ligne: rejouée sans réseau, absente donne 504
+        cache = CacheHTTP(client, Path(tempdir), hors_ligne=True)
+        n = len(requetes)
+        r = asyncio.run(lancer(cache))
+        assert r.json() == {"parcs": 1}
+        r = asyncio.run(cache.post(URL, data={"data": "autre"}))
+        assert r.status_code == 504
+        assert len(requetes) == n
+
+
+def test_reessais_limites(monkeypatch):
+    monkeypatch.setattr(points_air.cache, "DELAI", 0.0)
+    monkeypatch.setitem(points_air.cache.LIMITES, "example.com", Limite(2))
+    actives = maximum = 0
+    essais: Dict[str, int] = {}
+
+    async def repondre(request: httpx.Request) -> httpx.Response:
+        nonlocal actives, maximum
+        actives += 1
+        maximum = max(maximum, actives)
+        await asyncio.sleep(0.01)
+        actives -= 1
+        essais[request.url.path] = essais.get(request.url.path, 0) + 1
+        if essais[request.url.path] == 1:
+            return httpx.Response(503, headers={"Retry-After": "0"})
+        return httpx.Response(200, content=request.url.path.encode())
+
+    async def lancer(cache: CacheHTTP, tempdir: Path):
+        return await asyncio.gather(
+            *(cache.telecharger(f"{URL}/{i}", tempdir / f"{i}.txt") for i in range(6))
+        )
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        client = httpx.AsyncClient(transport=httpx.MockTransport(repondre))
+        cache = CacheHTTP(client, Path(tempdir) / "cache")
+        assert asyncio.run(lancer(cache, Path(tempdir))) == [True] * 6
+        assert maximum == 2
+        assert all(n == 2 for n in essais.values())
+        assert (Path(tempdir) / "3.txt").read_text() == "/parcs.geojson/3"
@@ -1,7 +1,8 @@
 import pytest
 
 from points_air.villes import VILLES
-from points_air.data import ville_sentiers
+from points_air.data import plateaux_ville, ville_sentiers
+from points_air.plateaux import PLATEAUX
 
 
 @pytest.mark.skip("Tests sur API externe désactivés")
@@ -12,3 +13,12 @@ async def test_sentiers():
     geom = await ville_sentiers(repentigny)
     assert geom
     assert len(geom.features) > 400
+
+
+def test_plateaux_ville():
+    """Jointure spatiale des parcs et sentiers (sans réseau)"""
+    plateaux = plateaux_ville("ville-de-repentigny")
+    assert [p.nom for p in plateaux] == [
+        p.nom for p in PLATEAUX["ville-de-repentigny"]
+    ]
+    assert all(p.ville == "ville-de-repentigny" for p in plateaux)
@@ -0,0 +1,36 @@
+import asyncio
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+
+from points_air.ecrivain import Ecrivain
+from points_air.stockage import NomPris, StockageFichiers, StockageSQLite
+from points_air.user import Activite, Utilisateur
+
+BIC = uuid.UUID("17aa7a09-e295-499c-845a-41a01e061a64")
+
+
+@pytest.mark.parametrize("moteur", [StockageFichiers, StockageSQLite])
+def test_ecrivain(moteur):
+    with tempfile.TemporaryDirectory() as tempdir:
+        stockage = moteur(Path(tempdir))
+        ecrivain = Ecrivain(stockage)
+        acts = [
+            Activite(user=uuid.uuid4(), sport=["Marche"], plateau=BIC)
+            for _ in range(50)
+        ]
+
+        async def ecrire():
+            await asyncio.gather(*(ecrivain.put_activite(a) for a in acts))
+            await ecrivain.put_user(Utilisateur(nom="foobie", sports=["Marche"]))
+            with pytest.raises(NomPris):
+                await ecrivain.put_user(Utilisateur(nom="foobie", sports=["Vélo"]))
+
+        asyncio.run(ecrire())
+        ecrivain.close()
+        assert stockage.scores() == {"ville-de-rimouski": 50}
+        assert sorted(a.id for a in stockage.activites()) == sorted(a.id for a in acts)
+        assert not list(Path(tempdir).glob("**/*.tmp"))
+        stockage.close()
@@ -0,0 +1,73 @@
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+
+import points_air.api
+from points_air import geodonnees, plateaux, villes
+
+client = TestClient(points_air.api.apiv1)
+
+
+def test_epingler():
+    ancienne = geodonnees.COURANTE
+    try:
+        with tempfile.TemporaryDirectory() as tempdir:
+            # Une seule ville, lue du GeoJSON (sans instantané)
+            source = Path(tempdir) / "villes.json"
+            with open(villes.SOURCE) as infh:
+                toutes = json.load(infh)
+            with open(source, "wt") as outfh:
+                json.dump({"ville-de-rimouski": toutes["ville-de-rimouski"]}, outfh)
+            nouvelles = villes.charger(Path(tempdir) / "absent", source)
+        with geodonnees.epingler() as version:
+            geodonnees.publier(villes=nouvelles)
+            # La requête en cours garde sa version
+            assert geodonnees.actuelle() is version
+            assert len(villes.VILLES) == 3
+            assert villes.Ville.from_wgs84(45.768380, -73.431657).nom == "Repentigny"
+        assert geodonnees.actuelle().numero == version.numero + 1
+        assert list(villes.VILLES) == ["ville-de-rimouski"]
+        assert villes.Ville.from_wgs84(45.768380, -73.431657) is None
+        # Les plateaux n'ont pas changé
+        assert len(plateaux.PLATEAUX) == 3
+    finally:
+        geodonnees.COURANTE = ancienne
+
+
+def test_surveillant(monkeypatch):
+    recharges = []
+    monkeypatch.setattr(geodonnees, "recharger", lambda: recharges.append(1))
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir) / "villes.json"
+        surveillant = geodonnees.Surveillant(0.05, [path])
+        surveillant.start()
+        path.write_text("{}")
+        time.sleep(0.5)
+        surveillant.close()
+    # Un seul rechargement, une fois le fichier stable
+    assert recharges == [1]
+
+
+def test_recharger(monkeypatch):
+    response = client.post("/admin/geodonnees")
+    assert response.status_code == 404
+    monkeypatch.setattr(points_air.api, "ADMIN_TOKEN", "secret")
+    response = client.post(
+        "/admin/geodonnees", headers={"Authorization": "Bearer faux"}
+    )
+    assert response.status_code == 401
+    avant = client.get("/geodonnees").json()
+    response = client.post(
+        "/admin/geodonnees", headers={"Authorization": "Bearer secret"}
+    )
+    assert response.status_code == 200
+    apres = response.json()
+    assert apres["version"] > avant["version"]
+    assert (apres["villes"], apres["plateaux"]) == (avant["villes"], avant["plateaux"])
+    assert client.get("/geodonnees").json() == apres
+    response = client.get("/villes")
+    assert response.status_code == 200
+    assert len(response.json()) == 3
@@ -0,0 +1,46 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import shapely
+
+from points_air import instantane, plateaux, villes
+
+
+def test_instantane_plateaux():
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir) / "plateaux.instantane"
+        plateaux.ecrire_instantane(path)
+        charge = plateaux.lire_instantane(path, plateaux.SOURCE)
+        assert charge is not None
+        fiches, geometries, centroides = charge
+        assert list(fiches.keys()) == list(plateaux.PLATEAUX.keys())
+        fiche = fiches["ville-de-rimouski"][0]
+        assert fiche == plateaux.FICHES[fiche.id]
+        assert fiche.plateau() == plateaux.PLATEAUX["ville-de-rimouski"][0]
+        assert shapely.equals_exact(geometries[0], plateaux.SHAPES[fiche.id], 0)
+        assert tuple(centroides[0]) == tuple(plateaux.donnees().centroides[0])
+        # Instantané périmé
+        assert plateaux.lire_instantane(path, villes.SOURCE) is None
+
+
+def test_instantane_villes():
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir) / "villes.instantane"
+        villes.ecrire_instantane(path)
+        charge = villes.lire_instantane(path, villes.SOURCE)
+        assert charge is not None
+        vs, geometries = charge
+        assert list(vs.keys()) == list(villes.VILLES.keys())
+        repentigny = vs["ville-de-repentigny"].ville().avec_feature()
+        assert repentigny.feature.geometry.type == "MultiPolygon"
+
+
+def test_instantane_sans_geometrie():
+    geometries = np.array([shapely.Point(1, 2), None, shapely.box(0, 0, 1, 1)])
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir) / "x.instantane"
+        instantane.ecrire(path, "source", ["a"], [0, 0, 0], [{}] * 3, geometries)
+        inst = instantane.lire(path)
+        assert inst.geometries[1] is None
+        assert shapely.equals(inst.geometries[[0, 2]], geometries[[0, 2]]).all()
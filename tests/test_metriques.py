@@ -0,0 +1,39 @@
+import tempfile
+from pathlib import Path
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from points_air.metriques import Metriques, Registre, exposer
+
+
+def test_metriques():
+    app = FastAPI()
+
+    @app.get("/plateau/{id}")
+    async def plateau(id: str) -> str:
+        return id
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        registre = Registre()
+        app.add_middleware(
+            Metriques,
+            routes=app.router.routes,
+            registre=registre,
+            profils=Path(tempdir),
+            entete=True,
+        )
+        client = TestClient(app)
+        for id in "abc":
+            assert client.get(f"/plateau/{id}").status_code == 200
+        assert client.get("/nulle/part").status_code == 404
+        texte = exposer(registre)
+        route = 'methode="GET",route="/plateau/{id}"'
+        assert f'points_air_requetes_total{{{route},statut="200"}} 3' in texte
+        assert 'route="inconnue",statut="404"} 1' in texte
+        assert f"points_air_requete_duree_secondes_count{{{route}}} 3" in texte
+        assert f"points_air_requetes_en_cours{{{route}}} 0" in texte
+        assert not list(Path(tempdir).iterdir())
+        client.get("/plateau/d", headers={"X-Profil": "1"})
+        [profil] = Path(tempdir).iterdir()
+        assert "plateau_id" in profil.name
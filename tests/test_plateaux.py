@@ -1,5 +1,8 @@
 import uuid
-from points_air.plateaux import Plateau
+
+import shapely
+
+from points_air.plateaux import SHAPES, Plateau
 
 
 def test_plateaux_wsg84():
@@ -27,7 +30,44 @@ def test_plateaux_wsg84():
     assert abs(dist - 164) < 1
     assert "Sanguinet" in p.nom
 
+    # Loin de tout (à Laval)
+    assert Plateau.near_wgs84(45.628861, -73.804224, proximite=1) == []
+    assert Plateau.near_wgs84(45.768380, -73.431657, limit=0) == []
+    nearby = Plateau.near_wgs84(45.768380, -73.431657, proximite=1000, limit=100)
+    assert len(nearby) == 46
+    assert [d for d, _ in nearby] == sorted(d for d, _ in nearby)
+
 
 def test_plateau_uuid():
     p = Plateau.from_uuid(uuid.UUID("17aa7a09-e295-499c-845a-41a01e061a64"))
     assert p.nom == "Parc du Bic"
+
+
+def test_plateau_feature():
+    p = Plateau.from_uuid(uuid.UUID("17aa7a09-e295-499c-845a-41a01e061a64"))
+    assert p.feature is None
+    assert Plateau.ville_de(p.id) == "ville-de-rimouski"
+    avec = p.avec_feature()
+    assert avec.feature.geometry.type in ("Polygon", "MultiPolygon")
+    # Partagé tant qu'il est utilisé
+    assert p.avec_feature() is avec
+
+
+def test_plateaux_bordure():
+    """Distance au périmètre plutôt qu'au centroïde"""
+    bic = uuid.UUID("17aa7a09-e295-499c-845a-41a01e061a64")
+    coords = shapely.get_coordinates(SHAPES[bic])
+    lon, lat = coords[coords[:, 0].argmin()]
+    lon -= 0.0005  # Juste à l'ouest du parc
+    [(dist, p)] = Plateau.near_wgs84(lat, lon, 5, 1)
+    assert p.id == bic
+    assert dist > 2000
+    [(dist, p)] = Plateau.near_wgs84(lat, lon, 5, 1, mesure="bordure")
+    assert p.id == bic
+    assert 30 < dist < 45
+    dedans = SHAPES[bic].representative_point()
+    [(dist, p)] = Plateau.near_wgs84(dedans.y, dedans.x, 1, 1, mesure="bordure")
+    assert p.id == bic
+    assert dist == 0
+    # Plus loin que la proximité
+    assert Plateau.near_wgs84(lat, lon - 0.1, 5, 10, mesure="bordure") == []
@@ -0,0 +1,32 @@
+import gc
+import os
+import signal
+
+import pytest
+import uvicorn
+
+import points_air
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="fork requis")
+def test_relances(monkeypatch, caplog):
+    """Un processus qui échoue au lancement n'est pas relancé sans fin"""
+    delais = []
+
+    def servir(config, sock):
+        os._exit(1)
+
+    monkeypatch.setattr(points_air, "servir", servir)
+    monkeypatch.setattr(points_air, "DELAI", 0.01)
+    monkeypatch.setattr(points_air.time, "sleep", delais.append)
+    handlers = {s: signal.getsignal(s) for s in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        with pytest.raises(SystemExit):
+            points_air.prefork(uvicorn.Config(None, port=0), 2)
+    finally:
+        gc.unfreeze()
+        for s, handler in handlers.items():
+            signal.signal(s, handler)
+    # Délais croissants avant chaque relance, puis abandon
+    assert set(delais) == {0.01, 0.02, 0.04, 0.08}
+    assert "au lancement" in caplog.text
@@ -0,0 +1,363 @@
+import datetime
+import multiprocessing
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+from pydantic_geojson import PointModel
+
+from points_air.especes import Observation
+from points_air.stockage import (
+    MOTEURS,
+    NomPris,
+    Stockage,
+    StockageFichiers,
+    StockageSQLite,
+    migrer,
+    ouvrir,
+)
+from points_air.user import Activite, Utilisateur
+
+BIC = uuid.UUID("17aa7a09-e295-499c-845a-41a01e061a64")
+CREVIER = uuid.UUID("e254f96d-4e58-4816-abd9-891409ab9e33")
+
+
+@pytest.fixture(params=[StockageFichiers, StockageSQLite])
+def stockage(request):
+    with tempfile.TemporaryDirectory() as tempdir:
+        s = request.param(Path(tempdir))
+        yield s
+        s.close()
+
+
+def test_activites(stockage):
+    user = uuid.uuid4()
+    act = Activite(user=user, sport=["Marche"], plateau=BIC)
+    stockage.put_activite(act)
+    stockage.put_activite(Activite(user=uuid.uuid4(), sport=["Vélo"], plateau=BIC))
+    assert stockage.get_activite(act.id) == act
+    assert list(stockage.activites(user=user)) == [act]
+    assert len(list(stockage.activites())) == 2
+    assert stockage.scores() == {"ville-de-rimouski": 2}
+
+
+def test_pagination(stockage):
+    user = uuid.uuid4()
+    acts = [Activite(user=user, sport=["Marche"], plateau=BIC) for _ in range(5)]
+    stockage.put_activites(acts)
+    stockage.put_activite(Activite(user=uuid.uuid4(), sport=["Vélo"], plateau=BIC))
+    acts.sort(key=lambda a: str(a.id))
+    page = list(stockage.activites(user=user, limite=2))
+    assert page == acts[:2]
+    page = list(stockage.activites(user=user, apres=page[-1].id, limite=2))
+    assert page == acts[2:4]
+    page = list(stockage.activites(user=user, apres=page[-1].id))
+    assert page == acts[4:]
+    assert len(list(stockage.activites(limite=10))) == 6
+
+
+def test_compteurs(stockage):
+    act = Activite(user=uuid.uuid4(), sport=["Marche"], plateau=BIC)
+    stockage.put_activite(act)
+    assert stockage.scores() == {"ville-de-rimouski": 1}
+    assert stockage.scores(confirme=True) == {}
+    act.plateau = CREVIER
+    act.confirme = True
+    stockage.put_activite(act)
+    assert stockage.scores() == {"ville-de-rimouski": 0, "ville-de-repentigny": 1}
+    assert stockage.scores(confirme=True) == {"ville-de-repentigny": 1}
+    # Compteurs sauvegardés et validés à la réouverture
+    stockage.put_activite(Activite(user=uuid.uuid4(), sport=["Vélo"], plateau=BIC))
+    stockage.close()
+    stockage = type(stockage)(stockage.datadir)
+    assert stockage.scores() == {"ville-de-rimouski": 1, "ville-de-repentigny": 1}
+    stockage.close()
+
+
+def test_cumuls(stockage):
+    jour = datetime.datetime(2024, 6, 3, 12)
+    act = Activite(
+        user=uuid.uuid4(), sport=["Marche", "Vélo"], plateau=BIC, date=jour
+    )
+    stockage.put_activite(act)
+    stockage.put_activite(
+        Activite(user=uuid.uuid4(), sport=["Vélo"], plateau=CREVIER, date=jour)
+    )
+    juin, juillet = datetime.date(2024, 6, 1), datetime.date(2024, 7, 1)
+    assert stockage.scores(debut=juin, fin=juillet) == {
+        "ville-de-rimouski": 1,
+        "ville-de-repentigny": 1,
+    }
+    assert stockage.scores(sport="Marche") == {"ville-de-rimouski": 1}
+    assert stockage.scores(debut=juillet) == {}
+    # Déplacer une activité retire sa contribution de l'ancienne case
+    act.date = datetime.datetime(2024, 7, 2)
+    act.sport = ["Marche"]
+    act.confirme = True
+    stockage.put_activite(act)
+    assert stockage.scores(fin=juillet) == {"ville-de-repentigny": 1}
+    assert stockage.scores(sport="Vélo") == {"ville-de-repentigny": 1}
+    assert stockage.scores(debut=juillet, confirme=True, sport="Marche") == {
+        "ville-de-rimouski": 1
+    }
+    # Cumuls sauvegardés, ou recalculés s'ils sont absents
+    stockage.close()
+    if isinstance(stockage, StockageSQLite):
+        stockage = StockageSQLite(stockage.datadir)
+        stockage.db.execute("DELETE FROM cumuls")
+        stockage.close()
+    stockage = type(stockage)(stockage.datadir)
+    assert stockage.scores(debut=juillet) == {"ville-de-rimouski": 1}
+    stockage.close()
+
+
+def ecrire_activites(moteur, datadir: Path, n: int):
+    stockage = moteur(datadir)
+    for _ in range(n):
+        stockage.put_activite(
+            Activite(user=uuid.uuid4(), sport=["Marche"], plateau=BIC)
+        )
+    stockage.close()
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="fork requis"
+)
+def test_processus(stockage):
+    """Plusieurs processus écrivent dans le même DATADIR"""
+    contexte = multiprocessing.get_context("fork")
+    processus = [
+        contexte.Process(
+            target=ecrire_activites, args=(type(stockage), stockage.datadir, 20)
+        )
+        for _ in range(4)
+    ]
+    for p in processus:
+        p.start()
+    for p in processus:
+        p.join()
+        assert p.exitcode == 0
+    # Les compteurs d'un stockage déjà ouvert sont à jour
+    assert stockage.scores() == {"ville-de-rimouski": 80}
+    assert stockage.scores(sport="Marche") == {"ville-de-rimouski": 80}
+    assert len(list(stockage.activites())) == 80
+
+
+def test_observations_proches(stockage):
+    user = uuid.uuid4()
+    date = datetime.datetime(2024, 6, 1)
+    proche = Observation(
+        user=user,
+        date=date,
+        code_espece="ACNE",
+        emplacement=PointModel(coordinates=(-73.432, 45.769)),
+    )
+    loin = Observation(
+        user=uuid.uuid4(),
+        date=date + datetime.timedelta(days=30),
+        code_espece="ACPL",
+        emplacement=PointModel(coordinates=(-73.45, 45.78)),
+    )
+    stockage.put_observations([proche, loin])
+    assert stockage.get_observation(proche.id) == proche
+    assert list(stockage.observations(user=user)) == [proche]
+    obss = stockage.observations_proches(45.768380, -73.431657)
+    assert [obs for _, obs in obss] == [proche, loin]
+    assert obss[0][0] < 100
+    assert stockage.observations_proches(45.768380, -73.431657, proximite=1) == [
+        obss[0]
+    ]
+    assert stockage.observations_proches(45.768380, -73.431657, limite=1) == [
+        obss[0]
+    ]
+    obss = stockage.observations_proches(45.768380, -73.431657, code_espece="ACPL")
+    assert [obs for _, obs in obss] == [loin]
+    obss = stockage.observations_proches(
+        45.768380, -73.431657, debut=date + datetime.timedelta(days=1)
+    )
+    assert [obs for _, obs in obss] == [loin]
+    obss = stockage.observations_proches(
+        45.768380, -73.431657, fin=date + datetime.timedelta(days=1)
+    )
+    assert [obs for _, obs in obss] == [proche]
+    # Déplacer une observation met l'index à jour
+    proche.emplacement = PointModel(coordinates=(-68.5164, 48.44))
+    stockage.put_observation(proche)
+    obss = stockage.observations_proches(45.768380, -73.431657)
+    assert [obs for _, obs in obss] == [loin]
+    obss = stockage.observations_proches(48.44, -68.5164)
+    assert [obs for _, obs in obss] == [proche]
+
+
+def test_densites(stockage):
+    def observation(code_espece, longitude, latitude):
+        return Observation(
+            user=uuid.uuid4(),
+            date=datetime.datetime(2024, 6, 1),
+            code_espece=code_espece,
+            emplacement=PointModel(coordinates=(longitude, latitude)),
+        )
+
+    rimouski = [observation("ACNE", -68.5164, 48.44) for _ in range(3)]
+    repentigny = observation("ACPL", -73.432, 45.769)
+    stockage.put_observations([*rimouski, repentigny])
+    quebec = (-80.0, 44.0, -57.0, 63.0)
+    assert sum(stockage.densites(0, quebec).values()) == 4
+    densites = stockage.densites(8, quebec)
+    assert sorted(densites.values()) == [1, 3]
+    assert {code for _, _, _, code in densites} == {"ACNE", "ACPL"}
+    assert list(stockage.densites(8, quebec, ["ACPL"]).values()) == [1]
+    assert stockage.densites(8, (-70.0, 48.0, -68.0, 49.0)) == {
+        k: v for k, v in densites.items() if k[3] == "ACNE"
+    }
+    # Déplacer une observation change ses tuiles
+    repentigny.emplacement = PointModel(coordinates=(-68.5164, 48.44))
+    stockage.put_observation(repentigny)
+    densites = stockage.densites(16, quebec)
+    assert sorted(densites.values()) == [1, 3]
+    assert len({(x, y) for _, x, y, _ in densites}) == 1
+    # Une observation répétée dans un lot n'est comptée qu'une fois
+    deplacee = repentigny.model_copy(
+        update={"emplacement": PointModel(coordinates=(-73.432, 45.769))}
+    )
+    nouvelle = observation("ACNE", -73.432, 45.769)
+    stockage.put_observations([repentigny, deplacee, nouvelle, nouvelle])
+    assert sum(stockage.densites(0, quebec).values()) == 5
+    assert stockage.densites(16, (-70.0, 48.0, -68.0, 49.0)) == {
+        k: v for k, v in densites.items() if k[3] == "ACNE"
+    }
+    assert stockage.densites(16, (-74.0, 45.0, -73.0, 46.0), ["ACPL"]) == {
+        (16, x, y, "ACPL"): 1
+        for _, x, y, _ in stockage.densites(16, (-74.0, 45.0, -73.0, 46.0))
+    }
+
+
+def test_photos(stockage):
+    obs = Observation(
+        user=uuid.uuid4(),
+        date=datetime.datetime(2024, 6, 1),
+        code_espece="ACNE",
+        emplacement=PointModel(coordinates=(-68.5164, 48.44)),
+    )
+    stockage.put_observation(obs)
+    assert stockage.ajouter_photo(uuid.uuid4(), "a.jpg") is None
+    # Des photos ajoutées en même temps sont toutes gardées
+    noms = [f"{i:064x}.jpg" for i in range(16)]
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda nom: stockage.ajouter_photo(obs.id, nom), noms))
+    assert sorted(stockage.get_observation(obs.id).photos) == noms
+    assert stockage.ajouter_photo(obs.id, noms[0]).photos.count(noms[0]) == 1
+    # Une mise à jour de l'observation ne les efface pas
+    stockage.put_observation(obs)
+    assert sorted(stockage.get_observation(obs.id).photos) == noms
+
+
+def test_densites_perimees():
+    with tempfile.TemporaryDirectory() as tempdir:
+        sqlite = StockageSQLite(Path(tempdir))
+        sqlite.put_observation(
+            Observation(
+                user=uuid.uuid4(),
+                date=datetime.datetime(2024, 6, 1),
+                code_espece="ACNE",
+                emplacement=PointModel(coordinates=(-68.5164, 48.44)),
+            )
+        )
+        avant = sqlite.densites(12, (-70.0, 48.0, -68.0, 49.0))
+        # Base créée avant les densités
+        sqlite.db.execute("DELETE FROM densites")
+        sqlite.db.execute("DELETE FROM meta WHERE cle = 'observations'")
+        sqlite.close()
+        sqlite = StockageSQLite(Path(tempdir))
+        assert sqlite.densites(12, (-70.0, 48.0, -68.0, 49.0)) == avant
+        sqlite.close()
+
+
+def test_users(stockage):
+    foobie = Utilisateur(nom="foobie", sports=["Marche"])
+    stockage.put_user(foobie)
+    assert stockage.get_user(foobie.id) == foobie
+    assert stockage.get_user_nom("foobie") == foobie
+    with pytest.raises(NomPris):
+        stockage.put_user(Utilisateur(nom="foobie", sports=["Vélo"]))
+    # Changer de nom libère l'ancien
+    renomme = foobie.model_copy(update={"nom": "foo/bie"})
+    stockage.put_user(renomme)
+    assert stockage.get_user_nom("foobie") is None
+    assert stockage.get_user_nom("foo/bie") == renomme
+    autre = Utilisateur(nom="foobie", sports=["Vélo"])
+    stockage.put_user(autre)
+    assert stockage.get_user_nom("foobie") == autre
+    assert sorted(u.id for u in stockage.users()) == sorted([foobie.id, autre.id])
+
+
+def test_noms_perimes():
+    with tempfile.TemporaryDirectory() as tempdir:
+        fichiers = StockageFichiers(Path(tempdir))
+        foobie = Utilisateur(nom="foobie", sports=["Marche"])
+        fichiers.put_user(foobie)
+        # Plantage après la réservation du nouveau nom
+        (Path(tempdir) / "users" / "noms" / "barbie").write_text(str(foobie.id))
+        assert fichiers.get_user_nom("barbie") is None
+        barbie = Utilisateur(nom="barbie", sports=["Vélo"])
+        fichiers.put_user(barbie)
+        assert fichiers.get_user_nom("barbie") == barbie
+        # Index reconstruit s'il est absent
+        for path in (Path(tempdir) / "users" / "noms").iterdir():
+            path.unlink()
+        (Path(tempdir) / "users" / "noms").rmdir()
+        fichiers = StockageFichiers(Path(tempdir))
+        assert fichiers.get_user_nom("foobie") == foobie
+
+
+def test_compteurs_perimes(caplog):
+    with tempfile.TemporaryDirectory() as tempdir:
+        # Pas d'avertissement pour une base neuve
+        StockageSQLite(Path(tempdir)).close()
+        assert "périmés" not in caplog.text
+        acts = [
+            Activite(user=uuid.uuid4(), sport=["Marche"], plateau=BIC)
+            for _ in range(3)
+        ]
+        fichiers = StockageFichiers(Path(tempdir))
+        fichiers.put_activites(acts[:2])
+        # Activité ajoutée sans passer par le stockage
+        with open(Path(tempdir) / "activites" / f"{acts[2].id}.json", "wt") as outfh:
+            outfh.write(acts[2].model_dump_json())
+        fichiers = StockageFichiers(Path(tempdir))
+        assert fichiers.scores() == {"ville-de-rimouski": 3}
+        sqlite = StockageSQLite(Path(tempdir))
+        sqlite.put_activites(acts)
+        sqlite.db.execute("DELETE FROM activites WHERE id = ?", (str(acts[0].id),))
+        sqlite.close()
+        sqlite = StockageSQLite(Path(tempdir))
+        assert sqlite.scores() == {"ville-de-rimouski": 2}
+        sqlite.close()
+
+
+def test_migrer():
+    with tempfile.TemporaryDirectory() as tempdir:
+        source = StockageFichiers(Path(tempdir))
+        acts = [
+            Activite(user=uuid.uuid4(), sport=["Marche"], plateau=BIC)
+            for _ in range(10)
+        ]
+        source.put_activites(acts)
+        dest = StockageSQLite(Path(tempdir))
+        assert migrer(source, dest) == 10
+        assert sorted(a.id for a in dest.activites()) == sorted(a.id for a in acts)
+        dest.close()
+
+
+def test_moteur_incomplet(monkeypatch):
+    class Incomplet(Stockage):
+        def put_activite(self, activite):
+            pass
+
+    # Une méthode oubliée est détectée à l'ouverture, pas à la requête
+    monkeypatch.setitem(MOTEURS, "incomplet", Incomplet)
+    with tempfile.TemporaryDirectory() as tempdir:
+        with pytest.raises(TypeError, match="get_activite"):
+            ouvrir("incomplet", Path(tempdir))
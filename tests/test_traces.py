@@ -0,0 +1,110 @@
+import datetime
+import json
+import time
+import uuid
+
+import numpy as np
+
+from points_air import plateaux, traces
+
+# Le Bic
+PLATEAU = uuid.UUID("17aa7a09-e295-499c-845a-41a01e061a64")
+
+
+def gpx(points) -> bytes:
+    trkpts = "".join(
+        f'<trkpt lat="{lat}" lon="{lon}"><ele>10</ele><time>{t}</time></trkpt>\n'
+        for lon, lat, t in points
+    )
+    return (
+        '<?xml version="1.0"?>\n'
+        '<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">\n'
+        f"<trk><name>Sortie</name><trkseg>\n{trkpts}</trkseg></trk></gpx>\n"
+    ).encode()
+
+
+def test_gpx():
+    points = [
+        (-68.805, 48.355, "2024-06-01T10:00:00Z"),
+        (-68.806, 48.356, "2024-06-01T10:05:00Z"),
+        (-68.5, 48.4, "2024-06-01T10:10:00Z"),
+    ]
+    donnees = gpx(points)
+    lecteur = traces.LecteurGPX()
+    # Morceaux arbitraires, comme reçus du réseau
+    for i in range(0, len(donnees), 7):
+        lecteur.feed(donnees[i : i + 7])
+    trace = lecteur.close()
+    assert list(trace.x) == [-68.805, -68.806, -68.5]
+    assert list(trace.y) == [48.355, 48.356, 48.4]
+    assert np.diff(trace.t).tolist() == [300, 300]
+    verification = traces.verifier(trace, plateaux.SHAPES[PLATEAU], 0.5, 600)
+    assert (verification.points, verification.dedans) == (3, 2)
+    assert verification.duree == 300
+    assert not verification.confirme
+    assert traces.verifier(trace, plateaux.SHAPES[PLATEAU], 0.5, 300).confirme
+
+
+def test_sans_heures():
+    lecteur = traces.LecteurGPX()
+    lecteur.feed(
+        b'<gpx><trk><trkseg><trkpt lat="48.355" lon="-68.805"/>'
+        b'<trkpt lat="48.356" lon="-68.806"/></trkseg></trk></gpx>'
+    )
+    trace = lecteur.close()
+    verification = traces.verifier(trace, plateaux.SHAPES[PLATEAU])
+    # Seule la couverture est vérifiée
+    assert verification.duree is None
+    assert verification.confirme
+    assert not traces.verifier(trace, plateaux.SHAPES[PLATEAU], 1.1).confirme
+    vide = traces.Trace(np.array([]), np.array([]), np.array([]))
+    assert not traces.verifier(vide, plateaux.SHAPES[PLATEAU]).confirme
+
+
+def test_geojson():
+    lecteur = traces.LecteurGeoJSON()
+    lecteur.feed(
+        json.dumps(
+            {
+                "type": "Feature",
+                "properties": {
+                    "coordTimes": ["2024-06-01T10:00:00Z", "2024-06-01T10:20:00Z"]
+                },
+                "geometry": {
+                    "type": "LineString",
+                    "coordinates": [[-68.805, 48.355, 10], [-68.806, 48.356, 12]],
+                },
+            }
+        ).encode()
+    )
+    trace = lecteur.close()
+    verification = traces.verifier(trace, plateaux.SHAPES[PLATEAU])
+    assert verification.couverture == 1.0
+    assert verification.duree == 1200
+    assert verification.confirme
+
+
+def test_longue_trace():
+    # Une longue sortie: 100 000 points à la seconde autour du plateau
+    n = 100_000
+    angle = np.linspace(0, 20 * np.pi, n)
+    depart = datetime.datetime(2024, 6, 1, 10)
+    points = zip(
+        -68.805 + 0.002 * np.cos(angle),
+        48.355 + 0.002 * np.sin(angle),
+        (
+            (depart + datetime.timedelta(seconds=i)).isoformat() + "Z"
+            for i in range(n)
+        ),
+    )
+    donnees = gpx(points)
+    debut = time.perf_counter()
+    lecteur = traces.LecteurGPX()
+    for i in range(0, len(donnees), 65536):
+        lecteur.feed(donnees[i : i + 65536])
+    verification = traces.verifier(lecteur.close(), plateaux.SHAPES[PLATEAU])
+    duree = time.perf_counter() - debut
+    assert verification.points == n
+    assert verification.confirme
+    assert verification.duree == n - 1
+    assert duree < 5  # Bien moins d'une seconde hors des tests
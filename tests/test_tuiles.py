@@ -0,0 +1,16 @@
+from points_air import tuiles
+
+
+def test_tuiles():
+    # Exemple de la documentation des quadkeys de Bing Maps
+    assert tuiles.quadkey(3, 3, 5) == "213"
+    assert tuiles.quadkey(0, 0, 0) == ""
+    z, x, y = tuiles.tuiles(-68.5164, 48.44)[-1]
+    assert z == tuiles.NIVEAU_MAX
+    ouest, sud, est, nord = tuiles.boite(z, x, y)
+    assert ouest <= -68.5164 < est and sud < 48.44 <= nord
+    # Les tuiles parentes sont des préfixes du quadkey
+    niveaux = [tuiles.quadkey(*t) for t in tuiles.tuiles(-68.5164, 48.44)]
+    assert all(b.startswith(a) for a, b in zip(niveaux, niveaux[1:]))
+    xmin, xmax, ymin, ymax = tuiles.plage((-80.0, 44.0, -57.0, 63.0), 4)
+    assert xmin <= x >> (z - 4) <= xmax and ymin <= y >> (z - 4) <= ymax
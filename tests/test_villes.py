@@ -1,4 +1,6 @@
-from points_air.villes import Ville
+import datetime
+
+from points_air.villes import Ville, bornes_periode, villes_wgs84
 
 
 def test_find_laval():
@@ -9,3 +11,32 @@ def test_find_laval():
     # On se trouve à Repentigny
     repentigny = Ville.from_wgs84(45.768380, -73.431657)
     assert repentigny.nom == "Repentigny"
+
+
+def test_villes_wgs84():
+    """Localiser plusieurs emplacements à la fois"""
+    assert villes_wgs84(
+        [45.628861, 45.768380, 48.4400], [-73.804224, -73.431657, -68.5164]
+    ) == [None, "ville-de-repentigny", "ville-de-rimouski"]
+    assert villes_wgs84([], []) == []
+
+
+def test_bornes_periode():
+    jour = datetime.date(2024, 1, 10)
+    assert bornes_periode("semaine", jour) == (
+        datetime.date(2024, 1, 8),
+        datetime.date(2024, 1, 15),
+    )
+    assert bornes_periode("mois", jour) == (
+        datetime.date(2024, 1, 1),
+        datetime.date(2024, 2, 1),
+    )
+    # L'hiver commence en décembre de l'année précédente
+    assert bornes_periode("saison", jour) == (
+        datetime.date(2023, 12, 1),
+        datetime.date(2024, 3, 1),
+    )
+    assert bornes_periode("saison", datetime.date(2024, 12, 25)) == (
+        datetime.date(2024, 12, 1),
+        datetime.date(2025, 3, 1),
+    )